@@ -8,6 +8,7 @@ setup(
     version="0.1.0",
     description="Generic tool to solve the modify + re-run problem",
     install_requires=requirements,
+    python_requires=">=3.7",
     setup_requires=["pytest-runner"],
     tests_require=[
         "pytest",
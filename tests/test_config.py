@@ -1,5 +1,3 @@
-from __future__ import division, print_function
-
 import pytest
 from watchcode.config import *
 
@@ -117,6 +115,36 @@ def test_fileset_validate():
     assert "'extra_key'" in str(e)
 
 
+def test_fileset_validate_invalid_pattern():
+    data = {
+        "include": ["(unbalanced"],
+        "exclude": None,
+        "match_mode": "re",
+    }
+    with pytest.raises(ConfigError) as e:
+        FileSet.validate(data)
+    assert "invalid pattern" in str(e)
+
+
+def test_fileset_validate_events():
+    data = {
+        "include": ["*"],
+        "exclude": None,
+        "events": ["modified", "moved"],
+        "directories": False,
+    }
+    fileset = FileSet.validate(data)
+    assert fileset.event_types == {"modified", "moved_from", "moved_to"}
+    assert not fileset.directories
+
+    assert FileSet.validate({"include": ["*"], "exclude": None}).directories
+
+    data["events"] = ["changed"]
+    with pytest.raises(ConfigError) as e:
+        FileSet.validate(data)
+    assert "'changed'" in str(e)
+
+
 def test_config_overrides(tmpdir):
     overrides = Overrides(task_name="other")
     c1 = load_test_config(tmpdir, CONFIG_VALID)
@@ -126,6 +154,128 @@ def test_config_overrides(tmpdir):
     assert c2.task.commands[0] == "other"
 
 
+def test_config_all_tasks(tmpdir):
+    c1 = load_test_config(tmpdir, CONFIG_VALID)
+    c2 = load_test_config(tmpdir, CONFIG_VALID, Overrides(all_tasks=True))
+
+    assert not c1.all_tasks
+    assert sorted(c1.active_tasks.keys()) == ["default"]
+    assert c2.all_tasks
+    assert sorted(c2.active_tasks.keys()) == ["default", "other"]
+    assert c2.tasks["other"].fileset_name == "default"
+
+
+def test_config_parallel_command_groups(tmpdir):
+    config = CONFIG_VALID.replace(
+        '      - "py.test"\n',
+        '      - "py.test"\n'
+        '      - parallel:\n'
+        '          - "flake8"\n'
+        '          - "mypy ."\n'
+        '        max_parallel: 1\n'
+        '      - parallel:\n'
+        '          - "a"\n'
+        '          - "b"\n',
+    )
+    c = load_test_config(tmpdir, config)
+    commands = c.task.commands
+    assert commands[0] == "py.test"
+    assert isinstance(commands[1], CommandGroup)
+    assert commands[1].commands == ["flake8", "mypy ."]
+    assert commands[1].max_parallel == 1
+    assert commands[2].max_parallel == 2
+
+    with pytest.raises(ConfigError) as e:
+        load_test_config(tmpdir, config.replace("max_parallel: 1", "max_parallel: 0"))
+    assert "positive integer" in str(e)
+
+
+def test_config_empty_commands(tmpdir):
+    # an unspecified list in YAML is an empty list
+    config = CONFIG_VALID.replace('    commands:\n      - "other"\n', '    commands:\n')
+    c = load_test_config(tmpdir, config)
+    assert c.tasks["other"].commands == []
+
+
+def test_config_debounce(tmpdir):
+    c = load_test_config(tmpdir, CONFIG_VALID)
+    assert c.task.debounce == 0.2
+    assert c.task.debounce_max_wait is None
+
+    c = load_test_config(tmpdir, CONFIG_VALID.replace(
+        '      - "py.test"\n',
+        '      - "py.test"\n    debounce_max_wait: 5\n',
+    ))
+    assert c.task.debounce_max_wait == 5
+
+    config = CONFIG_VALID.replace(
+        '      - "py.test"\n',
+        '      - "py.test"\n    debounce: adaptive\n    debounce_max: 2\n',
+    )
+    c = load_test_config(tmpdir, config)
+    assert c.task.debounce == "adaptive"
+    assert (c.task.debounce_min, c.task.debounce_max) == (0.05, 2)
+
+    with pytest.raises(ConfigError) as e:
+        load_test_config(tmpdir, config.replace("adaptive", "fast"))
+    assert "'adaptive'" in str(e)
+
+    with pytest.raises(ConfigError) as e:
+        load_test_config(tmpdir, config.replace("debounce_max: 2", "debounce_max: 0.01"))
+    assert "must not exceed" in str(e)
+
+
+def test_config_runner(tmpdir):
+    c = load_test_config(tmpdir, CONFIG_VALID)
+    assert c.task.runner == "shell"
+
+    config = CONFIG_VALID.replace(
+        '      - "py.test"\n',
+        '      - "py.test"\n    runner: python-forkserver\n    preload:\n      - numpy\n',
+    )
+    c = load_test_config(tmpdir, config)
+    assert c.task.runner == "python-forkserver"
+    assert c.task.preload == ["numpy"]
+
+    with pytest.raises(ConfigError) as e:
+        load_test_config(tmpdir, config.replace("python-forkserver", "shell"))
+    assert "requires runner" in str(e)
+
+    config = CONFIG_VALID.replace(
+        '      - "py.test"\n',
+        '      - "py.test"\n    runner: shell-session\n    setup:\n      - ". venv/bin/activate"\n',
+    )
+    c = load_test_config(tmpdir, config)
+    assert c.task.runner == "shell-session"
+    assert c.task.setup == [". venv/bin/activate"]
+
+    with pytest.raises(ConfigError) as e:
+        load_test_config(tmpdir, config.replace("shell-session", "shell"))
+    assert "requires runner" in str(e)
+
+
+def test_config_task_dependencies(tmpdir):
+    config = CONFIG_VALID.replace(
+        '      - "other"\n',
+        '      - "other"\n    depends_on:\n      - default\n',
+    )
+    c = load_test_config(tmpdir, config, Overrides(task_name="other"))
+    assert c.tasks["other"].depends_on == ["default"]
+    assert sorted(c.active_tasks.keys()) == ["default", "other"]
+
+    with pytest.raises(ConfigError) as e:
+        load_test_config(tmpdir, config.replace("- default\n", "- missing\n"))
+    assert "does not exist" in str(e)
+
+    config = config.replace(
+        '      - "py.test"\n',
+        '      - "py.test"\n    depends_on:\n      - other\n',
+    )
+    with pytest.raises(ConfigError) as e:
+        load_test_config(tmpdir, config)
+    assert "cycle" in str(e)
+
+
 def test_load_config(tmpdir):
     with tmpdir.as_cwd():
 
@@ -149,3 +299,33 @@ def test_load_config(tmpdir):
         load_test_config(tmpdir, CONFIG_INVALID_DEFAULT_TASK)
     with pytest.raises(ConfigError):
         load_test_config(tmpdir, CONFIG_INVALID_MATCH_MODE)
+
+
+def test_config_factory_caching(tmpdir):
+    with tmpdir.as_cwd():
+        with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+            f.write(CONFIG_VALID)
+        config_factory = ConfigFactory(".", Overrides())
+        c1 = config_factory.load_config()
+        assert config_factory.load_config() is c1
+
+        # unchanged content => no re-parsing
+        config_factory.notify_changed()
+        assert config_factory.load_config() is c1
+
+        with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+            f.write(CONFIG_VALID.replace("default_task: default", "default_task: other"))
+        # without notification the cached config is still used
+        assert config_factory.load_config() is c1
+        config_factory.notify_changed()
+        c2 = config_factory.load_config()
+        assert c2 is not c1
+        assert c2.task.commands[0] == "other"
+
+        # errors are raised until the config is fixed
+        with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+            f.write(CONFIG_INVALID_DEFAULT_TASK)
+        config_factory.notify_changed()
+        for _ in range(2):
+            with pytest.raises(ConfigError):
+                config_factory.load_config()
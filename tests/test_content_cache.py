@@ -0,0 +1,47 @@
+import os
+
+from watchcode.content_cache import ContentCache, hash_file
+
+
+def write_file(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_hash_file(tmpdir):
+    with tmpdir.as_cwd():
+        write_file("a", "x" * 1000)
+        write_file("b", "")
+        # mmap and plain reads must agree
+        assert hash_file("a", 10) == hash_file("a", 10000)
+        assert hash_file("b", 0) == hash_file("b", 10000)
+
+
+def test_content_cache(tmpdir):
+    with tmpdir.as_cwd():
+        write_file("a", "content")
+        write_file("b", "content")
+
+        cache = ContentCache()
+        cache.prime(["a"])
+        assert len(cache) == 1
+
+        # touching doesn't change the content
+        st = os.stat("a")
+        os.utime("a", ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        assert cache.changed(["a"]) == set()
+
+        # same size, different content, and a modification within the same
+        # mtime tick must still be detected (racily clean entries are re-hashed)
+        write_file("a", "CONTENT")
+        assert cache.changed(["a"]) == {"a"}
+        write_file("a", "content")
+        assert cache.changed(["a"]) == {"a"}
+        assert cache.changed(["a"]) == set()
+
+        # unknown files might have changed
+        assert cache.changed(["b"]) == {"b"}
+        assert cache.changed(["b"]) == set()
+
+        os.remove("b")
+        assert cache.changed(["b"]) == {"b"}
@@ -0,0 +1,166 @@
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+
+from watchcode import forkserver as forkserver_module
+from watchcode.forkserver import ForkedProcess, ForkServer, parse_python_command
+from watchcode.io_handler import IOHandler
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+
+
+def write_file(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def wait_with_timeout(predicate, timeout=10.0):
+    t_start = time.time()
+    while not predicate():
+        assert time.time() - t_start < timeout, "timeout"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def own_environment(monkeypatch):
+    # `python` on PATH might be another interpreter than the one running the tests
+    monkeypatch.setattr(forkserver_module, "is_own_environment", lambda prog: True)
+
+
+def test_parse_python_command(monkeypatch):
+    bin_dir = os.path.dirname(os.path.abspath(sys.executable))
+    monkeypatch.setattr(shutil, "which", lambda prog: (
+        os.path.join(bin_dir, prog) if prog in ("pytest", "py.test") else sys.executable
+    ))
+    assert parse_python_command("py.test -x tests") == {"kind": "pytest", "args": ["-x", "tests"]}
+    assert parse_python_command("python -m pytest -k 'a or b'") == \
+        {"kind": "pytest", "args": ["-k", "a or b"]}
+    assert parse_python_command("python3 -m mypkg.cli run") == \
+        {"kind": "module", "target": "mypkg.cli", "args": ["run"]}
+    assert parse_python_command("python script.py --flag") == \
+        {"kind": "path", "target": "script.py", "args": ["--flag"]}
+    # anything requiring a shell
+    assert parse_python_command("py.test && flake8") is None
+    assert parse_python_command("py.test tests/*.py") is None
+    assert parse_python_command("FOO=1 py.test") is None
+    assert parse_python_command("python -c 'print(1)'") is None
+    assert parse_python_command("make test") is None
+    # programs of other environments, e.g. of an activated venv
+    assert parse_python_command("./venv/bin/python script.py") is None
+    monkeypatch.setattr(shutil, "which", lambda prog: os.path.join("/other/venv/bin", prog))
+    assert parse_python_command("python script.py") is None
+    assert parse_python_command("py.test -x tests") is None
+
+
+def test_fork_server(tmpdir, own_environment):
+    with tmpdir.as_cwd():
+        write_file("heavy.py", "VALUE = 1\n")
+        write_file("script.py", (
+            "import os, sys, heavy\n"
+            "with open('out.txt', 'w') as f:\n"
+            "    f.write('{} {} {}'.format(heavy.VALUE, sys.argv[1], os.environ['TEST_VAR']))\n"
+            "sys.exit(3)\n"
+        ))
+        forkserver = ForkServer(".", ["heavy"])
+        env = dict(os.environ, TEST_VAR="x")
+        started = []
+        try:
+            command = "python script.py arg"
+            assert forkserver.accepts(command)
+            assert forkserver.run(command, env, started.append) == 3
+            with open("out.txt") as f:
+                assert f.read() == "1 arg x"
+            assert started[0].poll() == 3
+
+            # modules are preloaded once => changes require re-warming
+            write_file("heavy.py", "VALUE = 2\n")
+            server = forkserver.warm()
+            forkserver.notify_changed([os.path.abspath("other.py")])
+            forkserver.notify_changed([os.path.abspath("heavy.py")])
+            wait_with_timeout(lambda: forkserver.warm() is not server)
+            assert forkserver.run(command, env, started.append) == 3
+            with open("out.txt") as f:
+                assert f.read() == "2 arg x"
+        finally:
+            forkserver.stop()
+
+
+def test_fork_server_change_while_starting(tmpdir, own_environment):
+    with tmpdir.as_cwd():
+        write_file("heavy.py", "import time\ntime.sleep(1.0)\nVALUE = 1\n")
+        write_file("script.py", (
+            "import heavy\n"
+            "with open('out.txt', 'w') as f:\n"
+            "    f.write(str(heavy.VALUE))\n"
+        ))
+        forkserver = ForkServer(".", ["heavy"])
+        try:
+            server = forkserver.warm()
+            time.sleep(0.5)
+            assert not server.ready.is_set()
+
+            # the run right after the change must not use the starting server
+            write_file("heavy.py", "VALUE = 2\n")
+            forkserver.notify_changed([os.path.abspath("heavy.py")])
+            assert forkserver.run("python script.py", dict(os.environ), lambda child: None) == 0
+            with open("out.txt") as f:
+                assert f.read() == "2"
+            assert forkserver.warm() is not server
+        finally:
+            forkserver.stop()
+
+
+def test_fork_server_restarts_after_exit(tmpdir, own_environment):
+    with tmpdir.as_cwd():
+        write_file("script.py", "import sys\nsys.exit(4)\n")
+        forkserver = ForkServer(".", [])
+        env = dict(os.environ)
+        try:
+            server = forkserver.warm()
+            server.proc.kill()
+            server.proc.wait()
+            assert forkserver.run("python script.py", env, lambda child: None) == 4
+            assert forkserver.warm() is not server
+        finally:
+            forkserver.stop()
+
+
+def test_fork_server_fallback_to_shell(tmpdir, monkeypatch, capfd, own_environment):
+    # a server which fails to start
+    monkeypatch.setattr(forkserver_module, "SERVER_BOOTSTRAP", "import sys; sys.exit(1)")
+    with tmpdir.as_cwd():
+        write_file("script.py", "import sys\nsys.exit(5)\n")
+        forkserver = ForkServer(".", [])
+        try:
+            retcode, _ = IOHandler(".")._run_command("python script.py", False, runner=forkserver)
+            assert retcode == 5
+            assert "running in a shell" in capfd.readouterr().out
+        finally:
+            forkserver.stop()
+
+
+def test_forked_process():
+    proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)"])
+    child = ForkedProcess(proc.pid)
+    with pytest.raises(subprocess.TimeoutExpired):
+        child.wait(timeout=0.01)
+    child.terminate()
+    child._set_returncode(proc.wait())
+    assert child.wait(timeout=0.01) == child.poll() < 0
+    # signals to a finished process are ignored
+    child.kill()
+
+
+def test_fork_server_preload_error(tmpdir, capfd, own_environment):
+    with tmpdir.as_cwd():
+        write_file("script.py", "")
+        forkserver = ForkServer(".", ["module_that_does_not_exist"])
+        try:
+            assert forkserver.run("python script.py", dict(os.environ), lambda child: None) == 0
+            assert "Failed to preload module module_that_does_not_exist" in capfd.readouterr().out
+        finally:
+            forkserver.stop()
@@ -0,0 +1,116 @@
+import os
+import subprocess
+import threading
+
+from watchcode import git_files
+from watchcode.config import FileSet
+from watchcode.gitignore import GitIgnore
+from watchcode.git_files import GitFileList
+from watchcode.match_index import MatchIndex
+from watchcode.matching import does_match, is_excluded_subtree
+from watchcode.trigger import FileEvent
+
+
+def write_file(path, content=""):
+    dirname = os.path.dirname(path)
+    if dirname != "" and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def git(*args):
+    subprocess.check_call(["git"] + list(args))
+
+
+def test_git_file_list(tmpdir):
+    with tmpdir.as_cwd():
+        git("init", "--quiet")
+        write_file(".gitignore", "*.log\nbuild/\n")
+        write_file(os.path.join("src", "a.py"))
+        write_file(os.path.join("build", "out.py"))
+        write_file("untracked.txt")
+        write_file("tracked.log")
+        git("add", ".gitignore", "src")
+        git("add", "-f", "tracked.log")
+
+        file_list = GitFileList(GitIgnore("."))
+        assert len(file_list) == 4
+        assert file_list.contains(os.path.join(".", "src", "a.py"), False)
+        assert file_list.contains(os.path.join(".", "src"), True)
+        assert file_list.contains(os.path.join(".", "untracked.txt"), False)
+        # tracked files are listed even if they are ignored
+        assert file_list.contains(os.path.join(".", "tracked.log"), False)
+        assert not file_list.contains(os.path.join(".", "build", "out.py"), False)
+        assert not file_list.contains(os.path.join(".", "build"), True)
+        assert not file_list.contains(os.path.join(".", ".git", "index"), False)
+
+        # new untracked files don't change the index
+        write_file("new.py")
+        write_file("new.log")
+        assert file_list.contains(os.path.join(".", "new.py"), False)
+        assert not file_list.contains(os.path.join(".", "new.log"), False)
+
+        # changes of the index are picked up by a refresh
+        generation = file_list.generation
+        assert not file_list.refresh()
+        git("rm", "--quiet", "--cached", "tracked.log")
+        assert file_list.refresh()
+        assert file_list.generation > generation
+        assert not file_list.contains(os.path.join(".", "tracked.log"), False)
+
+
+def test_git_tracked_match_mode(tmpdir):
+    with tmpdir.as_cwd():
+        git("init", "--quiet")
+        write_file(".gitignore", "node_modules/\n")
+        write_file("a.py")
+        write_file(os.path.join("node_modules", "b.py"))
+
+        fileset = FileSet.validate({
+            "include": ["*.py"],
+            "exclude": None,
+            "match_mode": "git_tracked",
+        })
+        assert not fileset.exclude_gitignore
+
+        assert does_match(fileset, FileEvent(os.path.join(".", "a.py"), "modified", False))
+        assert not does_match(fileset, FileEvent(os.path.join(".", "a.txt"), "modified", False))
+        assert not does_match(fileset, FileEvent(os.path.join(".", "node_modules", "b.py"), "modified", False))
+        assert is_excluded_subtree(fileset, FileEvent(os.path.join(".", "node_modules"), "scan", True))
+        assert is_excluded_subtree(fileset, FileEvent(os.path.join(".", ".git"), "scan", True))
+
+
+def test_git_file_list_background_refresh(tmpdir):
+    with tmpdir.as_cwd():
+        git("init", "--quiet")
+        write_file(".gitignore", "b.py\n")
+        write_file("a.py")
+        write_file("b.py")
+        git("add", "a.py")
+        git("add", "-f", "b.py")
+
+        file_list = git_files.get_git_file_list(os.path.join(".", "a.py"))
+        fileset = FileSet.validate({"include": ["*.py"], "exclude": None, "match_mode": "git_tracked"})
+        index = MatchIndex(fileset)
+        assert index.does_match(FileEvent(os.path.join(".", "a.py"), "modified", False))
+        assert index.does_match(FileEvent(os.path.join(".", "b.py"), "modified", False))
+        generation = git_files.get_generation()
+
+        # an unchanged index doesn't start a refresh
+        changed = threading.Event()
+        git_files.notify_changed(file_list.index_file, changed.set)
+        assert not changed.wait(0.2)
+
+        # the previous list is served until the refresh has finished
+        git("rm", "--quiet", "--cached", "b.py")
+        with file_list.lock:
+            git_files.notify_changed(file_list.index_file, changed.set)
+            assert file_list.contains(os.path.join(".", "b.py"), False)
+        assert changed.wait(10.0)
+        assert not file_list.contains(os.path.join(".", "b.py"), False)
+        assert git_files.changes_since(generation) == {os.path.abspath("b.py")}
+
+        # only the decisions of the changed files are dropped
+        assert not index.does_match(FileEvent(os.path.join(".", "b.py"), "modified", False))
+        assert index.matched_files() == ["a.py"]
@@ -0,0 +1,64 @@
+import os
+import subprocess
+
+from watchcode.git_operations import GitOperationMonitor
+from watchcode.trigger import FileEvent
+
+
+def write_file(path, content=""):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_git_operation_monitor(tmpdir):
+    with tmpdir.as_cwd():
+        subprocess.check_call(["git", "init", "--quiet"])
+        monitor = GitOperationMonitor(".")
+        lock_file = os.path.join(".", ".git", "index.lock")
+        a = FileEvent(os.path.join(".", "a.py"), "modified", False)
+        b = FileEvent(os.path.join(".", "b.py"), "created", False)
+
+        # no operation => events pass through
+        assert monitor.process([a]) == ([a], False)
+
+        write_file(lock_file)
+        assert monitor.process([FileEvent(lock_file, "created", False), a]) == ([], False)
+        assert monitor.paused
+        assert monitor.process([a, b]) == ([], False)
+
+        os.remove(lock_file)
+        index_event = FileEvent(os.path.join(".", ".git", "index"), "moved_to", False)
+        events, overflowed = monitor.process([index_event])
+        assert not overflowed
+        assert not monitor.paused
+        # coalesced, with events of the git directory first
+        assert [(e.path, e.type) for e in events] == [
+            (lock_file, "created"),
+            (index_event.path, "moved_to"),
+            (a.path, "modified"),
+            (b.path, "created"),
+        ]
+
+
+def test_git_operation_monitor_overflow(tmpdir):
+    with tmpdir.as_cwd():
+        subprocess.check_call(["git", "init", "--quiet"])
+        monitor = GitOperationMonitor(".")
+        monitor.MAX_BUFFERED_EVENTS = 2
+
+        os.makedirs(os.path.join(".git", "rebase-merge"))
+        events = [FileEvent(os.path.join(".", "{}.py".format(i)), "modified", False) for i in range(3)]
+        assert monitor.process([FileEvent(os.path.join(".", ".git", "rebase-merge"), "created", True)]) == ([], False)
+        assert monitor.process(events) == ([], False)
+        assert monitor.defer_overflow()
+
+        os.rmdir(os.path.join(".git", "rebase-merge"))
+        assert monitor.process(events[:1]) == ([], True)
+        assert not monitor.defer_overflow()
+
+
+def test_git_operation_monitor_no_repo(tmpdir):
+    with tmpdir.as_cwd():
+        monitor = GitOperationMonitor(".")
+        event = FileEvent(os.path.join(".", ".git", "index.lock"), "created", False)
+        assert monitor.process([event]) == ([event], False)
@@ -0,0 +1,127 @@
+import os
+import subprocess
+
+from watchcode.gitignore import GitIgnore, IgnoreRule, translate_pattern
+
+
+def git_check_ignore(path):
+    p = subprocess.Popen(
+        ["git", "check-ignore", "--no-index", path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    p.communicate()
+    return p.returncode == 0
+
+
+def write_file(path, content=""):
+    dirname = os.path.dirname(path)
+    if dirname != "" and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_translate_pattern():
+    assert translate_pattern("*.py") == "[^/]*\\.py"
+    assert translate_pattern("**/foo") == "(?:.*/)?foo"
+    assert translate_pattern("foo/**") == "foo/.*"
+    assert translate_pattern("a/**/b") == "a/(?:.*/)?b"
+    assert translate_pattern("[abc") is None
+
+
+def test_ignore_rule_parse():
+    assert IgnoreRule.parse("") is None
+    assert IgnoreRule.parse("# comment") is None
+    assert IgnoreRule.parse("\\#file").regex.match("#file")
+
+    rule = IgnoreRule.parse("!/build/")
+    assert rule.negated
+    assert rule.dir_only
+    assert not rule.basename_only
+    assert rule.pattern == "build"
+
+    rule = IgnoreRule.parse("foo  ")
+    assert rule.pattern == "foo"
+
+
+def test_agrees_with_git(tmpdir):
+    with tmpdir.as_cwd():
+        subprocess.check_call(["git", "init", "--quiet"])
+        write_file(".gitignore", "\n".join([
+            "*.log",
+            "!keep.log",
+            "/build/",
+            "**/tmp/**",
+            "docs/**/*.html",
+            "data/*",
+            "!data/important/",
+            "[Tt]humbs.db",
+            "weird\\ ",
+        ]))
+        write_file(os.path.join("sub", ".gitignore"), "\n".join([
+            "!*.log",
+            "local/",
+        ]))
+        write_file(os.path.join(".git", "info", "exclude"), "excluded_by_info\n")
+
+        for d in ["build", "sub/local", "data/important", "data/other", "sub/build"]:
+            os.makedirs(d.replace("/", os.sep))
+
+        git_ignore = GitIgnore(".")
+
+        paths = [
+            "a.log",
+            "keep.log",
+            "sub/a.log",
+            "sub/deeper/a.log",
+            "build",
+            "build/out.o",
+            "sub/build",
+            "sub/build/out.o",
+            "x/tmp/y",
+            "tmp/y",
+            "tmp",
+            "docs/a.html",
+            "docs/x/y/a.html",
+            "docs/a.txt",
+            "data/file",
+            "data/important",
+            "data/important/file",
+            "data/other/file",
+            "Thumbs.db",
+            "thumbs.db",
+            "sub/local",
+            "sub/local/file",
+            "local",
+            "excluded_by_info",
+            "sub/excluded_by_info",
+            "weird ",
+            "weird",
+        ]
+        for path in paths:
+            path = path.replace("/", os.sep)
+            expected = git_check_ignore(path)
+            actual = git_ignore.is_ignored(path)
+            assert actual == expected, \
+                "path '{}' expected ignored={}, got {}".format(path, expected, actual)
+
+
+def test_invalidation(tmpdir):
+    with tmpdir.as_cwd():
+        subprocess.check_call(["git", "init", "--quiet"])
+        write_file(".gitignore", "*.log\n")
+
+        git_ignore = GitIgnore(".")
+        assert git_ignore.is_ignored("a.log")
+        assert not git_ignore.is_ignored("a.txt")
+        generation = git_ignore.generation
+
+        # no change => no new generation
+        assert git_ignore.is_ignored("b.log")
+        assert git_ignore.generation == generation
+
+        write_file(".gitignore", "*.txt\n")
+        assert not git_ignore.is_ignored("a.log")
+        assert git_ignore.is_ignored("a.txt")
+        assert git_ignore.generation > generation
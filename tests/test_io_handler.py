@@ -1,8 +1,16 @@
-from __future__ import division, print_function
-
 import datetime
+import os
+import subprocess
+import threading
 import time
-from watchcode.io_handler import Debouncer
+
+import pytest
+
+from watchcode.io_handler import Debouncer, kill_process_group, popen_isolated_kwargs
+from watchcode.io_handler import AdaptiveDebounce
+from watchcode.io_handler import ChangeSet, CommandEnvironment, IOHandler, LaunchInfo
+from watchcode.config import CommandGroup, ConfigFactory, Overrides, DEFAULT_CONFIG_FILENAME
+from watchcode.trigger import ManualTrigger
 
 
 def wait_with_timeout(f, timeout=5.0, cycle=0.01):
@@ -104,3 +112,389 @@ def test_debouncer_enqueues_not():
     time.sleep(0.6)
     print(calls)
     assert len(calls) == 1
+
+
+def test_debouncer_rearms_precisely():
+    debouncer = Debouncer()
+    calls = []
+
+    def f():
+        calls.append(datetime.datetime.now())
+
+    t1 = datetime.datetime.now()
+    debouncer.trigger(f, 2.0, enqueue=True)
+    time.sleep(0.01)
+    # a shorter debounce time must take effect during an ongoing wait
+    debouncer.trigger(f, 0.001, enqueue=True)
+
+    wait_with_timeout(lambda: len(calls) > 0)
+    assert (calls[0] - t1).total_seconds() < 1.0
+
+
+def test_debouncer_max_wait():
+    debouncer = Debouncer()
+    calls = []
+
+    def f():
+        calls.append(datetime.datetime.now())
+
+    t1 = datetime.datetime.now()
+    # a steady stream of triggers must not postpone the task forever
+    while len(calls) == 0:
+        debouncer.trigger(f, 0.1, enqueue=False, max_wait=0.3)
+        time.sleep(0.01)
+        assert (datetime.datetime.now() - t1).total_seconds() < 5.0
+    assert (calls[0] - t1).total_seconds() < 1.0
+
+
+def test_debouncer_cancel():
+    debouncer = Debouncer()
+    calls = []
+
+    def f():
+        calls.append(datetime.datetime.now())
+
+    debouncer.trigger(f, 0.2, enqueue=True)
+    assert debouncer.cancel()
+    assert not debouncer.cancel()
+    time.sleep(0.4)
+    assert len(calls) == 0
+    assert debouncer.wait_idle(timeout=1.0)
+
+
+def test_debouncer_restarts():
+    debouncer = Debouncer()
+    calls = []
+    cancel_event = threading.Event()
+
+    def f():
+        calls.append("start")
+        cancelled = cancel_event.wait(0.5)
+        calls.append("cancelled" if cancelled else "finished")
+        cancel_event.clear()
+
+    debouncer.trigger(f, 0.001, enqueue=False, cancel_running=cancel_event.set)
+    wait_with_timeout(lambda: len(calls) > 0)
+    debouncer.trigger(f, 0.001, enqueue=False, cancel_running=cancel_event.set)
+
+    wait_with_timeout(lambda: len(calls) == 4)
+    assert calls == ["start", "cancelled", "start", "finished"]
+
+
+def test_debouncer_speculative():
+    debouncer = Debouncer()
+    calls = []
+    cancels = []
+
+    def f():
+        calls.append(time.monotonic())
+        time.sleep(0.3)
+
+    # a single trigger starts without debounce latency
+    t0 = time.monotonic()
+    debouncer.trigger(f, 0.5, enqueue=False, speculative=lambda: cancels.append(1))
+    wait_with_timeout(lambda: len(calls) == 1)
+    assert calls[0] - t0 < 0.1
+
+    # a burst within the debounce window cancels and re-arms with debounce
+    time.sleep(0.05)
+    t1 = time.monotonic()
+    debouncer.trigger(f, 0.5, enqueue=False, speculative=lambda: cancels.append(1))
+    assert len(cancels) == 1
+    wait_with_timeout(lambda: len(calls) == 2)
+    assert calls[1] - t1 >= 0.5
+    assert debouncer.wait_idle(timeout=2.0)
+
+    # triggers outside the window of a speculative start follow the normal policy
+    debouncer.trigger(f, 0.1, enqueue=False, speculative=lambda: cancels.append(1))
+    wait_with_timeout(lambda: len(calls) == 3)
+    time.sleep(0.15)
+    debouncer.trigger(f, 0.1, enqueue=False, speculative=lambda: cancels.append(1))
+    assert debouncer.wait_idle(timeout=2.0)
+    assert len(calls) == 3
+    assert len(cancels) == 1
+
+
+def test_adaptive_debounce():
+    adaptive = AdaptiveDebounce(0.05, 1.0, initial=0.2)
+    assert adaptive.record(now=0.0) == 0.2
+
+    # a burst with gaps of up to 0.1 sec
+    adaptive.record(now=0.1)
+    assert adaptive.record(now=0.15) == pytest.approx(0.125)
+
+    # a burst with a larger gap increases the interval
+    adaptive.record(now=10.0)
+    assert adaptive.record(now=10.4) == pytest.approx(0.5)
+
+    # ... until it drops out of the history
+    for i in range(AdaptiveDebounce.HISTORY):
+        adaptive.record(now=20.0 + 10 * i)
+        adaptive.record(now=20.0 + 10 * i + 0.02)
+    assert adaptive.record(now=1000.0) == 0.05
+
+    # gaps beyond the upper bound separate bursts
+    assert adaptive.record(now=1001.5) == 0.05
+
+
+@pytest.mark.skipif(os.name == "nt", reason="requires process groups")
+def test_kill_process_group():
+    # The shell ignores SIGTERM and its child keeps running => requires SIGKILL
+    proc = subprocess.Popen(
+        "trap '' TERM; sleep 10 & wait",
+        shell=True,
+        **popen_isolated_kwargs()
+    )
+    time.sleep(0.2)
+    t1 = datetime.datetime.now()
+    kill_process_group(proc, grace_period=0.2)
+    assert proc.wait() != 0
+    assert (datetime.datetime.now() - t1).total_seconds() < 5.0
+
+
+def test_change_set():
+    changes = ChangeSet(["a.py", "b.py"])
+    changes.add("a.py")
+    changes.update(ChangeSet(["c.py", "b.py"]))
+    assert changes.paths == ["a.py", "b.py", "c.py"]
+    assert str(ChangeSet(str(i) for i in range(7))) == "0, 1, 2, 3, 4 (+2 more)"
+
+
+def test_command_environment(tmpdir):
+    for name in ["a.py", "with space.py"]:
+        tmpdir.join(name).write("")
+    # deleted files are not passed to commands
+    changes = ChangeSet(["a.py", "deleted.py", "with space.py"])
+    with CommandEnvironment(changes, str(tmpdir)) as command_env:
+        list_file = command_env.list_file
+        with open(list_file, "rb") as f:
+            assert f.read() == b"a.py\0with space.py\0"
+
+        env = command_env.env
+        assert env["WATCHCODE_CHANGED_FILES"] == "a.py\nwith space.py"
+        assert env["WATCHCODE_CHANGED_FILES_LIST"] == list_file
+
+        assert command_env.render("echo '{x}'") == "echo '{x}'"
+        if os.name != "nt":
+            assert command_env.render("flake8 {changed_files}") == "flake8 a.py 'with space.py'"
+            assert command_env.render("cat {changed_files_list}") == "cat " + list_file
+
+    assert not os.path.exists(list_file)
+
+
+def test_command_environment_large(tmpdir):
+    changes = ChangeSet("file_{}.py".format(i) for i in range(10000))
+    for path in changes:
+        tmpdir.join(path).write("")
+    with CommandEnvironment(changes, str(tmpdir)) as command_env:
+        assert "WATCHCODE_CHANGED_FILES" not in command_env.env
+
+
+CONFIG_PIPELINE = """\
+filesets:
+  default:
+    include:
+      - "*.py"
+    exclude:
+
+tasks:
+  codegen:
+    fileset: default
+    commands:
+      - "echo codegen >> ran.txt"
+  compile:
+    fileset: default
+    commands:
+      - "echo compile >> ran.txt && {compile_result}"
+    depends_on:
+      - codegen
+  test:
+    fileset: default
+    commands:
+      - "echo test >> ran.txt"
+    depends_on:
+      - compile
+
+default_task: test
+"""
+
+
+def test_io_handler_task_graph(tmpdir):
+    with tmpdir.as_cwd():
+        config_factory = ConfigFactory(".", Overrides())
+        finished = []
+
+        def write_config(compile_result):
+            with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+                f.write(CONFIG_PIPELINE.replace("{compile_result}", compile_result))
+            # done by the file watcher otherwise
+            config_factory.notify_changed()
+
+        def run(task_names):
+            del finished[:]
+            if os.path.exists("ran.txt"):
+                os.remove("ran.txt")
+            config = config_factory.load_config()
+            for task_name in task_names:
+                io_handler.trigger(LaunchInfo(
+                    old_config=config,
+                    task_name=task_name,
+                    trigger=ManualTrigger(),
+                    config_factory=config_factory,
+                    on_task_finished=finished.append,
+                ))
+            wait_with_timeout(lambda: len(finished) > 0)
+            if not os.path.exists("ran.txt"):
+                return []
+            with open("ran.txt") as f:
+                return f.read().split()
+
+        io_handler = IOHandler(".")
+        write_config("true")
+        assert run(["codegen", "compile", "test"]) == ["codegen", "compile", "test"]
+
+        # successful dependencies are reused
+        assert run(["compile"]) == ["compile", "test"]
+
+        # failures stop downstream tasks
+        write_config("false")
+        assert run(["compile"]) == ["compile"]
+        assert io_handler.results == {"codegen": True, "compile": False, "test": False}
+
+        # failed dependencies are re-run
+        write_config("true")
+        assert run(["test"]) == ["compile", "test"]
+
+
+def test_io_handler_parallel_command_group(capfd):
+    io_handler = IOHandler(".")
+    group = CommandGroup([
+        "echo a1; sleep 0.3; echo a2",
+        "echo b1; sleep 0.3; echo b2",
+        "echo c1; sleep 0.3; echo c2; false",
+    ], max_parallel=3)
+
+    t1 = time.time()
+    exec_infos = io_handler._run_command_group(group, "", False, None, lambda command: command)
+    runtime = time.time() - t1
+
+    assert runtime < 0.8
+    assert [e.retcode for e in exec_infos] == [0, 0, 1]
+    assert all(e.parallel and e.runtime >= 0.3 for e in exec_infos)
+
+    # output of each command is printed as a whole
+    out, _ = capfd.readouterr()
+    for name in ["a", "b", "c"]:
+        assert "{0}1\n{0}2\n".format(name) in out
+
+
+def test_io_handler_parallel_command_group_limit():
+    io_handler = IOHandler(".")
+    group = CommandGroup(["sleep 0.2"] * 4, max_parallel=2)
+
+    t1 = time.time()
+    io_handler._run_command_group(group, "", False, None, lambda command: command)
+    runtime = time.time() - t1
+    assert runtime >= 0.4
+
+
+CONFIG_CACHED = """\
+filesets:
+  default:
+    include:
+      - "*.py"
+    exclude:
+    exclude_gitignore: false
+
+tasks:
+  test:
+    fileset: default
+    commands:
+      # rendered differently on every run, must not prevent cache hits
+      - "echo run >> ran.txt && test -f {changed_files_list} && grep -q ok a.py"
+    cache_results: true
+
+default_task: test
+"""
+
+
+def test_io_handler_result_cache(tmpdir):
+    with tmpdir.as_cwd():
+        with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+            f.write(CONFIG_CACHED)
+        config_factory = ConfigFactory(".", Overrides())
+        io_handler = IOHandler(".")
+        finished = []
+
+        def run(content):
+            with open("a.py", "w") as f:
+                f.write(content)
+            del finished[:]
+            io_handler.trigger(LaunchInfo(
+                old_config=config_factory.load_config(),
+                task_name="test",
+                trigger=ManualTrigger(),
+                config_factory=config_factory,
+                on_task_finished=finished.append,
+            ))
+            wait_with_timeout(lambda: len(finished) > 0)
+            with open("ran.txt") as f:
+                return len(f.read().split())
+
+        assert run("ok 1") == 1
+        assert run("ok 2") == 2
+        # reverting to the inputs of a successful run doesn't run anything
+        assert run("ok 1") == 2
+        # failed runs are not cached
+        assert run("fail") == 3
+        assert run("fail") == 4
+        assert os.path.isdir(os.path.join(".watchcode", "cache"))
+
+
+def test_io_handler_task_error(tmpdir, monkeypatch, capfd):
+    def raise_error(*args, **kwargs):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(IOHandler, "_run_single_task", raise_error)
+
+    with tmpdir.as_cwd():
+        with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+            f.write(CONFIG_CACHED)
+        config_factory = ConfigFactory(".", Overrides())
+        io_handler = IOHandler(".")
+        finished = []
+        io_handler.trigger(LaunchInfo(
+            old_config=config_factory.load_config(),
+            task_name="test",
+            trigger=ManualTrigger(),
+            config_factory=config_factory,
+            on_task_finished=finished.append,
+        ))
+        wait_with_timeout(lambda: len(finished) > 0)
+        assert io_handler.results == {"test": False}
+        assert "Task failed" in capfd.readouterr().out
+
+
+def test_io_handler_stops_runners():
+    stopped = []
+
+    class FakeRunner(object):
+        def __init__(self, name):
+            self.name = name
+
+        def stop(self):
+            stopped.append(self.name)
+
+    class FakeConfig(object):
+        active_tasks = {"kept": None}
+
+    io_handler = IOHandler(".")
+    io_handler.runners = {
+        "kept": (("shell-session", ()), FakeRunner("kept")),
+        "removed": (("shell-session", ()), FakeRunner("removed")),
+    }
+    # tasks removed by a config reload
+    io_handler._prune_runners(FakeConfig())
+    assert stopped == ["removed"]
+    io_handler.stop()
+    assert stopped == ["removed", "kept"]
+    assert io_handler.runners == {}
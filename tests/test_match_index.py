@@ -0,0 +1,89 @@
+import os
+import subprocess
+
+from watchcode import gitignore
+from watchcode.config import FileSet
+from watchcode.match_index import MatchIndex
+from watchcode.trigger import FileEvent
+
+
+def make_fileset(include, exclude=None, exclude_gitignore=True):
+    return FileSet.validate({
+        "include": include,
+        "exclude": exclude,
+        "match_mode": "gitlike",
+        "exclude_gitignore": exclude_gitignore,
+    })
+
+
+def event(path, type="modified", is_dir=False):
+    return FileEvent(path.replace("/", os.sep), type, is_dir)
+
+
+def write_file(path, content=""):
+    with open(path.replace("/", os.sep), "w") as f:
+        f.write(content)
+
+
+def test_match_index_populate(tmpdir):
+    with tmpdir.as_cwd():
+        subprocess.check_call(["git", "init", "--quiet"])
+        os.makedirs("src")
+        os.makedirs("build")
+        write_file(".gitignore", "build/\n")
+        write_file("src/a.py")
+        write_file("src/b.txt")
+        write_file("build/c.py")
+
+        index = MatchIndex(make_fileset(["*.py"]))
+        assert index.populate(".")
+
+        assert index.key("./src/a.py", False) in index._decisions
+        assert index.key("./src/b.txt", False) in index._decisions
+        # ignored directories are not descended into
+        assert index.key("./build/c.py", False) not in index._decisions
+
+        assert index.does_match(event("./src/a.py"))
+        assert not index.does_match(event("./src/b.txt"))
+        assert not index.does_match(event("./build/c.py"))
+
+
+def test_match_index_incremental(tmpdir):
+    with tmpdir.as_cwd():
+        index = MatchIndex(make_fileset(["*.py"], exclude_gitignore=False))
+        assert index.does_match(event("./new.py", "created"))
+        assert index.key("./new.py", False) in index._decisions
+        assert index.does_match(event("./new.py", "deleted"))
+        assert index.key("./new.py", False) not in index._decisions
+
+
+def test_match_index_invalidation(tmpdir):
+    with tmpdir.as_cwd():
+        subprocess.check_call(["git", "init", "--quiet"])
+        write_file(".gitignore", "")
+        index = MatchIndex(make_fileset(["*.py"]))
+        assert index.does_match(event("./a.py"))
+
+        # an identical fileset keeps the index
+        assert not index.set_fileset(make_fileset(["*.py"]))
+        assert len(index) == 1
+
+        # a different fileset invalidates
+        assert index.set_fileset(make_fileset(["*.txt"]))
+        assert len(index) == 0
+        assert not index.does_match(event("./a.py"))
+
+        # gitignore changes invalidate via notification
+        index.set_fileset(make_fileset(["*.py"]))
+        assert index.does_match(event("./a.py"))
+        write_file(".gitignore", "*.py\n")
+        assert gitignore.notify_changed("./.gitignore")
+        assert not index.does_match(event("./a.py"))
+
+
+def test_match_index_bounded():
+    index = MatchIndex(make_fileset(["*.py"], exclude_gitignore=False), max_entries=10)
+    for i in range(100):
+        index.does_match(event("./file_{}.py".format(i)))
+    assert len(index) == 10
+    assert index.key("./file_99.py", False) in index._decisions
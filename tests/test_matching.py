@@ -1,8 +1,8 @@
-from __future__ import division, print_function
-
 import os
 from watchcode.trigger import FileEvent
 from watchcode.matching import matcher_fnmatch, matcher_re, matcher_gitlike, is_gitignore
+from watchcode.matching import FileSetMatcher, AVAILABLE_MATCH_MODES, accepts_event
+from watchcode.config import FileSet
 
 
 def fix_path(path):
@@ -161,6 +161,76 @@ def test_gitlike(tmpdir):
     verify_gitignore_rules(matches, differs)
 
 
+def test_pattern_sets_combined():
+    """
+    Combined pattern sets must behave like checking each pattern individually,
+    the expected results are those of the individual (reference) matchers.
+    """
+    patterns = {
+        "gitlike": [
+            "*.log", "/*.py", "/sub/*.log", "cache/", "/cache/", "foo", "foo/bar",
+            "foo/bar/", "*/", "a*/", "*/*.log", ".*", "[ab]?.txt", "*.tar.gz", "b/*",
+        ],
+        "fnmatch": ["*.py", "*.log", "test_*", "[!a]*.txt"],
+        "re": [r".*\.py$", r"sub", r"(a|b)\.txt"],
+    }
+    paths = [
+        ("test.log", False), ("sub/.hidden.log", False), ("test.py", False),
+        ("sub/test.py", False), ("cache", True), ("cache/x", False),
+        ("sub/cache/x", False), ("foo/bar/content", False), ("x", True),
+        ("sub/a", False), ("a", True), ("b/a/file", False), (".hidden", False),
+        ("ab.txt", False), ("sub/bc.txt", False), ("a.txt", False),
+        ("x.tar.gz", False), ("x.tar.gz", True), (".git/lock", False),
+        ("b", True), ("b", False), ("b/c", False),
+    ]
+    expected_matches = {
+        "gitlike": [
+            "test.log", "sub/.hidden.log", "test.py", "sub/test.py", "cache/", "cache/x",
+            "sub/cache/x", "foo/bar/content", "x/", "sub/a", "a/", "b/a/file", ".hidden",
+            "ab.txt", "sub/bc.txt", "x.tar.gz", "x.tar.gz/", ".git/lock", "b/", "b/c",
+        ],
+        "fnmatch": ["test.log", "sub/.hidden.log", "test.py", "sub/test.py", "sub/bc.txt"],
+        "re": [
+            "sub/.hidden.log", "test.py", "sub/test.py", "sub/cache/x", "sub/a",
+            "ab.txt", "sub/bc.txt", "a.txt",
+        ],
+    }
+    for mode, mode_patterns in patterns.items():
+        pattern_set = AVAILABLE_MATCH_MODES[mode](mode_patterns)
+        matches = [
+            path + ("/" if is_dir else "") for path, is_dir in paths
+            if pattern_set(FileEvent(fix_path("./" + path), "modified", is_dir))
+        ]
+        assert matches == expected_matches[mode], "mode '{}' mismatch".format(mode)
+
+
+def test_gitlike_wildcard_components_are_not_empty():
+    def matches(pattern, path, is_dir):
+        event = FileEvent(fix_path("./" + path), "modified", is_dir)
+        return AVAILABLE_MATCH_MODES["gitlike"]([pattern])(event)
+
+    for pattern in ["b/*", "/b/*", "b/*/", "b/*/*"]:
+        assert not matches(pattern, "b", True), pattern
+        assert matches(pattern, "b/c/d", False), pattern
+    assert matches("b/*", "b/c", False)
+    assert not matches("b/*/", "b/c", False)
+    assert matches("b/*/", "b/c", True)
+    assert not matches("b/*/*", "b/c", True)
+
+
+def test_fileset_matcher():
+    matcher = FileSetMatcher(["*.py", "*.txt"], ["/build/", "test_*"], AVAILABLE_MATCH_MODES["gitlike"])
+
+    def event(path):
+        return FileEvent(fix_path(path), "modified", False)
+
+    assert matcher(event("./src/main.py"))
+    assert matcher(event("./notes.txt"))
+    assert not matcher(event("./src/main.c"))
+    assert not matcher(event("./build/main.py"))
+    assert not matcher(event("./src/test_main.py"))
+
+
 def test_is_gitignore(tmpdir):
 
     def set_gitignore(pattern):
@@ -186,3 +256,17 @@ def test_is_gitignore(tmpdir):
     with tmpdir.as_cwd():
         os.system("git init --quiet")
         verify_gitignore_rules(matches, differs)
+
+
+def test_accepts_event():
+    fileset = FileSet.validate({
+        "include": ["*"],
+        "exclude": None,
+        "events": ["modified"],
+        "directories": False,
+    })
+    assert accepts_event(fileset, FileEvent("./a", "modified", False))
+    assert not accepts_event(fileset, FileEvent("./a", "created", False))
+    assert not accepts_event(fileset, FileEvent("./a", "modified", True))
+    # scans are never filtered by type
+    assert accepts_event(fileset, FileEvent("./a", "scan", False))
@@ -0,0 +1,102 @@
+import json
+import os
+import socket
+import threading
+import time
+
+from watchcode.notifications import Notification, NotificationDispatcher, WebhookBackend
+
+
+def wait_with_timeout(predicate, timeout=5.0):
+    t_start = time.time()
+    while not predicate():
+        assert time.time() - t_start < timeout, "timeout"
+        time.sleep(0.01)
+
+
+class SlowBackend(object):
+    def __init__(self):
+        self.release = threading.Event()
+        self.delivered = []
+
+    def send(self, notification):
+        self.release.wait()
+        self.delivered.append(notification.messages)
+
+
+def test_dispatcher_does_not_block_and_coalesces():
+    backend = SlowBackend()
+    dispatcher = NotificationDispatcher()
+
+    t_start = time.time()
+    dispatcher.notify(Notification(True, ["1"], [backend]))
+    # wait until the first notification is being delivered
+    wait_with_timeout(lambda: len(dispatcher.queue) == 0)
+    for i in range(2, 5):
+        dispatcher.notify(Notification(i % 2 == 0, [str(i)], [backend]))
+    assert time.time() - t_start < 1.0
+
+    backend.release.set()
+    wait_with_timeout(lambda: len(backend.delivered) == 2)
+    time.sleep(0.05)
+    assert backend.delivered == [["1"], ["4"]]
+
+
+def test_dispatcher_bounded_queue():
+    dispatcher = NotificationDispatcher(max_size=2)
+    # no thread has been started yet, but the queue must not grow anyway
+    dispatcher.thread = threading.Thread()
+    for i in range(5):
+        dispatcher.notify(Notification(True, [str(i)], [SlowBackend()], source=i))
+    assert [n.messages for n in dispatcher.queue.values()] == [["3"], ["4"]]
+
+
+def test_dispatcher_coalesces_per_source():
+    backend = SlowBackend()
+    dispatcher = NotificationDispatcher()
+
+    dispatcher.notify(Notification(True, ["a1"], [backend], source="a"))
+    wait_with_timeout(lambda: len(dispatcher.queue) == 0)
+    # a failure of one source must not be replaced by the success of another
+    dispatcher.notify(Notification(False, ["a2"], [backend], source="a"))
+    dispatcher.notify(Notification(True, ["b1"], [backend], source="b"))
+    dispatcher.notify(Notification(False, ["a3"], [backend], source="a"))
+
+    backend.release.set()
+    wait_with_timeout(lambda: len(backend.delivered) == 3)
+    time.sleep(0.05)
+    assert backend.delivered == [["a1"], ["b1"], ["a3"]]
+
+
+def test_dispatcher_stop():
+    backend = SlowBackend()
+    backend.release.set()
+    dispatcher = NotificationDispatcher()
+    dispatcher.notify(Notification(True, ["1"], [backend]))
+    thread = dispatcher.thread
+
+    # pending notifications are delivered, later ones are dropped
+    dispatcher.stop()
+    assert not thread.is_alive()
+    assert backend.delivered == [["1"]]
+    dispatcher.notify(Notification(True, ["2"], [backend]))
+    assert len(dispatcher.queue) == 0
+
+
+def test_webhook_unix_socket(tmpdir):
+    path = str(tmpdir.join("notify.sock"))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    try:
+        WebhookBackend("unix:" + path).send(Notification(False, ["failed"], []))
+        conn, _ = server.accept()
+        data = conn.makefile("rb").readline()
+        conn.close()
+    finally:
+        server.close()
+        os.remove(path)
+    payload = json.loads(data.decode("utf-8"))
+    assert payload["success"] is False
+    assert payload["title"] == "FAILURE"
+    assert payload["messages"] == ["failed"]
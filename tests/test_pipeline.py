@@ -0,0 +1,115 @@
+import threading
+
+from watchdog.events import FileModifiedEvent, FileMovedEvent
+
+from watchcode.pipeline import EventPipeline, coalesce_events, split_event
+from watchcode.pipeline import is_editor_temp_file, normalize_editor_saves
+from watchcode.trigger import FileEvent
+
+
+def test_split_event():
+    events = split_event(FileMovedEvent("a", "b"))
+    assert [(e.path, e.type) for e in events] == [("a", "moved_from"), ("b", "moved_to")]
+    events = split_event(FileModifiedEvent("a"))
+    assert [(e.path, e.type) for e in events] == [("a", "modified")]
+
+
+def test_coalesce_events():
+
+    def coalesce(events):
+        events = [FileEvent(path, type, False) for path, type in events]
+        return [(e.path, e.type) for e in coalesce_events(events)]
+
+    assert coalesce([
+        ("a", "modified"), ("a", "modified"), ("a", "closed"),
+    ]) == [("a", "modified")]
+
+    assert coalesce([
+        ("a", "created"), ("a", "modified"), ("b", "modified"), ("a", "closed"),
+    ]) == [("a", "created"), ("b", "modified")]
+
+    assert coalesce([
+        ("a", "deleted"), ("a", "created"), ("b", "opened"), ("b", "closed_no_write"),
+    ]) == [("a", "deleted"), ("a", "created"), ("b", "opened"), ("b", "closed_no_write")]
+
+
+def test_is_editor_temp_file():
+    for path in ["4913", "5036", ".a.py.swp", ".a.py.swx", "a.py~", "a.py___jb_tmp___",
+                 "a.py___jb_old___", ".goutputstream-ABC123", "#a.py#", ".#a.py",
+                 "a.py.kate-swp"]:
+        assert is_editor_temp_file(path), path
+    for path in ["a.py", "2024", ".swp", "a.swp", "~a"]:
+        assert not is_editor_temp_file(path), path
+
+
+def test_normalize_editor_saves():
+
+    def normalize(events):
+        events = [FileEvent(path, type, False) for path, type in events]
+        events = coalesce_events(normalize_editor_saves(events))
+        return [(e.path, e.type) for e in events]
+
+    # vim with backup
+    assert normalize([
+        ("4913", "created"), ("4913", "deleted"),
+        ("a.py", "moved_from"), ("a.py~", "moved_to"),
+        ("a.py", "created"), ("a.py", "modified"),
+        ("a.py~", "deleted"), (".a.py.swp", "modified"),
+    ]) == [("a.py", "modified")]
+
+    # JetBrains safe write
+    assert normalize([
+        ("a.py___jb_tmp___", "created"), ("a.py___jb_tmp___", "modified"),
+        ("a.py", "moved_from"), ("a.py___jb_old___", "moved_to"),
+        ("a.py___jb_tmp___", "moved_from"), ("a.py", "moved_to"),
+        ("a.py___jb_old___", "deleted"),
+    ]) == [("a.py", "modified")]
+
+    # atomic replace
+    assert normalize([
+        (".goutputstream-X1", "created"), (".goutputstream-X1", "modified"),
+        (".goutputstream-X1", "moved_from"), ("a.py", "moved_to"),
+    ]) == [("a.py", "modified")]
+
+    # regular events are untouched
+    assert normalize([
+        ("a.py", "moved_from"), ("b.py", "moved_to"), ("c.py", "created"),
+    ]) == [("a.py", "moved_from"), ("b.py", "moved_to"), ("c.py", "created")]
+
+
+def test_event_pipeline():
+    batches = []
+    done = threading.Event()
+
+    def on_events(events):
+        batches.append([(e.path, e.type) for e in events])
+        done.set()
+
+    pipeline = EventPipeline(on_events, lambda: None, coalesce_window=0.2)
+    pipeline.start()
+    pipeline.put(FileModifiedEvent("a"))
+    pipeline.put(FileModifiedEvent("a"))
+    pipeline.put(FileMovedEvent("b", "c"))
+    assert done.wait(5.0)
+    pipeline.stop()
+    assert batches == [[("a", "modified"), ("b", "moved_from"), ("c", "moved_to")]]
+
+
+def test_event_pipeline_overflow():
+    overflows = []
+    batches = []
+    done = threading.Event()
+
+    def on_overflow():
+        overflows.append(True)
+        done.set()
+
+    pipeline = EventPipeline(batches.append, on_overflow, max_size=3)
+    # consumer not yet started => queue overflows
+    for i in range(10):
+        pipeline.put(FileModifiedEvent(str(i)))
+    pipeline.start()
+    assert done.wait(5.0)
+    pipeline.stop()
+    assert overflows == [True]
+    assert batches == []
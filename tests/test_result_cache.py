@@ -0,0 +1,54 @@
+import os
+
+from watchcode.config import FileSet
+from watchcode.result_cache import ResultCache, list_fileset_files
+
+
+def write_file(path, content):
+    dirname = os.path.dirname(path)
+    if dirname != "" and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def make_fileset():
+    return FileSet.validate({
+        "include": ["*.py"],
+        "exclude": None,
+        "match_mode": "gitlike",
+        "exclude_gitignore": False,
+    })
+
+
+def test_list_fileset_files(tmpdir):
+    with tmpdir.as_cwd():
+        write_file(os.path.join("src", "a.py"), "")
+        write_file(os.path.join("src", "b.txt"), "")
+        write_file(os.path.join(".watchcode", "cache", "x.py"), "")
+        assert list_fileset_files(".", make_fileset()) == [os.path.join(".", "src", "a.py")]
+
+
+def test_result_cache(tmpdir):
+    with tmpdir.as_cwd():
+        fileset = make_fileset()
+        write_file("a.py", "version 1")
+
+        cache = ResultCache(".")
+        key1 = cache.input_key("test", fileset, ["py.test"])
+        assert cache.lookup("test", key1) is None
+        cache.store("test", key1, [("py.test", 1.5, 0, False)])
+        assert cache.lookup("test", key1) == [("py.test", 1.5, 0, False)]
+
+        # different inputs => different keys
+        assert cache.input_key("test", fileset, ["py.test -x"]) != key1
+        assert cache.input_key("other", fileset, ["py.test"]) != key1
+        write_file("a.py", "version 2")
+        key2 = cache.input_key("test", fileset, ["py.test"])
+        assert key2 != key1
+        assert cache.lookup("test", key2) is None
+
+        # reverting restores the key, also for a new cache instance
+        write_file("a.py", "version 1")
+        assert ResultCache(".").input_key("test", fileset, ["py.test"]) == key1
+        assert ResultCache(".").lookup("test", key1) == [("py.test", 1.5, 0, False)]
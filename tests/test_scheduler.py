@@ -0,0 +1,89 @@
+import threading
+import time
+
+from watchcode.scheduler import TaskGraph, run_graph, SUCCESS, FAILURE, SKIPPED
+
+
+def make_graph():
+    # codegen -> compile -> test, and an independent lint
+    return TaskGraph({
+        "codegen": [],
+        "compile": ["codegen"],
+        "test": ["compile"],
+        "docs": ["codegen"],
+        "lint": [],
+    })
+
+
+def test_task_graph():
+    graph = make_graph()
+    assert graph.upstream(["test"]) == {"test", "compile", "codegen"}
+    assert graph.downstream(["codegen"]) == {"codegen", "compile", "test", "docs"}
+    assert graph.component("test") == frozenset(["codegen", "compile", "test", "docs"])
+    assert graph.component("lint") == frozenset(["lint"])
+
+    order = graph.topological_order(["test", "docs", "codegen", "compile"])
+    assert order.index("codegen") < order.index("compile") < order.index("test")
+    assert order.index("codegen") < order.index("docs")
+
+
+def test_task_graph_validation():
+    assert make_graph().find_cycle() is None
+    assert make_graph().undefined_dependencies() == []
+
+    graph = TaskGraph({"a": ["b"], "b": ["c"], "c": ["a"], "d": ["x"]})
+    assert graph.find_cycle() == ["a", "b", "c", "a"]
+    assert graph.undefined_dependencies() == [("d", "x")]
+
+
+def test_run_graph_order_and_parallelism():
+    graph = make_graph()
+    lock = threading.Lock()
+    started = []
+    finished = []
+
+    def run_task(name):
+        with lock:
+            started.append(name)
+        time.sleep(0.1)
+        with lock:
+            finished.append(name)
+        return SUCCESS
+
+    t1 = time.time()
+    results = run_graph(graph, ["codegen", "compile", "test", "docs", "lint"], run_task, 4)
+    runtime = time.time() - t1
+
+    assert all(result == SUCCESS for result in results.values())
+    assert finished.index("codegen") < started.index("compile")
+    assert finished.index("compile") < started.index("test")
+    # lint runs next to codegen, docs next to compile
+    assert runtime < 0.45
+
+
+def test_run_graph_skips_downstream_of_failure():
+    graph = make_graph()
+
+    def run_task(name):
+        return FAILURE if name == "compile" else SUCCESS
+
+    results = run_graph(graph, ["codegen", "compile", "test", "docs"], run_task, 2)
+    assert results == {
+        "codegen": SUCCESS,
+        "compile": FAILURE,
+        "test": SKIPPED,
+        "docs": SUCCESS,
+    }
+
+
+def test_run_graph_assumes_external_dependencies_up_to_date():
+    graph = make_graph()
+    ran = []
+
+    def run_task(name):
+        ran.append(name)
+        return SUCCESS
+
+    results = run_graph(graph, ["test"], run_task, 2)
+    assert ran == ["test"]
+    assert results == {"test": SUCCESS}
@@ -0,0 +1,78 @@
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+import watchcode
+from watchcode.io_handler import kill_process_group
+from watchcode.shell_session import ShellSession
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt" or shutil.which("bash") is None, reason="requires bash"
+)
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def test_shell_session(tmpdir):
+    with tmpdir.as_cwd():
+        session = ShellSession(".", ["export SETUP_VAR=$$", "echo x >> setup_runs.txt"])
+        env = dict(os.environ, TEST_VAR="a")
+        started = []
+        try:
+            assert session.run("echo $SETUP_VAR $TEST_VAR > out1.txt", env, started.append) == 0
+            assert session.run("echo $SETUP_VAR $TEST_VAR > out2.txt; exit 3", env, started.append) == 3
+            assert started[1].poll() == 3
+
+            # setup ran once, its environment persists, variables of `env` are updated
+            shell_pid = read_file("out1.txt").split()[0]
+            assert read_file("out1.txt") == "{} a".format(shell_pid)
+            assert read_file("out2.txt") == "{} a".format(shell_pid)
+            assert read_file("setup_runs.txt") == "x"
+            del env["TEST_VAR"]
+            assert session.run("echo $SETUP_VAR ${TEST_VAR-unset} > out3.txt", env, started.append) == 0
+            assert read_file("out3.txt") == "{} unset".format(shell_pid)
+
+            # cancelling a command keeps the session
+            def on_started(job):
+                started.append(job)
+                threading.Thread(target=kill_process_group, args=(job, 3.0)).start()
+            assert session.run("sleep 10", env, on_started) != 0
+            assert session.run("echo $SETUP_VAR > out4.txt", env, started.append) == 0
+            assert read_file("out4.txt") == shell_pid
+
+            # a dead shell is restarted including the setup
+            session.proc.kill()
+            session.proc.wait()
+            assert session.run("echo $SETUP_VAR > out5.txt", env, started.append) == 0
+            assert read_file("out5.txt") != shell_pid
+            assert read_file("setup_runs.txt") == "x\nx"
+        finally:
+            session.stop()
+
+
+def test_watcher_stops_shell_session(tmpdir):
+    config = {
+        "filesets": {"all": {"include": ["*"], "exclude": [], "match_mode": "gitlike"}},
+        "tasks": {"test": {
+            "fileset": "all", "commands": ["true"], "clear_screen": False, "runner": "shell-session",
+        }},
+        "default_task": "test",
+        "log": False,
+    }
+    with tmpdir.as_cwd():
+        with watchcode.Watcher(".", config=config) as watcher:
+            assert watcher.wait_idle(timeout=10.0)
+            io_handler, = watcher.event_handler.io_handlers.values()
+            _, session = io_handler.runners["test"]
+            proc = session.proc
+            assert proc.poll() is None
+        t_start = time.time()
+        while proc.poll() is None:
+            assert time.time() - t_start < 10.0, "timeout"
+            time.sleep(0.01)
@@ -0,0 +1,57 @@
+import os
+
+from watchcode.config import FileSet
+from watchcode.snapshot import Snapshot
+
+
+def write_file(path, content=""):
+    dirname = os.path.dirname(path)
+    if dirname != "" and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def make_fileset():
+    return FileSet.validate({
+        "include": ["*.py"],
+        "exclude": None,
+        "match_mode": "gitlike",
+        "exclude_gitignore": False,
+    })
+
+
+def test_snapshot(tmpdir):
+    with tmpdir.as_cwd():
+        write_file(".watchcode.yaml")
+        write_file(".watchcode.log")
+        write_file(os.path.join("src", "a.py"), "a")
+        write_file(os.path.join("src", "b.py"), "b")
+        write_file(os.path.join("src", "c.txt"))
+        write_file(os.path.join(".watchcode", "cache", "d.py"))
+
+        snapshot = Snapshot.take(".", [make_fileset()], {"test": True})
+        assert sorted(snapshot.files.keys()) == [
+            ".watchcode.yaml", os.path.join("src", "a.py"), os.path.join("src", "b.py"),
+        ]
+
+        snapshot.save(".")
+        loaded = Snapshot.load(".")
+        assert loaded.files == snapshot.files
+        assert loaded.results == {"test": True}
+        assert loaded.diff(snapshot) == []
+
+        write_file(os.path.join("src", "a.py"), "changed")
+        os.remove(os.path.join("src", "b.py"))
+        write_file(os.path.join("src", "e.py"))
+        write_file(os.path.join("src", "c.txt"), "not matched")
+        assert loaded.diff(Snapshot.take(".", [make_fileset()], {})) == [
+            os.path.join("src", "a.py"), os.path.join("src", "b.py"), os.path.join("src", "e.py"),
+        ]
+
+
+def test_snapshot_load_invalid(tmpdir):
+    with tmpdir.as_cwd():
+        assert Snapshot.load(".") is None
+        write_file(os.path.join(".watchcode", "snapshot.json"), "{")
+        assert Snapshot.load(".") is None
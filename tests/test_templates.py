@@ -1,5 +1,3 @@
-from __future__ import division, print_function
-
 import watchcode.templates as templates
 import watchcode.config as config
 
@@ -1,5 +1,3 @@
-from __future__ import division, print_function
-
 import os
 from watchcode.trigger import FileEvent
 
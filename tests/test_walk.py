@@ -0,0 +1,25 @@
+import os
+from watchcode.walk import walk_tree
+
+
+def test_walk_tree(tmpdir):
+    with tmpdir.as_cwd():
+        for d in ["a/b/c", "a/skip/deeper", "d"]:
+            os.makedirs(d.replace("/", os.sep))
+        for f in ["x.txt", "a/y.txt", "a/b/c/z.txt", "a/skip/deeper/w.txt"]:
+            with open(f.replace("/", os.sep), "w") as fh:
+                fh.write("")
+
+        def paths(prune=None):
+            return sorted(
+                os.path.relpath(entry.path, ".").replace(os.sep, "/")
+                for entry in walk_tree(".", prune=prune, max_workers=4)
+            )
+
+        assert paths() == [
+            "a", "a/b", "a/b/c", "a/b/c/z.txt", "a/skip", "a/skip/deeper",
+            "a/skip/deeper/w.txt", "a/y.txt", "d", "x.txt",
+        ]
+        assert paths(prune=lambda entry: entry.name == "skip") == [
+            "a", "a/b", "a/b/c", "a/b/c/z.txt", "a/skip", "a/y.txt", "d", "x.txt",
+        ]
@@ -0,0 +1,106 @@
+import os
+import subprocess
+
+from watchcode.config import FileSet
+from watchcode.trigger import FileEvent
+from watchcode.watch_manager import compute_watch_plan, WatchManager
+
+
+def p(path):
+    return path.replace("/", os.sep)
+
+
+def make_fileset(exclude=None):
+    return FileSet.validate({
+        "include": ["*.py"],
+        "exclude": exclude,
+        "match_mode": "gitlike",
+        "exclude_gitignore": True,
+    })
+
+
+def make_tree():
+    subprocess.check_call(["git", "init", "--quiet"])
+    if not os.path.exists(p(".git/info")):
+        os.makedirs(p(".git/info"))
+    for d in ["src/pkg", "src/node_modules/dep", "docs", "build/out"]:
+        os.makedirs(p(d))
+    with open(".gitignore", "w") as f:
+        f.write("node_modules/\n")
+
+
+class FakeObserver(object):
+    def __init__(self):
+        self.watches = set()
+
+    def schedule(self, event_handler, path, recursive):
+        watch = (path, recursive)
+        self.watches.add(watch)
+        return watch
+
+    def unschedule(self, watch):
+        self.watches.remove(watch)
+
+
+def test_compute_watch_plan(tmpdir):
+    with tmpdir.as_cwd():
+        make_tree()
+        plan = compute_watch_plan(".", [make_fileset(exclude=["/build/"])])
+        git_info = os.path.abspath(os.path.join(".git", "info"))
+        git_dir = os.path.abspath(".git")
+        assert plan == {
+            (".", False),
+            (p("./src"), False),
+            (p("./src/pkg"), True),
+            (p("./docs"), True),
+            (git_info, False),
+            (git_dir, False),
+        }
+
+        # only `.git` left to prune => recursive watches on top level directories
+        os.rmdir(p("src/node_modules/dep"))
+        os.rmdir(p("src/node_modules"))
+        plan = compute_watch_plan(".", [make_fileset()])
+        assert plan == {
+            (".", False),
+            (p("./src"), True),
+            (p("./docs"), True),
+            (p("./build"), True),
+            (git_info, False),
+            (git_dir, False),
+        }
+
+
+def test_watch_manager(tmpdir):
+    with tmpdir.as_cwd():
+        make_tree()
+        observer = FakeObserver()
+        watch_manager = WatchManager(observer, None, ".")
+        watch_manager.update([make_fileset(exclude=["/build/"])])
+        assert (p("./src"), False) in observer.watches
+        assert (p("./build"), False) not in observer.watches
+
+        # new directories below partially watched directories get watched
+        os.makedirs(p("src/new"))
+        watch_manager.on_event(FileEvent(p("./src/new"), "created", True))
+        assert (p("./src/new"), True) in observer.watches
+        watch_manager.on_event(FileEvent(p("./src/new"), "deleted", True))
+        assert (p("./src/new"), True) not in observer.watches
+
+        # changing the fileset changes the watches
+        watch_manager.update([make_fileset()])
+        assert (p("./build"), True) in observer.watches
+        assert observer.watches == set(watch_manager.watches.keys())
+
+
+def test_compute_watch_plan_multiple_filesets(tmpdir):
+    with tmpdir.as_cwd():
+        make_tree()
+        # a directory is only pruned if no fileset can match in it
+        plan = compute_watch_plan(".", [
+            make_fileset(exclude=["/build/"]),
+            make_fileset(exclude=["/docs/"]),
+        ])
+        assert (p("./build"), True) in plan
+        assert (p("./docs"), True) in plan
+        assert (p("./src/node_modules"), True) not in plan
@@ -1,2 +1,372 @@
-from __future__ import division, print_function
+import os
+import threading
+import time
 
+import pytest
+
+import watchcode
+from watchcode.config import ConfigFactory, Overrides, DEFAULT_CONFIG_FILENAME, INTERNAL_DIRNAME
+from watchcode.config import load_config
+from watchcode.io_handler import IOHandler
+from watchcode.snapshot import Snapshot
+from watchcode.trigger import FileEvent
+from watchcode.watchcode import EventHandler
+
+
+CONFIG_MULTIPLE_TASKS = """\
+filesets:
+  python:
+    include:
+      - "*.py"
+    exclude:
+    match_mode: "gitlike"
+    exclude_gitignore: false
+  css:
+    include:
+      - "*.css"
+    exclude:
+    match_mode: "gitlike"
+    exclude_gitignore: false
+
+tasks:
+  test:
+    fileset: python
+    commands:
+      - "py.test"
+  lint:
+    fileset: python
+    commands:
+      - "flake8"
+  css:
+    fileset: css
+    commands:
+      - "sass"
+
+default_task: test
+all_tasks: true
+"""
+
+
+def test_events_are_routed_to_matching_tasks(tmpdir, monkeypatch):
+    triggered = []
+    monkeypatch.setattr(
+        IOHandler, "trigger",
+        lambda self, launch_info: triggered.append(launch_info.task_name),
+    )
+
+    with tmpdir.as_cwd():
+        with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+            f.write(CONFIG_MULTIPLE_TASKS)
+        event_handler = EventHandler(".", ConfigFactory(".", Overrides()))
+        try:
+            assert sorted(event_handler.match_indexes.keys()) == ["css", "python"]
+
+            event_handler.on_any_single_event(FileEvent(os.path.join(".", "a.py"), "modified", False))
+            assert triggered == ["lint", "test"]
+
+            del triggered[:]
+            event_handler.on_any_single_event(FileEvent(os.path.join(".", "a.css"), "modified", False))
+            assert triggered == ["css"]
+
+            del triggered[:]
+            event_handler.on_manual_trigger()
+            assert triggered == ["css", "lint", "test"]
+            assert len(event_handler.io_handlers) == 3
+        finally:
+            event_handler.pipeline.stop()
+
+
+def test_io_handlers_of_removed_task_groups_are_stopped(tmpdir, monkeypatch):
+    triggered = []
+    monkeypatch.setattr(
+        IOHandler, "trigger",
+        lambda self, launch_info: triggered.append(launch_info.task_name),
+    )
+
+    with tmpdir.as_cwd():
+        with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+            f.write(CONFIG_MULTIPLE_TASKS)
+        event_handler = EventHandler(".", ConfigFactory(".", Overrides()))
+        try:
+            event_handler.on_manual_trigger()
+            old_io_handlers = dict(event_handler.io_handlers)
+            assert len(old_io_handlers) == 3
+            old_io_handlers[frozenset(["lint"])].pending_tasks.add("lint")
+
+            # lint and test become one group
+            with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+                f.write(CONFIG_MULTIPLE_TASKS.replace(
+                    '      - "py.test"\n', '      - "py.test"\n    depends_on:\n      - lint\n',
+                ))
+            del triggered[:]
+            event_handler.on_task_finished(load_config(".", Overrides()))
+
+            assert sorted(sorted(c) for c in event_handler.io_handlers) == [["css"], ["lint", "test"]]
+            assert event_handler.io_handlers[frozenset(["css"])] is old_io_handlers[frozenset(["css"])]
+            assert old_io_handlers[frozenset(["lint"])].debouncer.stopped
+            assert old_io_handlers[frozenset(["test"])].debouncer.stopped
+            # pending tasks are triggered in their new group
+            assert triggered == ["lint"]
+        finally:
+            event_handler.stop()
+
+
+def test_unchanged_content_is_dropped(tmpdir, monkeypatch):
+    triggered = []
+    monkeypatch.setattr(
+        IOHandler, "trigger",
+        lambda self, launch_info: triggered.append(launch_info.task_name),
+    )
+
+    with tmpdir.as_cwd():
+        config = CONFIG_MULTIPLE_TASKS.replace(
+            '      - "*.py"\n',
+            '      - "*.py"\n    compare_content: true\n',
+        )
+        with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+            f.write(config)
+        with open("a.py", "w") as f:
+            f.write("print(1)\n")
+
+        event_handler = EventHandler(".", ConfigFactory(".", Overrides()))
+        try:
+            event = FileEvent(os.path.join(".", "a.py"), "modified", False)
+            event_handler.content_cache.prime([event.path])
+
+            event_handler.on_any_single_event(event)
+            assert triggered == []
+
+            with open("a.py", "w") as f:
+                f.write("print(2)\n")
+            event_handler.on_any_single_event(event)
+            assert triggered == ["lint", "test"]
+        finally:
+            event_handler.pipeline.stop()
+
+
+def test_internal_files_are_ignored(tmpdir, monkeypatch):
+    triggered = []
+    monkeypatch.setattr(
+        IOHandler, "trigger",
+        lambda self, launch_info: triggered.append(launch_info.task_name),
+    )
+
+    with tmpdir.as_cwd():
+        # the catch-all fileset would match the log file as well
+        with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+            f.write(CONFIG_MULTIPLE_TASKS.replace('"*.css"', '"*"'))
+        event_handler = EventHandler(".", ConfigFactory(".", Overrides()))
+        try:
+            path = os.path.join(".", ".watchcode", "cache", "a.py")
+            event_handler.on_any_single_event(FileEvent(path, "created", False))
+            assert triggered == []
+            event_handler.on_any_single_event(FileEvent(os.path.join(".", ".watchcode.log"), "modified", False))
+            assert triggered == []
+        finally:
+            event_handler.pipeline.stop()
+
+
+def test_event_type_filter(tmpdir, monkeypatch):
+    triggered = []
+    monkeypatch.setattr(
+        IOHandler, "trigger",
+        lambda self, launch_info: triggered.append(launch_info.task_name),
+    )
+
+    with tmpdir.as_cwd():
+        config = CONFIG_MULTIPLE_TASKS.replace(
+            '      - "*.css"\n',
+            '      - "*.css"\n    events:\n      - modified\n',
+        )
+        with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+            f.write(config)
+        event_handler = EventHandler(".", ConfigFactory(".", Overrides()))
+        try:
+            # opened events are not in the default event types
+            event_handler.on_any_single_event(FileEvent(os.path.join(".", "a.py"), "opened", False))
+            assert triggered == []
+
+            event_handler.on_any_single_event(FileEvent(os.path.join(".", "a.css"), "created", False))
+            assert triggered == []
+            event_handler.on_any_single_event(FileEvent(os.path.join(".", "a.css"), "modified", False))
+            assert triggered == ["css"]
+        finally:
+            event_handler.pipeline.stop()
+
+
+def test_config_reads_do_not_reload(tmpdir, monkeypatch):
+    with tmpdir.as_cwd():
+        with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+            f.write(CONFIG_MULTIPLE_TASKS)
+        config_factory = ConfigFactory(".", Overrides())
+        notified = []
+        monkeypatch.setattr(config_factory, "notify_changed", lambda: notified.append(True))
+        event_handler = EventHandler(".", config_factory)
+        try:
+            path = os.path.join(".", DEFAULT_CONFIG_FILENAME)
+            event_handler.on_any_single_event(FileEvent(path, "opened", False))
+            event_handler.on_any_single_event(FileEvent(path, "closed_no_write", False))
+            assert notified == []
+            event_handler.on_any_single_event(FileEvent(path, "modified", False))
+            assert notified == [True]
+        finally:
+            event_handler.pipeline.stop()
+
+
+def test_initial_trigger_uses_snapshot(tmpdir, monkeypatch):
+    triggered = []
+    monkeypatch.setattr(
+        IOHandler, "trigger",
+        lambda self, launch_info: triggered.append(launch_info.task_name),
+    )
+
+    with tmpdir.as_cwd():
+        with open(DEFAULT_CONFIG_FILENAME, "w") as f:
+            f.write(CONFIG_MULTIPLE_TASKS)
+        with open("a.py", "w") as f:
+            f.write("a")
+        event_handler = EventHandler(".", ConfigFactory(".", Overrides()))
+        try:
+            # no snapshot => everything runs
+            event_handler.initial_trigger()
+            assert triggered == ["css", "lint", "test"]
+
+            # nothing changed and all succeeded => nothing runs
+            results = {"css": True, "lint": True, "test": True}
+            Snapshot.take(".", event_handler.filesets, results).save(".")
+            del triggered[:]
+            event_handler.initial_trigger()
+            assert triggered == []
+
+            # only tasks affected by changed files run
+            with open("a.py", "w") as f:
+                f.write("changed")
+            del triggered[:]
+            event_handler.initial_trigger()
+            assert triggered == ["lint", "test"]
+
+            # tasks that failed last time run
+            results["css"] = False
+            Snapshot.take(".", event_handler.filesets, results).save(".")
+            del triggered[:]
+            event_handler.initial_trigger()
+            assert triggered == ["css"]
+        finally:
+            event_handler.pipeline.stop()
+
+
+def test_watcher_with_callable_tasks(tmpdir):
+    calls = []
+
+    def record(changes):
+        calls.append(sorted(changes))
+        return len(calls) > 1
+
+    config = {
+        "filesets": {"python": {"include": ["*.py"], "exclude": [], "match_mode": "gitlike"}},
+        "tasks": {"test": {"fileset": "python", "commands": [record], "clear_screen": False}},
+        "default_task": "test",
+        "log": False,
+    }
+
+    with tmpdir.as_cwd():
+        with pytest.raises(watchcode.ConfigError):
+            watchcode.Watcher(".", config=dict(config, default_task="other"))
+
+        with watchcode.Watcher(".", config=config) as watcher:
+            assert watcher.wait_idle(timeout=10.0)
+            assert calls == [[]]
+            assert watcher.event_handler.task_results() == {"test": False}
+
+            with open("a.py", "w") as f:
+                f.write("a")
+            t_start = time.time()
+            while len(calls) < 2:
+                assert time.time() - t_start < 10.0, "timeout"
+                time.sleep(0.01)
+            assert watcher.wait_idle(timeout=10.0)
+            assert calls[1] == ["a.py"]
+            assert watcher.event_handler.task_results() == {"test": True}
+
+
+def test_snapshot_results_are_carried_over(tmpdir):
+    calls = []
+
+    def record(changes):
+        calls.append(sorted(changes))
+
+    config = {
+        "filesets": {"python": {"include": ["*.py"], "exclude": [], "match_mode": "gitlike"}},
+        "tasks": {"test": {"fileset": "python", "commands": [record], "clear_screen": False}},
+        "default_task": "test",
+        "log": False,
+    }
+
+    with tmpdir.as_cwd():
+        with open("a.py", "w") as f:
+            f.write("a")
+        # only the first session runs, the others reuse its result
+        for _ in range(3):
+            with watchcode.Watcher(".", config=config) as watcher:
+                assert watcher.wait_idle(timeout=10.0)
+            assert Snapshot.load(".").results == {"test": True}
+        assert calls == [[]]
+
+
+def test_watcher_callable_with_result_cache(tmpdir):
+    calls = []
+
+    def record(changes):
+        calls.append(sorted(changes))
+
+    config = {
+        "filesets": {"python": {"include": ["*.py"], "exclude": [], "match_mode": "gitlike"}},
+        "tasks": {"test": {
+            "fileset": "python", "commands": [record], "clear_screen": False, "cache_results": True,
+        }},
+        "default_task": "test",
+        "log": False,
+    }
+
+    with tmpdir.as_cwd():
+        with open("a.py", "w") as f:
+            f.write("a")
+        with watchcode.Watcher(".", config=config) as watcher:
+            assert watcher.wait_idle(timeout=10.0)
+            assert watcher.event_handler.task_results() == {"test": True}
+
+            # inputs unchanged => cached result
+            watcher.trigger()
+            assert watcher.wait_idle(timeout=10.0)
+            assert calls == [[]]
+            assert watcher.event_handler.task_results() == {"test": True}
+        cache_files = os.listdir(os.path.join(INTERNAL_DIRNAME, "cache"))
+        assert not any(name.endswith(".tmp") for name in cache_files)
+
+
+def test_watcher_stops_worker_threads(tmpdir):
+    config = {
+        "filesets": {"python": {
+            "include": ["*.py"], "exclude": [], "match_mode": "gitlike", "compare_content": True,
+        }},
+        "tasks": {"test": {
+            "fileset": "python", "commands": [lambda changes: True], "clear_screen": False,
+            "cache_results": True,
+        }},
+        "default_task": "test",
+        "log": False,
+        "bell": True,
+    }
+    threads_before = set(threading.enumerate())
+    with tmpdir.as_cwd():
+        with open("a.py", "w") as f:
+            f.write("a")
+        with watchcode.Watcher(".", config=config) as watcher:
+            assert watcher.wait_idle(timeout=10.0)
+            watcher.event_handler.content_cache.prime([os.path.join(".", "a.py")])
+        t_start = time.time()
+        while len(set(threading.enumerate()) - threads_before) > 0:
+            assert time.time() - t_start < 10.0, "threads left: {}".format(
+                set(threading.enumerate()) - threads_before
+            )
+            time.sleep(0.01)
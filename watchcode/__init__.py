@@ -0,0 +1,4 @@
+from .config import ConfigError
+from .watchcode import Watcher
+
+__all__ = ["ConfigError", "Watcher"]
@@ -1,5 +1,3 @@
-from __future__ import division, print_function
-
 # Insipred by: https://stackoverflow.com/a/21786287/1804173
 
 
@@ -1,12 +1,27 @@
-from __future__ import division, print_function
-
 import functools
+import hashlib
+import logging
+import multiprocessing
 import os
+import threading
 import yaml
 
-from .matching import AVAILABLE_MATCH_MODES
+from .matching import AVAILABLE_MATCH_MODES, DEFAULT_EVENT_TYPES, EVENT_TYPES
+from .matching import FileSetMatcher, PatternError
+from .scheduler import TaskGraph
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_CONFIG_FILENAME = ".watchcode.yaml"
+# directory for persistent state, e.g. cached results
+INTERNAL_DIRNAME = ".watchcode"
+
+DEFAULT_DEBOUNCE = 0.2
+
+LOG_FILENAME = ".watchcode.log"
+
+# libyaml based parsing is much faster, if available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 
 # -----------------------------------------------------------------------------
@@ -38,6 +53,45 @@ class CheckerBool(object):
         return isinstance(x, bool), x
 
 
+class CheckerNonNegativeNumber(object):
+    # must be ...
+    name = "a non-negative number"
+
+    def __call__(self, x):
+        is_number = isinstance(x, (int, float)) and not isinstance(x, bool)
+        return is_number and x >= 0, x
+
+
+class CheckerPositiveInt(object):
+    # must be ...
+    name = "a positive integer"
+
+    def __call__(self, x):
+        return isinstance(x, int) and not isinstance(x, bool) and x > 0, x
+
+
+class CheckerDebounce(object):
+    # must be ...
+    name = "a non-negative number or 'adaptive'"
+
+    def __call__(self, x):
+        if x == "adaptive":
+            return True, x
+        return CheckerNonNegativeNumber()(x)
+
+
+class CheckerListOfChoices(object):
+
+    def __init__(self, choices):
+        self.choices = choices
+        # must be ...
+        self.name = "a list of {}".format(", ".join("'{}'".format(c) for c in choices))
+
+    def __call__(self, x):
+        is_valid, x = CheckerListOfStr()(x)
+        return is_valid and all(element in self.choices for element in x), x
+
+
 class CheckerDict(object):
     # must be ...
     name = "a dictionary"
@@ -65,6 +119,30 @@ class CheckerListOfStr(object):
                 return all_str, x
 
 
+class CheckerCommands(object):
+    # must be ...
+    name = "a list of commands (strings, dictionaries defining parallel groups, or callables)"
+
+    def __call__(self, x):
+        # Like for CheckerListOfStr, unspecified lists are empty
+        if x is None:
+            return True, []
+        if not isinstance(x, list):
+            return False, x
+        return all(isinstance(element, (str, dict)) or callable(element) for element in x), x
+
+
+class CheckerChoice(object):
+
+    def __init__(self, choices):
+        self.choices = choices
+        # must be ...
+        self.name = "one of {}".format(", ".join("'{}'".format(c) for c in choices))
+
+    def __call__(self, x):
+        return x in self.choices, x
+
+
 class CheckerMatchMode(object):
     # must be ...
     name = "either {}".format(AVAILABLE_MATCH_MODES.keys())
@@ -121,11 +199,33 @@ class SafeKeyExtractor(object):
 # -----------------------------------------------------------------------------
 
 class FileSet(object):
-    def __init__(self, patterns_incl, patterns_excl, matcher, exclude_gitignore):
+    def __init__(self, patterns_incl, patterns_excl, matcher, exclude_gitignore,
+                 compare_content=False, event_types=None, directories=True):
         self.patterns_incl = patterns_incl
         self.patterns_excl = patterns_excl
+        # precompiled FileSetMatcher
         self.matcher = matcher
         self.exclude_gitignore = exclude_gitignore
+        # drop 'modified' events if the file content did not change
+        self.compare_content = compare_content
+        # accepted (raw) event types, None accepts all
+        self.event_types = event_types
+        # whether directory events can match at all
+        self.directories = directories
+
+    @property
+    def signature(self):
+        """
+        Identifies the matching behavior, which allows to detect whether
+        a reloaded fileset actually differs.
+        """
+        return (
+            tuple(self.patterns_incl),
+            tuple(self.patterns_excl),
+            type(self.matcher.matcher_incl),
+            self.exclude_gitignore,
+            self.directories,
+        )
 
     @staticmethod
     def validate(data):
@@ -133,33 +233,150 @@ class FileSet(object):
 
         patterns_incl = extractor("include", CheckerListOfStr())
         patterns_excl = extractor("exclude", CheckerListOfStr())
-        matcher = extractor("match_mode", CheckerMatchMode(), default="gitlike")
+        pattern_set_cls = extractor("match_mode", CheckerMatchMode(), default="gitlike")
         exclude_gitignore = extractor("exclude_gitignore", CheckerBool(), default=True)
+        compare_content = extractor("compare_content", CheckerBool(), default=False)
+        events = extractor(
+            "events", CheckerListOfChoices(sorted(EVENT_TYPES.keys())),
+            default=DEFAULT_EVENT_TYPES,
+        )
+        directories = extractor("directories", CheckerBool(), default=True)
 
         extractor.verify_no_extra_keys()
+
+        # git doesn't list ignored files (unless they are tracked)
+        if pattern_set_cls.uses_git_file_list:
+            exclude_gitignore = False
+
+        try:
+            matcher = FileSetMatcher(patterns_incl, patterns_excl, pattern_set_cls)
+        except PatternError as e:
+            raise ConfigError("Fileset contains invalid pattern: {}".format(e))
+
         return FileSet(
             patterns_incl=patterns_incl,
             patterns_excl=patterns_excl,
             matcher=matcher,
             exclude_gitignore=exclude_gitignore,
+            compare_content=compare_content,
+            event_types={t for event in events for t in EVENT_TYPES[event]},
+            directories=directories,
+        )
+
+
+ON_BUSY_POLICIES = ["discard", "queue", "restart"]
+
+RUNNERS = ["shell", "python-forkserver", "shell-session"]
+
+
+class CommandGroup(object):
+    """
+    Commands that run in parallel, with at most `max_parallel` at a time.
+    """
+
+    def __init__(self, commands, max_parallel):
+        self.commands = commands
+        self.max_parallel = max_parallel
+
+    def __str__(self):
+        return "parallel: {}".format(", ".join(self.commands))
+
+    @staticmethod
+    def validate(data):
+        extractor = SafeKeyExtractor(data, "parallel command group")
+
+        commands = extractor("parallel", CheckerListOfStr())
+        max_parallel = extractor(
+            "max_parallel", CheckerPositiveInt(), default=max(len(commands), 1)
+        )
+
+        extractor.verify_no_extra_keys()
+        return CommandGroup(commands, max_parallel)
+
+
+class CallableCommand(object):
+    """
+    A Python callable used as command (only possible via the Watcher API).
+    It runs in-process and receives the list of changed files.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return "{}.{}()".format(
+            getattr(self.func, "__module__", None) or "?",
+            getattr(self.func, "__qualname__", None) or type(self.func).__name__,
         )
 
 
 class Task(object):
-    def __init__(self, fileset, commands, clear_screen, queue_events):
+    def __init__(self, fileset, commands, clear_screen, queue_events, on_busy, debounce_max_wait,
+                 fileset_name=None, depends_on=(), cache_results=False, speculative=False,
+                 debounce=DEFAULT_DEBOUNCE, debounce_min=0.05, debounce_max=1.0,
+                 runner="shell", preload=(), setup=()):
         self.fileset = fileset
+        # tasks referring to the same fileset can share matching state
+        self.fileset_name = fileset_name
+        # names of tasks that have to succeed before this task runs
+        self.depends_on = list(depends_on)
+        # skip runs if the inputs match a previous successful run
+        self.cache_results = cache_results
+        # start at the first trigger, restart if more triggers follow
+        self.speculative = speculative
+        # debounce interval in seconds, or "adaptive" (learned within the bounds)
+        self.debounce = debounce
+        self.debounce_min = debounce_min
+        self.debounce_max = debounce_max
+        # how commands are executed, see RUNNERS
+        self.runner = runner
+        # modules imported once by the python-forkserver runner
+        self.preload = list(preload)
+        # commands run once per session by the shell-session runner
+        self.setup = list(setup)
         self.commands = commands
         self.clear_screen = clear_screen
         self.queue_events = queue_events
+        # what to do with triggers while the task is running
+        self.on_busy = on_busy
+        # None means that a steady stream of events can postpone the task forever
+        self.debounce_max_wait = debounce_max_wait
 
     @staticmethod
     def validate(data, filesets):
         extractor = SafeKeyExtractor(data, "task")
 
         fileset = extractor("fileset", CheckerStr())
-        commands = extractor("commands", CheckerListOfStr())
+        commands = [
+            CommandGroup.validate(command) if isinstance(command, dict) else
+            CallableCommand(command) if callable(command) else command
+            for command in extractor("commands", CheckerCommands())
+        ]
         clear_screen = extractor("clear_screen", CheckerBool(), default=True)
         queue_events = extractor("queue_events", CheckerBool(), default=False)
+        on_busy = extractor(
+            "on_busy", CheckerChoice(ON_BUSY_POLICIES),
+            default="queue" if queue_events else "discard",
+        )
+        # opt-in, by default a steady stream of events keeps postponing the task
+        debounce_max_wait = extractor("debounce_max_wait", CheckerNonNegativeNumber(), default=0)
+        if debounce_max_wait == 0:
+            debounce_max_wait = None
+        depends_on = extractor("depends_on", CheckerListOfStr(), default=[])
+        cache_results = extractor("cache_results", CheckerBool(), default=False)
+        speculative = extractor("speculative", CheckerBool(), default=False)
+        debounce = extractor("debounce", CheckerDebounce(), default=DEFAULT_DEBOUNCE)
+        debounce_min = extractor("debounce_min", CheckerNonNegativeNumber(), default=0.05)
+        debounce_max = extractor("debounce_max", CheckerNonNegativeNumber(), default=1.0)
+        if debounce_min > debounce_max:
+            raise ConfigError("Key 'debounce_min' of task must not exceed 'debounce_max'.")
+        runner = extractor("runner", CheckerChoice(RUNNERS), default="shell")
+        preload = extractor("preload", CheckerListOfStr(), default=[])
+        if len(preload) > 0 and runner != "python-forkserver":
+            raise ConfigError("Key 'preload' of task requires runner 'python-forkserver'.")
+        setup = extractor("setup", CheckerListOfStr(), default=[])
+        if len(setup) > 0 and runner != "shell-session":
+            raise ConfigError("Key 'setup' of task requires runner 'shell-session'.")
 
         # Lookup fileset in filesets dict
         if fileset not in filesets:
@@ -168,22 +385,50 @@ class Task(object):
                 ", ".join(["'{}'".format(x) for x in sorted(filesets.keys())])
             ))
 
+        fileset_name = fileset
         fileset = filesets[fileset]
 
         extractor.verify_no_extra_keys()
-        return Task(fileset, commands, clear_screen, queue_events)
+        return Task(
+            fileset, commands, clear_screen, queue_events, on_busy, debounce_max_wait,
+            fileset_name=fileset_name,
+            depends_on=depends_on,
+            cache_results=cache_results,
+            speculative=speculative,
+            debounce=debounce,
+            debounce_min=debounce_min,
+            debounce_max=debounce_max,
+            runner=runner,
+            preload=preload,
+            setup=setup,
+        )
+
+
+def validate_task_dependencies(tasks):
+    graph = TaskGraph.from_tasks(tasks)
+    for name, dep in graph.undefined_dependencies():
+        raise ConfigError("Task '{}' depends on task '{}' which does not exist.".format(
+            name, dep,
+        ))
+    cycle = graph.find_cycle()
+    if cycle is not None:
+        raise ConfigError("Task dependencies contain a cycle: {}".format(
+            " -> ".join("'{}'".format(name) for name in cycle)
+        ))
 
 
 class Overrides(object):
-    def __init__(self, task_name=None, log=None, sound=None, notifications=None):
+    def __init__(self, task_name=None, log=None, sound=None, notifications=None, all_tasks=None):
         self.task_name = task_name
+        self.all_tasks = all_tasks
         self.log = log
         self.sound = sound
         self.notifications = notifications
 
 
 class Config(object):
-    def __init__(self, overrides, tasks, default_task, log, sound, notifications):
+    def __init__(self, overrides, tasks, default_task, log, sound, notifications, all_tasks=False,
+                 max_workers=None, bell=False, webhook=""):
         self.overrides = overrides
 
         def with_override(value, override_value):
@@ -193,11 +438,17 @@ class Config(object):
                 return override_value
 
         self.tasks = tasks
+        self.graph = TaskGraph.from_tasks(tasks)
+        self.max_workers = max_workers
 
         self.default_task = with_override(default_task, overrides.task_name)
+        self.all_tasks = with_override(all_tasks, overrides.all_tasks)
         self.log = with_override(log, overrides.log)
         self.sound = with_override(sound, overrides.sound)
         self.notifications = with_override(notifications, overrides.notifications)
+        self.bell = bell
+        # URL or 'unix:<path>' to post notifications to, empty if disabled
+        self.webhook = webhook
 
         self.task = self.get_task_validated()
 
@@ -206,6 +457,20 @@ class Config(object):
             raise ConfigError("Task name '{}' is not defined.".format(self.default_task))
         return self.tasks[self.default_task]
 
+    @property
+    def active_tasks(self):
+        """
+        Tasks that react to events: Either all tasks, or only the default task.
+        """
+        if self.all_tasks:
+            return self.tasks
+        else:
+            # the default task requires its dependencies
+            return {
+                name: self.tasks[name]
+                for name in self.graph.upstream([self.default_task])
+            }
+
     @staticmethod
     def validate(data, overrides):
         extractor = SafeKeyExtractor(data, "config")
@@ -216,10 +481,17 @@ class Config(object):
         log = extractor("log", CheckerBool(), default=True)
         sound = extractor("sound", CheckerBool(), default=False)
         notifications = extractor("notifications", CheckerBool(), default=False)
+        bell = extractor("bell", CheckerBool(), default=False)
+        webhook = extractor("webhook", CheckerStr(), default="")
+        all_tasks = extractor("all_tasks", CheckerBool(), default=False)
+        max_workers = extractor(
+            "max_workers", CheckerPositiveInt(), default=multiprocessing.cpu_count()
+        )
 
         # subparsers including consistency check
         filesets = map_dict_values(filesets_dict, FileSet.validate)
         tasks = map_dict_values(tasks_dict, functools.partial(Task.validate, filesets=filesets))
+        validate_task_dependencies(tasks)
 
         extractor.verify_no_extra_keys()
         return Config(
@@ -229,12 +501,16 @@ class Config(object):
             log=log,
             sound=sound,
             notifications=notifications,
+            all_tasks=all_tasks,
+            max_workers=max_workers,
+            bell=bell,
+            webhook=webhook,
         )
 
 
-def load_config(working_directory, overrides):
+def read_config_file(working_directory):
     """
-    Main entry point for config loading.
+    Returns the raw content of the config file.
     """
     config_path = os.path.join(working_directory, DEFAULT_CONFIG_FILENAME)
 
@@ -242,9 +518,18 @@ def load_config(working_directory, overrides):
         raise ConfigError("Could not find '{}'".format(DEFAULT_CONFIG_FILENAME))
 
     try:
-        with open(config_path) as f:
-            config_data = yaml.load(f)
-    except (IOError, yaml.YAMLError) as e:
+        with open(config_path, "rb") as f:
+            return f.read()
+    except IOError as e:
+        raise ConfigError("Could not read/parse '{}':\n{}".format(
+            DEFAULT_CONFIG_FILENAME, str(e)
+        ))
+
+
+def parse_config(content, overrides):
+    try:
+        config_data = yaml.load(content, Loader=YAML_LOADER)
+    except yaml.YAMLError as e:
         raise ConfigError("Could not read/parse '{}':\n{}".format(
             DEFAULT_CONFIG_FILENAME, str(e)
         ))
@@ -252,10 +537,101 @@ def load_config(working_directory, overrides):
     return Config.validate(config_data, overrides)
 
 
+def load_config(working_directory, overrides):
+    """
+    Main entry point for config loading.
+    """
+    return parse_config(read_config_file(working_directory), overrides)
+
+
 class ConfigFactory(object):
+    """
+    Provides the current config. The validated config is cached, so that
+    loading it on every trigger doesn't involve any I/O. The file watcher
+    has to call `notify_changed` on changes of the config file, which
+    reloads the config in the background. Re-parsing is skipped if the
+    content digest of the file did not change.
+    """
+
     def __init__(self, working_directory, overrides):
         self.working_directory = working_directory
         self.overrides = overrides
 
+        self.lock = threading.Lock()
+        # serializes reloading
+        self.load_lock = threading.Lock()
+        self._config = None
+        self._digest = None
+        self._stale = True
+        self._reloading = False
+
+    def load_config(self):
+        with self.lock:
+            if not self._stale and not self._reloading:
+                return self._config
+        return self._reload()
+
+    def notify_changed(self):
+        """
+        Marks the cached config as outdated, and reloads it in the background.
+        """
+        with self.lock:
+            self._stale = True
+        thread = threading.Thread(target=self._reload_in_background)
+        thread.daemon = True
+        thread.start()
+
+    def _reload_in_background(self):
+        try:
+            self._reload()
+        except ConfigError:
+            # reported when the config gets used
+            pass
+
+    def _reload(self):
+        with self.load_lock:
+            with self.lock:
+                if not self._stale:
+                    return self._config
+                # changes from here on have to mark the config stale again
+                self._stale = False
+                self._reloading = True
+                config = self._config
+                digest = self._digest
+
+            try:
+                content = read_config_file(self.working_directory)
+                new_digest = hashlib.blake2b(content, digest_size=20).digest()
+                if config is None or new_digest != digest:
+                    logger.info("Config: (re)parsing '{}'".format(DEFAULT_CONFIG_FILENAME))
+                    config = parse_config(content, self.overrides)
+            except ConfigError:
+                # keep retrying on subsequent loads
+                with self.lock:
+                    self._stale = True
+                    self._reloading = False
+                raise
+
+            with self.lock:
+                self._config = config
+                self._digest = new_digest
+                self._reloading = False
+            return config
+
+
+class StaticConfigFactory(object):
+    """
+    Provides a config given as data (with the same structure as the config
+    file) instead of reading the config file, e.g. for the Watcher API.
+    The config is validated once, i.e., errors are raised on construction.
+    """
+
+    def __init__(self, data, overrides):
+        self.overrides = overrides
+        self._config = Config.validate(data, overrides)
+
     def load_config(self):
-        return load_config(self.working_directory, self.overrides)
+        return self._config
+
+    def notify_changed(self):
+        pass
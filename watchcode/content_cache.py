@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import mmap
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file(path, mmap_threshold):
+    """
+    Returns a digest of the file content. Files of at least
+    `mmap_threshold` bytes are read through mmap.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= mmap_threshold and size > 0:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                h.update(m)
+            finally:
+                m.close()
+        else:
+            h.update(f.read())
+    return h.digest()
+
+
+class ContentCache(object):
+    """
+    Remembers (size, mtime_ns, digest) of files in order to detect
+    `modified` events that did not actually change the content
+    (e.g. saving an unmodified buffer, `touch`, or rewriting identical
+    generated files).
+
+    If the stat data of a file did not change, its content is assumed
+    unchanged without hashing -- unless the file was modified so shortly
+    before it was hashed that a later modification could still carry
+    the same mtime ("racily clean" files).
+    """
+
+    MMAP_THRESHOLD = 1024 * 1024
+    RACY_MARGIN_NS = 1000000000
+
+    def __init__(self, max_workers=None, mmap_threshold=MMAP_THRESHOLD):
+        self.lock = threading.Lock()
+        self.mmap_threshold = mmap_threshold
+        # normalized path => (size, mtime_ns, digest, hashed_at_ns)
+        self._entries = {}
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _map(self, func, items):
+        with self.lock:
+            pool = self._pool
+        if pool is not None:
+            try:
+                return pool.map(func, items)
+            except RuntimeError:
+                # shut down concurrently
+                pass
+        return map(func, items)
+
+    def close(self):
+        """
+        Shuts down the background pool. Files are checked sequentially
+        afterwards.
+        """
+        with self.lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def _check(self, path):
+        """
+        Updates the entry of a file. Returns (changed, digest), where changed
+        is False if the content is known to be unchanged. The digest is None
+        if the file cannot be read.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self.lock:
+                self._entries.pop(path, None)
+            return True, None
+
+        with self.lock:
+            entry = self._entries.get(path)
+
+        if entry is not None:
+            size, mtime_ns, digest, hashed_at_ns = entry
+            if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns) and \
+                    hashed_at_ns - mtime_ns > self.RACY_MARGIN_NS:
+                return False, digest
+            if size != stat.st_size:
+                digest = None
+        else:
+            digest = None
+
+        hashed_at_ns = time.time_ns()
+        try:
+            new_digest = hash_file(path, self.mmap_threshold)
+        except (IOError, OSError, ValueError) as e:
+            logger.info("Failed to hash '{}': {}".format(path, e))
+            with self.lock:
+                self._entries.pop(path, None)
+            return True, None
+
+        with self.lock:
+            self._entries[path] = (stat.st_size, stat.st_mtime_ns, new_digest, hashed_at_ns)
+        return digest is None or digest != new_digest, new_digest
+
+    def changed(self, paths):
+        """
+        Returns the subset of `paths` whose content may have changed since
+        they have been seen last. Files are checked in parallel on the
+        background pool.
+        """
+        paths = [os.path.normpath(path) for path in paths]
+        results = list(self._map(self._check, paths))
+        return {path for path, (changed, _) in zip(paths, results) if changed}
+
+    def digests(self, paths):
+        """
+        Returns a dict mapping the given paths to the digest of their
+        current content (None for unreadable files).
+        """
+        results = self._map(self._check, paths)
+        return {path: digest for path, (_, digest) in zip(paths, results)}
+
+    def forget(self, path):
+        with self.lock:
+            self._entries.pop(os.path.normpath(path), None)
+
+    def prime(self, paths):
+        """
+        Records the current content of the given files.
+        """
+        paths = [os.path.normpath(path) for path in paths]
+        for _ in self._map(self._check, paths):
+            pass
+        logger.info("Content cache: {} entries".format(len(self._entries)))
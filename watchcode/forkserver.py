@@ -0,0 +1,435 @@
+import importlib
+import json
+import logging
+import os
+import runpy
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+class ForkServerError(Exception):
+    pass
+
+
+# Commands containing any of these characters need a shell.
+SHELL_CHARS = set("|&;<>()$`*?[]{}~")
+
+PYTEST_COMMANDS = ("pytest", "py.test")
+
+
+def is_own_environment(prog):
+    """
+    Checks whether a program (looked up on PATH) is the running interpreter,
+    or the pytest script of its environment. Otherwise running it in-process
+    would silently switch the interpreter, e.g. if a venv is activated.
+    """
+    if os.sep in prog or (os.altsep is not None and os.altsep in prog):
+        return False
+    path = shutil.which(prog)
+    if path is None:
+        return False
+    executable = os.path.abspath(sys.executable)
+    if os.path.dirname(os.path.abspath(path)) != os.path.dirname(executable):
+        return False
+    if prog in PYTEST_COMMANDS:
+        return True
+    return os.path.realpath(path) == os.path.realpath(executable)
+
+
+def parse_python_command(command):
+    """
+    Determines whether a command can run in-process in a child of the fork
+    server: `pytest ...`, `python -m <module> ...`, or `python <script> ...`,
+    as long as the program belongs to the environment of the running
+    interpreter. Returns the request, or None if the command has to run in
+    a shell.
+    """
+    if any(c in SHELL_CHARS for c in command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    if len(argv) == 0:
+        return None
+
+    prog = argv[0]
+    if prog not in PYTEST_COMMANDS + ("python", "python3", os.path.basename(sys.executable)):
+        return None
+    if not is_own_environment(prog):
+        return None
+    if prog in PYTEST_COMMANDS:
+        return {"kind": "pytest", "args": argv[1:]}
+    if len(argv) >= 3 and argv[1] == "-m":
+        if argv[2] in PYTEST_COMMANDS:
+            return {"kind": "pytest", "args": argv[3:]}
+        return {"kind": "module", "target": argv[2], "args": argv[3:]}
+    if len(argv) >= 2 and not argv[1].startswith("-"):
+        return {"kind": "path", "target": argv[1], "args": argv[2:]}
+    return None
+
+
+class ForkedProcess(object):
+    """
+    Popen-like handle of a process started on our behalf by another
+    process (e.g. a child of the fork server), sufficient for
+    `kill_process_group`. The process has to be a process group leader.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+        self._done = threading.Event()
+
+    def _set_returncode(self, returncode):
+        self.returncode = returncode
+        self._done.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise subprocess.TimeoutExpired("forked child {}".format(self.pid), timeout)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except OSError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+# The server has to be able to import watchcode, but the modules of the
+# working directory take precedence.
+SERVER_BOOTSTRAP = (
+    "import sys; sys.path.append({!r}); "
+    "from watchcode.forkserver import serve; serve(int(sys.argv[1]), sys.argv[2:])"
+).format(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class _ServerProcess(object):
+    """
+    A single fork server process. Requests are sent via stdin, responses
+    are received via a separate pipe, because stdout/stderr are shared
+    with the children.
+    """
+
+    STOP_TIMEOUT = 3.0
+
+    def __init__(self, working_dir, preload):
+        self.working_dir = working_dir
+        read_fd, write_fd = os.pipe()
+        try:
+            self.proc = subprocess.Popen(
+                [sys.executable, "-c", SERVER_BOOTSTRAP, str(write_fd)] + list(preload),
+                stdin=subprocess.PIPE,
+                cwd=working_dir,
+                pass_fds=(write_fd,),
+            )
+        except OSError as e:
+            os.close(read_fd)
+            raise ForkServerError(str(e))
+        finally:
+            os.close(write_fd)
+        self.responses = os.fdopen(read_fd, "r")
+
+        # absolute paths of the files of all preloaded modules
+        self.files = set()
+        self.failed = False
+        self.ready = threading.Event()
+        self.request_lock = threading.Lock()
+
+        thread = threading.Thread(target=self._wait_ready)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def _receive(self):
+        line = self.responses.readline()
+        if line == "":
+            raise ForkServerError("fork server exited")
+        return json.loads(line)
+
+    def _wait_ready(self):
+        try:
+            message = self._receive()
+            self.files = set(message["files"])
+            for error in message["errors"]:
+                print(" * Failed to preload module {}".format(error))
+            logger.info("Fork server ready: {} preloaded files".format(len(self.files)))
+        except (ForkServerError, ValueError, KeyError) as e:
+            logger.warning("Fork server failed to start: {}".format(e))
+            self.failed = True
+        finally:
+            self.ready.set()
+
+    def run(self, request, on_started):
+        with self.request_lock:
+            if not self.alive:
+                raise ForkServerError("fork server exited")
+            try:
+                self.proc.stdin.write((json.dumps(request) + "\n").encode("utf-8"))
+                self.proc.stdin.flush()
+            except (IOError, OSError) as e:
+                raise ForkServerError(str(e))
+            child = ForkedProcess(self._receive()["pid"])
+            on_started(child)
+            child._set_returncode(self._receive()["retcode"])
+            return child.returncode
+
+    def stop(self):
+        """
+        Stops the server after a running request has finished.
+        """
+        with self.request_lock:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+        try:
+            self.proc.wait(timeout=self.STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.responses.close()
+
+
+class ForkServer(object):
+    """
+    Keeps a warm Python interpreter with the `preload` modules imported.
+    For every command it forks a child, which runs pytest, a module, or
+    a script in-process, so that neither interpreter startup nor importing
+    heavy dependencies is paid per run. If the file of a preloaded module
+    changes, a fresh interpreter is warmed up in the background. A run
+    never uses an interpreter which has preloaded a changed file.
+    """
+
+    def __init__(self, working_dir, preload):
+        self.working_dir = working_dir
+        self.preload = list(preload)
+        self.lock = threading.Lock()
+        self._server = None
+        # changed paths not yet checked against the files of `_server`
+        self._changed = set()
+
+    def warm(self):
+        """
+        Starts the interpreter (in the background) unless it is running.
+        """
+        with self.lock:
+            if self._server is None or not self._server.alive:
+                self._start_server()
+            return self._server
+
+    def _start_server(self):
+        # requires the lock held
+        old_server = self._server
+        self._changed = set()
+        try:
+            self._server = _ServerProcess(self.working_dir, self.preload)
+        except ForkServerError:
+            self._server = None
+            raise
+        finally:
+            if old_server is not None:
+                thread = threading.Thread(target=old_server.stop)
+                thread.daemon = True
+                thread.start()
+
+    def notify_changed(self, paths):
+        """
+        Re-warms the interpreter if any of the (absolute) paths belongs to
+        a preloaded module. Never blocks: If the interpreter is still
+        starting, the check is done once it is ready, or by the next run.
+        """
+        with self.lock:
+            server = self._server
+            if server is None:
+                return
+            self._changed.update(paths)
+            if server.ready.is_set():
+                self._rewarm_if_changed()
+                return
+        thread = threading.Thread(target=self._check_changed, args=(server,))
+        thread.daemon = True
+        thread.start()
+
+    def _check_changed(self, server):
+        server.ready.wait()
+        with self.lock:
+            if self._server is server:
+                self._rewarm_if_changed()
+
+    def _rewarm_if_changed(self):
+        # requires the lock held and `_server` to be ready
+        changed = self._changed
+        self._changed = set()
+        if not any(path in self._server.files for path in changed):
+            return
+        logger.info("Preloaded module changed => re-warming fork server")
+        try:
+            self._start_server()
+        except ForkServerError as e:
+            # started again on the next run
+            logger.warning("Failed to start fork server: {}".format(e))
+
+    @staticmethod
+    def accepts(command):
+        return parse_python_command(command) is not None
+
+    def run(self, command, env, on_started):
+        """
+        Runs a command accepted by `accepts` in a forked child and returns
+        its exit code. `on_started` is called with the ForkedProcess handle,
+        which allows to cancel the child.
+        """
+        request = parse_python_command(command)
+        if request is None:
+            raise ForkServerError("command requires a shell")
+        server = self.warm()
+        while True:
+            server.ready.wait()
+            # changes notified while the server was starting must be checked first
+            with self.lock:
+                if self._server is server:
+                    self._rewarm_if_changed()
+                    if self._server is server:
+                        break
+            server = self.warm()
+        if server.failed:
+            raise ForkServerError("fork server failed to start")
+        request = dict(request, cwd=os.path.abspath(self.working_dir), env=env)
+        return server.run(request, on_started)
+
+    def stop(self):
+        with self.lock:
+            server = self._server
+            self._server = None
+        if server is not None:
+            thread = threading.Thread(target=server.stop)
+            thread.daemon = True
+            thread.start()
+
+
+# -----------------------------------------------------------------------------
+# Server side
+# -----------------------------------------------------------------------------
+
+def _exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def _execute(request):
+    kind = request["kind"]
+    args = request["args"]
+    if kind == "pytest":
+        import pytest
+        sys.argv = ["pytest"] + args
+        return int(pytest.main(args))
+    elif kind == "module":
+        sys.argv = [request["target"]] + args
+        runpy.run_module(request["target"], run_name="__main__", alter_sys=True)
+        return 0
+    else:
+        path = request["target"]
+        sys.argv = [path] + args
+        sys.path[0] = os.path.dirname(os.path.abspath(path))
+        runpy.run_path(path, run_name="__main__")
+        return 0
+
+
+def _run_child(request):
+    code = 1
+    try:
+        os.setsid()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        code = _execute(request)
+    except SystemExit as e:
+        code = _exit_code(e.code)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        os._exit(code)
+
+
+def _preloaded_files(modules_before):
+    files = set()
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if name not in modules_before and path is not None:
+            files.add(os.path.abspath(path))
+    return sorted(files)
+
+
+def serve(response_fd, preload):
+    """
+    Main loop of the fork server process.
+    """
+    responses = os.fdopen(response_fd, "w")
+    # The server exits when watchcode closes stdin, <CTRL>+C in the
+    # terminal must not produce a traceback here.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def send(message):
+        responses.write(json.dumps(message) + "\n")
+        responses.flush()
+
+    modules_before = set(sys.modules)
+    errors = []
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            errors.append("{}: {}".format(name, e))
+    send({"files": _preloaded_files(modules_before), "errors": errors})
+
+    while True:
+        line = sys.stdin.readline()
+        if line == "":
+            break
+        request = json.loads(line)
+        pid = os.fork()
+        if pid == 0:
+            _run_child(request)
+        send({"pid": pid})
+        _, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            retcode = -os.WTERMSIG(status)
+        else:
+            retcode = os.WEXITSTATUS(status)
+        send({"retcode": retcode})
@@ -0,0 +1,277 @@
+import collections
+import functools
+import logging
+import os
+import subprocess
+import threading
+
+from . import gitignore
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=64)
+def find_index_file(repo_root):
+    """
+    Determines the path of the index file, which is specific to the
+    work tree in case of linked worktrees. Its directory also contains
+    the markers of running git operations.
+    """
+    try:
+        p = subprocess.Popen(
+            ["git", "rev-parse", "--git-path", "index"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=repo_root,
+        )
+        outs, _ = p.communicate()
+        index_file = outs.decode("utf-8", "surrogateescape").strip() if p.returncode == 0 else ""
+    except OSError:
+        index_file = ""
+
+    if index_file == "":
+        index_file = os.path.join(".git", "index")
+    return os.path.normpath(os.path.join(repo_root, index_file))
+
+
+class GitFileList(object):
+    """
+    The files git knows about: tracked files, and untracked files that
+    are not ignored.
+
+    The list is obtained by a single `git ls-files` call, and refreshed
+    in the background whenever the index file changes (e.g. on `git add`,
+    `git rm`, or a checkout, but also on `git status`). Meanwhile the
+    previous list is served. Untracked files created afterwards don't touch
+    the index. They are added on first sight after checking the ignore
+    rules once. Every change of the listed files increments `generation`,
+    and the changed paths are recorded (see `changes_since`).
+    """
+
+    def __init__(self, git_ignore):
+        self.git_ignore = git_ignore
+        self.repo_root = git_ignore.repo_root
+        self.index_file = find_index_file(self.repo_root)
+
+        self.generation = 0
+        self.lock = threading.RLock()
+
+        # tuples of components relative to the repository root
+        self._files = set()
+        self._dirs = set()
+        self._signature = None
+
+        # background refresh: running, and requested again in the meantime
+        self._refresh_running = False
+        self._refresh_pending = False
+        self._listeners = []
+
+        self.refresh(force=True)
+
+    def _index_signature(self):
+        try:
+            st = os.stat(self.index_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _list_files(self):
+        try:
+            p = subprocess.Popen(
+                ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=self.repo_root,
+            )
+            outs, errs = p.communicate()
+        except OSError as e:
+            logger.warning("Failed to run git ls-files: {}".format(e))
+            return None
+        if p.returncode != 0:
+            logger.warning("Failed to run git ls-files: {}".format(
+                errs.decode("utf-8", "replace").strip()
+            ))
+            return None
+        paths = outs.decode("utf-8", "surrogateescape").split("\0")
+        return [path for path in paths if path != ""]
+
+    def refresh(self, force=False):
+        """
+        Re-lists the files if the index has changed. Returns True if
+        the set of files has changed.
+        """
+        signature = self._index_signature()
+        with self.lock:
+            if not force and signature == self._signature:
+                return False
+
+        paths = self._list_files()
+        if paths is None:
+            return False
+
+        files = set(tuple(path.split("/")) for path in paths)
+        dirs = set(comps[:i] for comps in files for i in range(1, len(comps)))
+
+        with self.lock:
+            self._signature = signature
+            if files == self._files:
+                return False
+            logger.info("Git file list: {} files".format(len(files)))
+            changed = files ^ self._files
+            self._files = files
+            self._dirs = dirs
+            self.generation += 1
+        if not force:
+            # a change without log entry is treated as unknown by `changes_since`
+            _record_change(self, changed)
+        return True
+
+    def request_refresh(self, on_changed=None):
+        """
+        Refreshes the list in the background if the index has changed, and
+        calls `on_changed` (if given) if the listed files have changed.
+        Never blocks, concurrent requests are coalesced.
+        """
+        if self._index_signature() == self._signature:
+            return
+        with self.lock:
+            if on_changed is not None and on_changed not in self._listeners:
+                self._listeners.append(on_changed)
+            if self._refresh_running:
+                self._refresh_pending = True
+                return
+            self._refresh_running = True
+        thread = threading.Thread(target=self._refresh_loop)
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            changed = self.refresh()
+            with self.lock:
+                listeners = self._listeners if changed else []
+                if changed:
+                    self._listeners = []
+                done = not self._refresh_pending
+                self._refresh_pending = False
+                if done:
+                    self._refresh_running = False
+            for listener in listeners:
+                listener()
+            if done:
+                return
+
+    def contains(self, path, is_dir):
+        """
+        Checks whether a file (or directory) is listed, i.e., whether a
+        directory contains any listed files.
+        """
+        comps = self.git_ignore.to_components(path)
+        if comps is None or ".git" in comps:
+            return False
+        with self.lock:
+            if comps in (self._dirs if is_dir else self._files):
+                return True
+        # not listed yet => only new untracked paths can still be included
+        if self.git_ignore.is_ignored(path, is_dir):
+            return False
+        with self.lock:
+            if is_dir:
+                self._dirs.add(comps)
+            else:
+                self._files.add(comps)
+            for i in range(1, len(comps)):
+                self._dirs.add(comps[:i])
+        return True
+
+    def __len__(self):
+        return len(self._files)
+
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+# (generation after the change, changed absolute paths or None for unknown)
+_change_log = collections.deque(maxlen=32)
+MAX_LOGGED_PATHS = 10000
+
+
+def _record_change(instance, changed):
+    if changed is not None and len(changed) > MAX_LOGGED_PATHS:
+        changed = None
+    if changed is not None:
+        changed = set(os.path.join(instance.repo_root, *comps) for comps in changed)
+    with _instances_lock:
+        if _instances.get(instance.repo_root) is not instance:
+            # not shared => not part of `get_generation`
+            return
+        generation = sum(instance.generation for instance in _instances.values())
+        _change_log.append((generation, changed))
+
+
+def changes_since(generation):
+    """
+    Returns the absolute paths of files whose listing changed after the
+    given generation, or None if they are not known (anymore).
+    """
+    with _instances_lock:
+        current = sum(instance.generation for instance in _instances.values())
+        entries = [(g, paths) for g, paths in _change_log if g > generation]
+    if len(entries) != current - generation or any(paths is None for _, paths in entries):
+        return None
+    result = set()
+    for _, paths in entries:
+        result.update(paths)
+    return result
+
+
+def get_git_file_list(path):
+    """
+    Returns the (shared) GitFileList of the repository containing `path`,
+    or None if the path isn't in a git repository.
+    """
+    git_ignore = gitignore.get_gitignore(path)
+    if git_ignore is None:
+        return None
+    with _instances_lock:
+        instance = _instances.get(git_ignore.repo_root)
+        if instance is None:
+            instance = GitFileList(git_ignore)
+            _instances[git_ignore.repo_root] = instance
+        return instance
+
+
+def get_generation():
+    """
+    Returns a counter that changes whenever the listed files of any
+    known repository have changed.
+    """
+    with _instances_lock:
+        return sum(instance.generation for instance in _instances.values())
+
+
+def notify_changed(path, on_changed=None):
+    """
+    Refreshes the file list in the background if `path` refers to an index
+    file. `on_changed` is called once the listed files have changed.
+    """
+    if os.path.basename(path) != "index":
+        return
+    path = os.path.abspath(path)
+    with _instances_lock:
+        instances = [
+            instance for instance in _instances.values() if instance.index_file == path
+        ]
+    for instance in instances:
+        instance.request_refresh(on_changed)
+
+
+def refresh_all(on_changed=None):
+    """
+    Refreshes the file lists of all known repositories in the background,
+    e.g. after events of the index might have been lost.
+    """
+    with _instances_lock:
+        instances = list(_instances.values())
+    for instance in instances:
+        instance.request_refresh(on_changed)
@@ -0,0 +1,110 @@
+import logging
+import os
+import threading
+
+from . import gitignore
+from .git_files import find_index_file
+from .pipeline import coalesce_events
+
+logger = logging.getLogger(__name__)
+
+
+# Files/directories in the git directory which indicate that git is
+# rewriting the work tree.
+GIT_OPERATION_MARKERS = [
+    "index.lock",
+    "rebase-merge",
+    "rebase-apply",
+    "MERGE_HEAD",
+    "CHERRY_PICK_HEAD",
+    "REVERT_HEAD",
+]
+
+
+class GitOperationMonitor(object):
+    """
+    Holds back events while a git operation (checkout, merge, rebase, ...)
+    is running, so that tasks neither run on a half-updated tree nor get
+    triggered by each of the rewritten files.
+
+    Running operations are detected by the markers git creates in its
+    directory, which is watched (non-recursively) by the watch manager.
+    Events arriving in the meantime are buffered without matching them,
+    and released as a single batch once all markers are gone.
+    """
+
+    MAX_BUFFERED_EVENTS = 100000
+
+    def __init__(self, working_dir):
+        git_ignore = gitignore.get_gitignore(os.path.join(working_dir, ".gitignore"))
+        if git_ignore is not None:
+            self.git_dir = os.path.dirname(find_index_file(git_ignore.repo_root))
+        else:
+            self.git_dir = None
+
+        self.lock = threading.Lock()
+        self.paused = False
+        self.buffered = []
+        self.overflowed = False
+
+    def is_operation_running(self):
+        if self.git_dir is None:
+            return False
+        return any(
+            os.path.lexists(os.path.join(self.git_dir, marker))
+            for marker in GIT_OPERATION_MARKERS
+        )
+
+    def _is_git_dir_event(self, event):
+        return os.path.dirname(os.path.abspath(event.path)) == self.git_dir
+
+    def process(self, events):
+        """
+        Returns (events, overflowed): The events that can be handled now,
+        and whether events had to be dropped in the meantime, which requires
+        a rescan.
+        """
+        if self.git_dir is None:
+            return events, False
+
+        with self.lock:
+            if not self.paused and not any(self._is_git_dir_event(event) for event in events):
+                return events, False
+
+            if self.is_operation_running():
+                if not self.paused:
+                    logger.info("Git operation in progress => holding back events")
+                    self.paused = True
+                if not self.overflowed:
+                    self.buffered.extend(events)
+                    if len(self.buffered) > self.MAX_BUFFERED_EVENTS:
+                        logger.info("Git operation: too many events => rescan afterwards")
+                        self.buffered = []
+                        self.overflowed = True
+                return [], False
+
+            if not self.paused:
+                return events, False
+
+            overflowed = self.overflowed
+            events = coalesce_events(self.buffered + events) if not overflowed else []
+            self.paused = False
+            self.buffered = []
+            self.overflowed = False
+
+        logger.info("Git operation finished => releasing {} events".format(len(events)))
+        # Events of the git directory first, so that e.g. the refresh of
+        # the git file list starts before matching the files of the work tree.
+        events.sort(key=lambda event: not self._is_git_dir_event(event))
+        return events, overflowed
+
+    def defer_overflow(self):
+        """
+        Returns True if a rescan should wait for the running git operation.
+        """
+        with self.lock:
+            if self.paused:
+                self.buffered = []
+                self.overflowed = True
+                return True
+            return False
@@ -0,0 +1,480 @@
+import logging
+import os
+import re
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# -----------------------------------------------------------------------------
+# Pattern compilation
+# -----------------------------------------------------------------------------
+
+POSIX_CLASSES = {
+    "alnum": "a-zA-Z0-9",
+    "alpha": "a-zA-Z",
+    "blank": " \\t",
+    "cntrl": "\\x00-\\x1f\\x7f",
+    "digit": "0-9",
+    "graph": "\\x21-\\x7e",
+    "lower": "a-z",
+    "print": "\\x20-\\x7e",
+    "punct": re.escape("!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~"),
+    "space": " \\t\\n\\r\\f\\v",
+    "upper": "A-Z",
+    "xdigit": "0-9A-Fa-f",
+}
+
+
+def _translate_bracket(pattern, i):
+    """
+    Translates the bracket expression starting at pattern[i] == '['.
+    Returns the regex and the index after the closing bracket, or
+    (None, None) if the bracket expression is malformed (in which
+    case git's wildmatch never matches).
+    """
+    n = len(pattern)
+    j = i + 1
+    negate = False
+    if j < n and pattern[j] in "!^":
+        negate = True
+        j += 1
+    parts = []
+    first = True
+    while j < n:
+        c = pattern[j]
+        if c == "]" and not first:
+            break
+        first = False
+        if c == "\\" and j + 1 < n:
+            c = pattern[j + 1]
+            j += 1
+        elif c == "[" and pattern.startswith("[:", j):
+            k = pattern.find(":]", j + 2)
+            if k != -1:
+                name = pattern[j + 2:k]
+                if name not in POSIX_CLASSES:
+                    return None, None
+                parts.append(POSIX_CLASSES[name])
+                j = k + 2
+                continue
+        if j + 2 < n and pattern[j + 1] == "-" and pattern[j + 2] != "]":
+            hi = pattern[j + 2]
+            j += 3
+            if hi == "\\" and j < n:
+                hi = pattern[j]
+                j += 1
+            parts.append(re.escape(c) + "-" + re.escape(hi))
+            continue
+        parts.append(re.escape(c))
+        j += 1
+    else:
+        return None, None
+
+    body = "".join(parts)
+    if negate:
+        return "[^/" + body + "]", j + 1
+    else:
+        return "(?!/)[" + body + "]", j + 1
+
+
+def translate_pattern(pattern):
+    """
+    Translates a gitignore glob (already stripped from '!', leading and
+    trailing '/') into a regex string following git's wildmatch rules
+    with WM_PATHNAME semantics. Returns None if the pattern can never
+    match.
+    """
+    n = len(pattern)
+    i = 0
+    res = []
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**", i):
+                at_start = i == 0 or pattern[i - 1] == "/"
+                at_end = i + 2 == n or pattern[i + 2] == "/"
+                if at_start and at_end:
+                    if i + 2 == n:
+                        # trailing '**' (or a bare '**') matches everything
+                        res.append(".*")
+                        i += 2
+                    else:
+                        # '**/' matches zero or more directories
+                        res.append("(?:.*/)?")
+                        i += 3
+                    continue
+                while i < n and pattern[i] == "*":
+                    i += 1
+                res.append("[^/]*")
+                continue
+            res.append("[^/]*")
+            i += 1
+        elif c == "?":
+            res.append("[^/]")
+            i += 1
+        elif c == "[":
+            bracket, i = _translate_bracket(pattern, i)
+            if bracket is None:
+                return None
+            res.append(bracket)
+        elif c == "\\":
+            if i + 1 < n:
+                res.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            res.append(re.escape(c))
+            i += 1
+    return "".join(res)
+
+
+def _trim_trailing_spaces(line):
+    end = len(line)
+    while end > 0 and line[end - 1] == " ":
+        num_backslashes = 0
+        k = end - 2
+        while k >= 0 and line[k] == "\\":
+            num_backslashes += 1
+            k -= 1
+        if num_backslashes % 2 == 1:
+            break
+        end -= 1
+    return line[:end]
+
+
+class IgnoreRule(object):
+    def __init__(self, pattern, regex, negated, dir_only, basename_only):
+        self.pattern = pattern
+        self.regex = regex
+        self.negated = negated
+        self.dir_only = dir_only
+        self.basename_only = basename_only
+
+    @staticmethod
+    def parse(line):
+        """
+        Parses a single line of an ignore file. Returns None for blank
+        lines, comments, and patterns that can never match.
+        """
+        line = line.rstrip("\n").rstrip("\r")
+        if line == "" or line.startswith("#"):
+            return None
+        line = _trim_trailing_spaces(line)
+
+        negated = False
+        if line.startswith("!"):
+            negated = True
+            line = line[1:]
+
+        dir_only = False
+        if line.endswith("/"):
+            dir_only = True
+            line = line[:-1]
+
+        if line == "":
+            return None
+
+        basename_only = "/" not in line
+        if line.startswith("/"):
+            line = line[1:]
+
+        regex = translate_pattern(line)
+        if regex is None:
+            return None
+        try:
+            regex = re.compile("^" + regex + "$", re.DOTALL)
+        except re.error:
+            logger.warning("Failed to compile ignore pattern '{}'".format(line))
+            return None
+
+        return IgnoreRule(line, regex, negated, dir_only, basename_only)
+
+    def matches(self, rel_path, basename, is_dir):
+        if self.dir_only and not is_dir:
+            return False
+        if self.basename_only:
+            return self.regex.match(basename) is not None
+        else:
+            return self.regex.match(rel_path) is not None
+
+
+def parse_ignore_file(path):
+    try:
+        with open(path, "rb") as f:
+            content = f.read().decode("utf-8", "replace")
+    except (IOError, OSError):
+        return []
+    if content.startswith(u"\ufeff"):
+        content = content[1:]
+    rules = []
+    for line in content.split("\n"):
+        rule = IgnoreRule.parse(line)
+        if rule is not None:
+            rules.append(rule)
+    return rules
+
+
+# -----------------------------------------------------------------------------
+# Repository level evaluation
+# -----------------------------------------------------------------------------
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def find_repo_root(path):
+    """
+    Returns the work tree root containing `path`, or None if the path
+    is not inside a git repository.
+    """
+    path = os.path.abspath(path)
+    while True:
+        if os.path.exists(os.path.join(path, ".git")):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def find_git_dir(repo_root):
+    """
+    Resolves the (common) git directory, taking into account that `.git`
+    can be a file pointing elsewhere (worktrees, submodules).
+    """
+    dot_git = os.path.join(repo_root, ".git")
+    if os.path.isfile(dot_git):
+        try:
+            with open(dot_git) as f:
+                content = f.read().strip()
+        except (IOError, OSError):
+            return dot_git
+        if content.startswith("gitdir:"):
+            git_dir = os.path.join(repo_root, content[len("gitdir:"):].strip())
+            commondir_file = os.path.join(git_dir, "commondir")
+            if os.path.exists(commondir_file):
+                try:
+                    with open(commondir_file) as f:
+                        git_dir = os.path.join(git_dir, f.read().strip())
+                except (IOError, OSError):
+                    pass
+            return os.path.normpath(git_dir)
+    return dot_git
+
+
+def find_global_excludes_file(repo_root):
+    """
+    Determines the path of `core.excludesFile`. This is the only place
+    where we have to ask git itself, and it happens once per repository.
+    """
+    try:
+        p = subprocess.Popen(
+            ["git", "config", "--get", "core.excludesFile"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=repo_root,
+        )
+        outs, _ = p.communicate()
+        configured = outs.decode("utf-8", "replace").strip()
+    except OSError:
+        configured = ""
+
+    if configured != "":
+        return os.path.expanduser(configured)
+
+    xdg_config_home = os.environ.get("XDG_CONFIG_HOME", "")
+    if xdg_config_home == "":
+        xdg_config_home = os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(xdg_config_home, "git", "ignore")
+
+
+class GitIgnore(object):
+    """
+    In-process evaluation of the gitignore rules of a repository.
+
+    Rules are taken from the `.gitignore` hierarchy, `.git/info/exclude`,
+    and the global excludes file with the same precedence as git. Parsed
+    rules are cached per ignore file and only re-parsed when the file's
+    stat signature changes. Every such change increments `generation`,
+    which allows dependent caches to detect that ignore decisions may
+    have changed.
+
+    Note that, similar to `git check-ignore --no-index`, tracked files
+    are not treated specially.
+    """
+
+    def __init__(self, repo_root):
+        self.repo_root = os.path.abspath(repo_root)
+        self.git_dir = find_git_dir(self.repo_root)
+        self.info_exclude_file = os.path.join(self.git_dir, "info", "exclude")
+        self.global_excludes_file = find_global_excludes_file(self.repo_root)
+
+        self.generation = 0
+        self.lock = threading.RLock()
+
+        # ignore file path => (signature, rules)
+        self._ignore_files = {}
+        # directory (tuple of components) => bool
+        self._dir_decisions = {}
+
+    def is_ignore_file(self, path):
+        path = os.path.abspath(path)
+        return (
+            os.path.basename(path) == ".gitignore" or
+            path == self.info_exclude_file or
+            path == os.path.abspath(self.global_excludes_file)
+        )
+
+    def invalidate(self, path=None):
+        """
+        Drops cached rules of a specific ignore file (or all of them).
+        """
+        with self.lock:
+            if path is None:
+                self._ignore_files.clear()
+            else:
+                self._ignore_files.pop(os.path.abspath(path), None)
+            self._dir_decisions.clear()
+            self.generation += 1
+
+    def _rules(self, path):
+        signature = _file_signature(path)
+        cached = self._ignore_files.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        if cached is not None:
+            logger.info("Ignore file changed: {}".format(path))
+            self._dir_decisions.clear()
+            self.generation += 1
+        rules = parse_ignore_file(path) if signature is not None else []
+        self._ignore_files[path] = (signature, rules)
+        return rules
+
+    def _rule_levels(self, dir_comps):
+        """
+        Returns (base, rules) pairs ordered from highest to lowest precedence
+        applicable to entries in the directory given by `dir_comps`.
+        """
+        levels = []
+        for i in range(len(dir_comps), -1, -1):
+            base_comps = dir_comps[:i]
+            ignore_file = os.path.join(self.repo_root, *(base_comps + (".gitignore",)))
+            levels.append(("/".join(base_comps), self._rules(ignore_file)))
+        levels.append(("", self._rules(self.info_exclude_file)))
+        levels.append(("", self._rules(self.global_excludes_file)))
+        return levels
+
+    def _match(self, comps, is_dir, levels=None):
+        """
+        Returns True (ignored), False (re-included by a negated rule) or
+        None (no rule applies) for the given path components.
+        """
+        if levels is None:
+            levels = self._rule_levels(comps[:-1])
+        rel_path = "/".join(comps)
+        basename = comps[-1]
+        for base, rules in levels:
+            if base != "":
+                sub_path = rel_path[len(base) + 1:]
+            else:
+                sub_path = rel_path
+            for rule in reversed(rules):
+                if rule.matches(sub_path, basename, is_dir):
+                    return not rule.negated
+        return None
+
+    def _is_dir_ignored(self, dir_comps):
+        decision = self._dir_decisions.get(dir_comps)
+        if decision is None:
+            decision = (
+                (len(dir_comps) > 1 and self._is_dir_ignored(dir_comps[:-1])) or
+                self._match(dir_comps, True) is True
+            )
+            self._dir_decisions[dir_comps] = decision
+        return decision
+
+    def to_components(self, path):
+        """
+        Converts a path (absolute or relative to the current directory)
+        into a tuple of components relative to the repository root.
+        Returns None for paths outside of the repository.
+        """
+        rel_path = os.path.relpath(os.path.abspath(path), self.repo_root)
+        if rel_path == os.curdir or rel_path == os.pardir or \
+                rel_path.startswith(os.pardir + os.sep):
+            return None
+        return tuple(rel_path.split(os.sep))
+
+    def is_ignored(self, path, is_dir=None):
+        """
+        Determines if a path is ignored. If `is_dir` is not specified,
+        a trailing separator marks a directory, otherwise the file
+        system is consulted (like git does for directory-only rules).
+        """
+        if is_dir is None:
+            is_dir = path.endswith(os.sep) or os.path.isdir(path)
+        comps = self.to_components(path)
+        if comps is None:
+            return False
+        with self.lock:
+            # Validate all ignore files on the path first, so that a
+            # changed file invalidates cached directory decisions
+            # before they are used.
+            levels = self._rule_levels(comps[:-1])
+            if len(comps) > 1 and self._is_dir_ignored(comps[:-1]):
+                return True
+            return self._match(comps, is_dir, levels) is True
+
+
+_repo_roots = {}
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def get_gitignore(path):
+    """
+    Returns the (shared) GitIgnore instance of the repository containing
+    `path`, or None if the path isn't in a git repository.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with _instances_lock:
+        if directory in _repo_roots:
+            repo_root = _repo_roots[directory]
+        else:
+            repo_root = find_repo_root(directory)
+            _repo_roots[directory] = repo_root
+        if repo_root is None:
+            return None
+        instance = _instances.get(repo_root)
+        if instance is None:
+            instance = GitIgnore(repo_root)
+            _instances[repo_root] = instance
+        return instance
+
+
+def get_generation():
+    """
+    Returns a counter that changes whenever any ignore file of any
+    known repository has changed.
+    """
+    with _instances_lock:
+        return sum(instance.generation for instance in _instances.values())
+
+
+def notify_changed(path):
+    """
+    Invalidates cached rules if `path` refers to an ignore file. Returns
+    True if that was the case.
+    """
+    if os.path.basename(path) not in (".gitignore", "exclude", "ignore"):
+        return False
+    git_ignore = get_gitignore(path)
+    if git_ignore is not None and git_ignore.is_ignore_file(path):
+        git_ignore.invalidate(path)
+        return True
+    return False
@@ -1,139 +1,439 @@
 # *-* encoding: utf-8
-from __future__ import division, print_function
-
+import collections
 import logging
-import datetime
 import os
+import shlex
+import signal
 import sys
 import subprocess
+import tempfile
 import threading
 import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
 
 from .colors import color, FG, BG, Style
-from .config import ConfigError
+from . import scheduler
+from .config import CallableCommand, CommandGroup, ConfigError, DEFAULT_DEBOUNCE
+from .forkserver import ForkServer, ForkServerError
+from .notifications import Notification, NotificationDispatcher, create_backends
+from .result_cache import ResultCache
+from .shell_session import ShellSession, ShellSessionError
+from .trigger import FileEvent
 
 logger = logging.getLogger(__name__)
 
-
-class StoppableThread(threading.Thread):
-    """Thread class with a stop() method. The thread itself has to check
-    regularly for the stopped() condition."""
-
-    def __init__(self):
-        super(StoppableThread, self).__init__()
-        self._stop_event = threading.Event()
-
-    def stop(self):
-        self._stop_event.set()
-
-    def stopped(self):
-        return self._stop_event.is_set()
+# serializes printing of buffered command output
+output_lock = threading.Lock()
 
 
 class Debouncer(object):
+    """
+    Debounces triggers of a task function.
+
+    A single long-lived worker thread waits on a condition variable until
+    the debounce deadline (measured on the monotonic clock) has passed.
+    Every trigger while waiting re-arms the deadline, but the task is
+    never postponed more than `max_wait` seconds after the first trigger
+    of a burst. Triggers during a running task are either queued or
+    discarded.
+
+    In speculative mode the task is started right away on the first
+    trigger. Further triggers within the debounce window cancel it and
+    re-arm as usual, so a single trigger has no debounce latency, while
+    a burst still results in only one completed run.
+    """
+
     def __init__(self):
-        self.lock = threading.Lock()
+        self.condition = threading.Condition()
 
+        # None, "waiting", or "running"
         self.status = None
         self.thread = None
         self.queued = None
+        self.stopped = False
+
         self.trigger_time = None
+        self.first_trigger_time = None
+        # while a speculatively started task runs: end of its debounce window
+        self.speculation_deadline = None
 
-        # We cannot bind func/debounce_time to the thread function,
-        # because otherwise we couldn't update the func anymore during
-        # waiting.
+        # We cannot bind func/debounce_time to the worker, because
+        # otherwise we couldn't update the func anymore during waiting.
         self.func = None
         self.debounce_time = None
-
-    def _thread_func(self):
+        self.max_wait = None
+
+    def _deadline(self):
+        deadline = self.trigger_time + self.debounce_time
+        if self.max_wait is not None:
+            deadline = min(deadline, self.first_trigger_time + self.max_wait)
+        return deadline
+
+    def _wait_for_deadline(self):
+        """
+        Blocks (with condition acquired) until a waiting trigger is due.
+        Returns the function to run, or None if the debouncer was stopped.
+        """
         while True:
-            # Note the sleep based implementation has the drawback that something
-            # like this would behave a bit unexpected:
-            #
-            #     debouncer.trigger(f, 1.0)
-            #     time.sleep(0.001)
-            #     debouncer.trigger(f, 0.001)
-            #
-            # After the first trigger we would sleep for an entire second, and even
-            # though the second trigger updates self.debounce_time, we cannot stop
-            # the ongoing sleep. Do we want to support this?
-            trigger_time_debounced = self.trigger_time + datetime.timedelta(seconds=self.debounce_time)
-            # print("trigger time:           {}".format(self.trigger_time))
-            # print("trigger time debounced: {}".format(trigger_time_debounced))
-            now = datetime.datetime.now()
-            time_to_sleep = (trigger_time_debounced - now).total_seconds()
-            # print("time to sleep: {}".format(time_to_sleep))
-            if time_to_sleep > 0:
-                time.sleep(time_to_sleep)
-            else:
-                break
-        with self.lock:
+            if self.stopped:
+                return None
+            if self.status != "waiting":
+                self.condition.wait()
+                continue
+            time_to_wait = self._deadline() - time.monotonic()
+            if time_to_wait > 0:
+                self.condition.wait(time_to_wait)
+                continue
             self.status = "running"
-        logger.info(u"Task [---]: debounce wait finished, starting task")
-        self.func()
-        logger.info("Task [▴▴▴]: finished")
-        with self.lock:
-            if self.queued is None:
-                self.status = None
-                self.thread = None
-            else:
-                logger.info("Task [▾▾▾]: starting thread (from queued trigger)")
-                # unwrap / unset queued args
-                (func, debounce_time) = self.queued
-                self.queued = None
-                # update trigger
-                self.trigger_time = datetime.datetime.now()
-                # update args
-                self.func = func
-                self.debounce_time = debounce_time
-                # change status
-                self.status = "waiting"
-                self.thread = self._start_thread()
-
-    def trigger(self, func, debounce_time, enqueue):
-        with self.lock:
+            return self.func
+
+    def _worker_func(self):
+        while True:
+            with self.condition:
+                func = self._wait_for_deadline()
+            if func is None:
+                return
+
+            logger.info(u"Task [---]: debounce wait finished, starting task")
+            try:
+                func()
+            except Exception:
+                logger.exception("Task [!!!]: task raised exception")
+            logger.info(u"Task [▴▴▴]: finished")
+
+            with self.condition:
+                self.speculation_deadline = None
+                if self.queued is None:
+                    self.status = None
+                else:
+                    logger.info(u"Task [▾▾▾]: re-arming (from queued trigger)")
+                    (func, debounce_time, max_wait) = self.queued
+                    self.queued = None
+                    self._arm(func, debounce_time, max_wait, new_burst=True)
+                self.condition.notify_all()
+
+    def _arm(self, func, debounce_time, max_wait, new_burst):
+        now = time.monotonic()
+        self.trigger_time = now
+        if new_burst:
+            self.first_trigger_time = now
+        self.func = func
+        self.debounce_time = debounce_time
+        self.max_wait = max_wait
+        self.status = "waiting"
+
+    def trigger(self, func, debounce_time, enqueue, max_wait=None, cancel_running=None,
+                speculative=None):
+        """
+        Triggers `func` after `debounce_time`. If the task is running,
+        the trigger is queued if `enqueue` is set, otherwise discarded.
+        If `cancel_running` is specified, the trigger is queued and the
+        running task is cancelled by calling it. If `speculative` is
+        specified (a function cancelling the running task), an idle task
+        is started immediately, and cancelled by calling `speculative` if
+        another trigger arrives within `debounce_time`.
+        """
+        cancel = None
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._worker_func)
+                self.thread.daemon = True
+                self.thread.start()
+
+            now = time.monotonic()
             if self.status is None:
-                logger.info(u"Task [▾▾▾]: starting thread")
-                # update trigger
-                self.trigger_time = datetime.datetime.now()
-                # update args
-                self.func = func
-                self.debounce_time = debounce_time
-                # change status
-                self.status = "waiting"
-                self.thread = self._start_thread()
+                if speculative is not None:
+                    logger.info(u"Task [▾▾▾]: arming (speculative start)")
+                    self._arm(func, 0.0, max_wait, new_burst=True)
+                    self.speculation_deadline = now + debounce_time
+                else:
+                    logger.info(u"Task [▾▾▾]: arming")
+                    self._arm(func, debounce_time, max_wait, new_burst=True)
             elif self.status == "waiting":
                 logger.info(u"Task [---]: debouncing event")
-                # update trigger
-                self.trigger_time = datetime.datetime.now()
-                # update args
-                self.func = func
-                self.debounce_time = debounce_time
-                # no status change
+                self._arm(func, debounce_time, max_wait, new_burst=False)
             elif self.status == "running":
                 # update args (delayed)
-                if enqueue:
-                    self.queued = (func, debounce_time)
-                    logger.info("Task [---]: still in progress => queuing trigger")
+                if speculative is not None and self.speculation_deadline is not None and \
+                        now < self.speculation_deadline:
+                    self.queued = (func, debounce_time, max_wait)
+                    self.speculation_deadline = None
+                    logger.info(u"Task [xxx]: burst during speculative start => cancelling")
+                    cancel = speculative
+                elif cancel_running is not None:
+                    self.queued = (func, debounce_time, max_wait)
+                    logger.info(u"Task [xxx]: still in progress => cancelling and restarting")
+                    cancel = cancel_running
+                elif enqueue:
+                    self.queued = (func, debounce_time, max_wait)
+                    logger.info(u"Task [---]: still in progress => queuing trigger")
+                else:
+                    logger.info(u"Task [---]: still in progress => discarding trigger")
+            # wake up the worker, so it can re-compute its deadline
+            self.condition.notify_all()
+
+        if cancel is not None:
+            cancel()
+
+    def cancel(self):
+        """
+        Cancels a waiting or queued trigger (not a running task).
+        Returns True if anything was cancelled.
+        """
+        with self.condition:
+            cancelled = self.queued is not None or self.status == "waiting"
+            self.queued = None
+            if self.status == "waiting":
+                self.status = None
+            self.condition.notify_all()
+            if cancelled:
+                logger.info(u"Task [xxx]: trigger cancelled")
+            return cancelled
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """
+        Waits until neither a trigger is pending nor a task is running.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.status is not None:
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+            return True
+
+
+class AdaptiveDebounce(object):
+    """
+    Learns the debounce interval from the gaps between triggers.
+
+    Triggers separated by less than `max_time` are considered to belong
+    to the same burst (e.g. an editor writing a temp file, renaming it,
+    and updating its metadata). The interval is chosen as the smallest
+    window that would have merged each of the recent bursts into a
+    single run (plus a safety margin), clamped to [min_time, max_time].
+    """
+
+    HISTORY = 10
+    MARGIN = 1.25
+
+    def __init__(self, min_time, max_time, initial=DEFAULT_DEBOUNCE):
+        self.lock = threading.Lock()
+        self.min_time = min_time
+        self.max_time = max_time
+        # largest gap within each of the recent (completed) bursts
+        self.burst_gaps = collections.deque(maxlen=self.HISTORY)
+        self.current_gap = None
+        self.last_trigger_time = None
+        self.value = self._clamp(initial)
+
+    def _clamp(self, value):
+        return min(max(value, self.min_time), self.max_time)
+
+    def record(self, now=None):
+        """
+        Records a trigger and returns the debounce interval to use.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if self.last_trigger_time is not None:
+                gap = now - self.last_trigger_time
+                if gap < self.max_time:
+                    self.current_gap = max(self.current_gap or 0.0, gap)
                 else:
-                    logger.info("Task [---]: still in progress => discarding trigger")
+                    if self.current_gap is not None:
+                        self.burst_gaps.append(self.current_gap)
+                    self.current_gap = None
+            self.last_trigger_time = now
+
+            gaps = list(self.burst_gaps)
+            if self.current_gap is not None:
+                gaps.append(self.current_gap)
+            if len(gaps) > 0:
+                value = self._clamp(max(gaps) * self.MARGIN)
+                if value != self.value:
+                    logger.info(u"Task [~~~]: adaptive debounce interval {:.3f} sec".format(value))
+                    self.value = value
+            return self.value
+
+
+def popen_isolated_kwargs():
+    """
+    Popen arguments to start a process in its own process group, which
+    allows to terminate it including all its children.
+    """
+    if os.name == "nt":
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        return {"start_new_session": True}
 
-    def _start_thread(self):
-        thread = threading.Thread(target=self._thread_func)
-        thread.start()
-        return thread
+
+def kill_process_group(proc, grace_period):
+    """
+    Terminates the process group of a process started with
+    `popen_isolated_kwargs` gracefully, and kills it if it is still
+    alive after the grace period.
+    """
+    if proc.poll() is not None:
+        return
+    try:
+        if os.name == "nt":
+            proc.send_signal(signal.CTRL_BREAK_EVENT)
+        else:
+            os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        # not a process group leader => fall back to the process itself
+        proc.terminate()
+    try:
+        proc.wait(timeout=grace_period)
+        return
+    except subprocess.TimeoutExpired:
+        pass
+    logger.info("Process {} did not terminate => killing".format(proc.pid))
+    try:
+        if os.name == "nt":
+            subprocess.call(["taskkill", "/F", "/T", "/PID", str(proc.pid)])
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        proc.kill()
+
+
+class ChangeSet(object):
+    """
+    Ordered, deduplicated set of changed file paths.
+    """
+
+    def __init__(self, paths=()):
+        self._paths = dict.fromkeys(paths)
+
+    def add(self, path):
+        self._paths[path] = None
+
+    def update(self, other):
+        self._paths.update(other._paths)
+
+    @property
+    def paths(self):
+        return list(self._paths.keys())
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __str__(self):
+        max_paths = 5
+        paths = self.paths
+        s = ", ".join(paths[:max_paths])
+        if len(paths) > max_paths:
+            s += " (+{} more)".format(len(paths) - max_paths)
+        return s
+
+
+def quote_path(path):
+    if os.name == "nt":
+        return subprocess.list2cmdline([path])
+    else:
+        return shlex.quote(path)
+
+
+class CommandEnvironment(object):
+    """
+    Makes a change set available to commands:
+
+    - `{changed_files}` in a command is substituted by the quoted paths.
+    - `{changed_files_list}` is substituted by the path of a temporary
+      file containing the NUL-separated paths (also available via the
+      `WATCHCODE_CHANGED_FILES_LIST` env variable).
+    - The `WATCHCODE_CHANGED_FILES` env variable contains the newline
+      separated paths, unless the change set is too large for the
+      environment, in which case only the list file is available.
+
+    Only files that still exist are included, deleted (or moved away)
+    files would make e.g. `flake8 {changed_files}` fail.
+    """
+
+    MAX_ENV_SIZE = 64 * 1024
+
+    def __init__(self, changes, working_dir="."):
+        self.changes = [
+            path for path in changes if os.path.exists(os.path.join(working_dir, path))
+        ]
+        self.list_file = None
+
+    def __enter__(self):
+        fd, self.list_file = tempfile.mkstemp(prefix="watchcode_changes_", suffix=".txt")
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"".join(path.encode("utf-8") + b"\0" for path in self.changes))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            os.remove(self.list_file)
+        except OSError:
+            pass
+
+    def render(self, command):
+        if "{changed_files}" in command:
+            command = command.replace(
+                "{changed_files}", " ".join(quote_path(path) for path in self.changes)
+            )
+        return command.replace("{changed_files_list}", quote_path(self.list_file))
+
+    @property
+    def env(self):
+        env = dict(os.environ)
+        env["WATCHCODE_CHANGED_FILES_LIST"] = self.list_file
+        changed_files = "\n".join(self.changes)
+        if len(changed_files) <= self.MAX_ENV_SIZE:
+            env["WATCHCODE_CHANGED_FILES"] = changed_files
+        else:
+            logger.info("Change set too large for WATCHCODE_CHANGED_FILES")
+            env.pop("WATCHCODE_CHANGED_FILES", None)
+        return env
 
 
 class ExecInfo(object):
-    def __init__(self, command, runtime, retcode):
+    def __init__(self, command, runtime, retcode, parallel=False, cached=False):
         self.command = command
         self.runtime = runtime
         self.retcode = retcode
+        # whether the command ran as part of a parallel group
+        self.parallel = parallel
+        # whether the result is reported from the result cache
+        self.cached = cached
+
+
+def write_output(output):
+    """
+    Writes the (bytes) output of a command to stdout.
+    """
+    sys.stdout.flush()
+    if hasattr(sys.stdout, "buffer"):
+        sys.stdout.buffer.write(output)
+    else:
+        sys.stdout.write(output.decode("utf-8", "replace"))
+    sys.stdout.flush()
 
 
 class LaunchInfo(object):
-    def __init__(self, old_config, trigger, config_factory, on_task_finished):
+    def __init__(self, old_config, task_name, trigger, config_factory, on_task_finished):
         self.old_config = old_config
+        self.task_name = task_name
         self.trigger = trigger
         self.config_factory = config_factory
         self.on_task_finished = on_task_finished
@@ -142,27 +442,425 @@ class LaunchInfo(object):
 class IOHandler(object):
     """
     Helper class to handle asynchronous IO (running tasks, logging, event queuing).
+    Each group of tasks connected by dependencies has its own IOHandler, i.e.,
+    its own debouncer and execution slot.
     """
 
-    def __init__(self, working_dir):
+    KILL_GRACE_PERIOD = 3.0
+
+    def __init__(self, working_dir, dispatcher=None):
         self.working_dir = working_dir
         self.debouncer = Debouncer()
+        # notifications are delivered asynchronously, possibly shared
+        self.owns_dispatcher = dispatcher is None
+        self.dispatcher = dispatcher if dispatcher is not None else NotificationDispatcher()
+
+        self.lock = threading.Lock()
+        self.procs = set()
+        self.cancelled = threading.Event()
+
+        # changes and triggered tasks collected for the next run
+        self.pending_changes = ChangeSet()
+        self.pending_tasks = set()
+        # task name => whether its last run succeeded
+        self.results = {}
+        # task name => AdaptiveDebounce
+        self.adaptive_debounces = {}
+        self.result_cache = ResultCache(working_dir)
+        # task name => (key, ForkServer or ShellSession) of tasks using such a runner
+        self.runners = {}
+
+    def _collect_change(self, trigger):
+        if isinstance(trigger, FileEvent) and not trigger.is_dir:
+            path = os.path.relpath(trigger.path, self.working_dir)
+            with self.lock:
+                self.pending_changes.add(path)
+
+    def _take_changes(self):
+        with self.lock:
+            changes = self.pending_changes
+            self.pending_changes = ChangeSet()
+            task_names = self.pending_tasks
+            self.pending_tasks = set()
+        return changes, task_names
+
+    def _return_changes(self, changes, task_names):
+        """
+        Puts changes of an unfinished run back, so that they get
+        processed by the next run.
+        """
+        with self.lock:
+            changes.update(self.pending_changes)
+            self.pending_changes = changes
+            self.pending_tasks.update(task_names)
+
+    def is_settled(self):
+        """
+        Whether neither a run is pending nor in progress.
+        """
+        with self.lock:
+            return len(self.pending_tasks) == 0 and self.debouncer.status is None
+
+    def settled_results(self):
+        """
+        Returns the results of the last runs, or an empty dict if a run is
+        pending or in progress, i.e., if the results might be outdated.
+        """
+        with self.lock:
+            if len(self.pending_tasks) > 0 or self.debouncer.status is not None:
+                return {}
+            return dict(self.results)
 
     def trigger(self, launch_info):
+        self._collect_change(launch_info.trigger)
+        with self.lock:
+            self.pending_tasks.add(launch_info.task_name)
+        task = launch_info.old_config.tasks[launch_info.task_name]
+        self._prepare_runners(launch_info.task_name, task, launch_info.trigger)
         self.debouncer.trigger(
             lambda: self._run_task(launch_info),
-            0.2,    # TODO make configurable
-            launch_info.old_config.task.queue_events,
+            self._debounce_time(launch_info.task_name, task),
+            task.on_busy == "queue",
+            max_wait=task.debounce_max_wait,
+            cancel_running=self.cancel_running if task.on_busy == "restart" else None,
+            speculative=self.cancel_running if task.speculative else None,
         )
 
-    def _run_task(self, launch_info):
+    def _debounce_time(self, task_name, task):
+        if task.debounce != "adaptive":
+            return task.debounce
+        with self.lock:
+            adaptive = self.adaptive_debounces.get(task_name)
+            bounds = (task.debounce_min, task.debounce_max)
+            if adaptive is None or (adaptive.min_time, adaptive.max_time) != bounds:
+                adaptive = AdaptiveDebounce(*bounds)
+                self.adaptive_debounces[task_name] = adaptive
+        return adaptive.record()
+
+    def cancel_running(self):
+        """
+        Cancels the running task by killing its processes in the background.
+        """
+        with self.lock:
+            if self.cancelled.is_set():
+                return
+            self.cancelled.set()
+            procs = list(self.procs)
+        for proc in procs:
+            thread = threading.Thread(
+                target=kill_process_group,
+                args=(proc, self.KILL_GRACE_PERIOD),
+            )
+            thread.daemon = True
+            thread.start()
+
+    def _runner(self, task_name, task):
+        """
+        Returns the ForkServer or ShellSession of a task, or None if the task
+        uses the plain shell runner (or the platform doesn't support its runner).
+        """
+        if task.runner == "python-forkserver" and hasattr(os, "fork"):
+            key = (task.runner, tuple(task.preload))
+        elif task.runner == "shell-session" and os.name != "nt":
+            key = (task.runner, tuple(task.setup))
+        else:
+            return None
+        with self.lock:
+            current = self.runners.get(task_name)
+            if current is not None and current[0] != key:
+                current[1].stop()
+                current = None
+            if current is None:
+                if task.runner == "python-forkserver":
+                    runner = ForkServer(self.working_dir, task.preload)
+                else:
+                    runner = ShellSession(self.working_dir, task.setup)
+                current = (key, runner)
+                self.runners[task_name] = current
+        return current[1]
+
+    def _prune_runners(self, config):
+        """
+        Stops the runners of tasks which are no longer active.
+        """
+        with self.lock:
+            removed = [name for name in self.runners if name not in config.active_tasks]
+            runners = [self.runners.pop(name)[1] for name in removed]
+        for runner in runners:
+            runner.stop()
+
+    def stop(self):
+        """
+        Discards pending triggers, stops the runners (fork servers and
+        shell sessions) in the background, and shuts down worker threads.
+        """
+        self.debouncer.stop()
+        with self.lock:
+            runners = [runner for _, runner in self.runners.values()]
+            self.runners = {}
+        for runner in runners:
+            runner.stop()
+        self.result_cache.close()
+        if self.owns_dispatcher:
+            self.dispatcher.stop()
+
+    def _prepare_runners(self, task_name, task, trigger):
+        """
+        Warms up the runner of a task while debouncing, and re-warms fork
+        servers which preloaded a changed file.
+        """
+        runner = self._runner(task_name, task)
+        if runner is not None:
+            try:
+                runner.warm()
+            except (ForkServerError, ShellSessionError) as e:
+                logger.warning("Failed to start runner: {}".format(e))
+        if isinstance(trigger, FileEvent) and not trigger.is_dir:
+            with self.lock:
+                forkservers = [
+                    runner for _, runner in self.runners.values() if isinstance(runner, ForkServer)
+                ]
+            for forkserver in forkservers:
+                forkserver.notify_changed([os.path.abspath(trigger.path)])
+
+    def _run_in_runner(self, runner, command, env):
+        """
+        Runs a command by a ForkServer or ShellSession, registering the
+        process handle it reports, so that it can be cancelled.
+        """
+        with self.lock:
+            if self.cancelled.is_set():
+                return None
+        children = []
+
+        def on_started(child):
+            with self.lock:
+                children.append(child)
+                self.procs.add(child)
+                cancelled = self.cancelled.is_set()
+            if cancelled:
+                thread = threading.Thread(
+                    target=kill_process_group,
+                    args=(child, self.KILL_GRACE_PERIOD),
+                )
+                thread.daemon = True
+                thread.start()
+
+        try:
+            return runner.run(command, env if env is not None else dict(os.environ), on_started)
+        finally:
+            with self.lock:
+                for child in children:
+                    self.procs.discard(child)
+
+    def _run_command(self, command, isolated, env=None, capture=False, runner=None):
+        """
+        Runs a command and returns (retcode, output). The output is only
+        captured (stdout and stderr combined) if requested, otherwise the
+        command writes directly to the terminal and output is None.
+        Commands accepted by the runner (ForkServer or ShellSession), if
+        given, are run by it.
+        """
+        if runner is not None and not capture and runner.accepts(command):
+            try:
+                return self._run_in_runner(runner, command, env), None
+            except (ForkServerError, ShellSessionError) as e:
+                print(" * Runner '{}' not available ({}) => running in a shell".format(
+                    type(runner).__name__, e,
+                ))
+                sys.stdout.flush()
+
+        with self.lock:
+            if self.cancelled.is_set():
+                return None, None
+            kwargs = popen_isolated_kwargs() if isolated else {}
+            if capture:
+                kwargs.update(stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            proc = subprocess.Popen(command, shell=True, cwd=self.working_dir, env=env, **kwargs)
+            self.procs.add(proc)
+        try:
+            output, _ = proc.communicate()
+            return proc.returncode, output
+        finally:
+            with self.lock:
+                self.procs.discard(proc)
+
+    def _run_command_group(self, group, prefix, isolated, env, render):
+        """
+        Runs the commands of a parallel group. The output of each command is
+        buffered and printed as a whole once the command has finished.
+        """
+        print(" * {}Running in parallel (max. {}):\n{}\n".format(
+            prefix,
+            group.max_parallel,
+            "\n".join("   {}{}{}".format(
+                color(FG.blue, style=Style.bold), command, color()
+            ) for command in group.commands),
+        ))
+        sys.stdout.flush()
+
+        def run(command):
+            t1 = time.time()
+            retcode, output = self._run_command(render(command), isolated, env, capture=True)
+            t2 = time.time()
+            if output is not None:
+                with output_lock:
+                    print(" * {}Output of: {}{}{}\n".format(
+                        prefix,
+                        color(FG.blue, style=Style.bold),
+                        command,
+                        color(),
+                    ))
+                    write_output(output)
+                    print("")
+            return ExecInfo(command, t2 - t1, retcode, parallel=True)
+
+        with ThreadPoolExecutor(max_workers=group.max_parallel) as pool:
+            return list(pool.map(run, group.commands))
+
+    def _tasks_to_run(self, config, task_names):
+        """
+        Determines the tasks affected by a trigger of `task_names`: the
+        triggered tasks, everything downstream of them, and dependencies
+        which have to be re-run because they never succeeded. Results of
+        successful dependencies are reused.
+        """
+        graph = config.graph
+        active_tasks = config.active_tasks
+        affected = graph.downstream(task_names & set(active_tasks)) & set(active_tasks)
+        scope = graph.upstream(affected)
+        with self.lock:
+            outdated = affected | {name for name in scope if not self.results.get(name)}
+        return graph.downstream(outdated) & scope
+
+    @staticmethod
+    def _command_templates(commands):
+        """
+        The (unrendered) commands as part of the cache key. Rendering would
+        make the key differ on every run, e.g. `{changed_files_list}` is a
+        new temporary file each time. The inputs are covered by the digests
+        of the files.
+        """
+        return [
+            {"parallel": command.commands, "max_parallel": command.max_parallel}
+            if isinstance(command, CommandGroup) else
+            {"callable": str(command)} if isinstance(command, CallableCommand) else command
+            for command in commands
+        ]
+
+    def _lookup_cached_result(self, task_name, task, prefix):
+        """
+        Returns (cache_key, exec_infos), where exec_infos is None on a cache miss.
+        """
+        cache_key = self.result_cache.input_key(
+            task_name, task.fileset, self._command_templates(task.commands),
+        )
+        results = self.result_cache.lookup(task_name, cache_key)
+        if results is None:
+            return cache_key, None
+        print(" * {}Inputs match a previous successful run => {}using cached result{}".format(
+            prefix, color(FG.green), color(),
+        ))
+        exec_infos = [
+            ExecInfo(command, runtime, retcode, parallel=parallel, cached=True)
+            for command, runtime, retcode, parallel in results
+        ]
+        return cache_key, exec_infos
+
+    def _run_callable(self, command, changes):
+        """
+        Calls a CallableCommand in-process with the list of changed files.
+        Returns its exit code: None and True map to 0, False to 1, and an
+        int is returned as it is. An exception is printed and maps to 1.
+        The call cannot be interrupted, cancelling waits for it to return.
+        """
+        with self.lock:
+            if self.cancelled.is_set():
+                return None
+        try:
+            result = command.func(list(changes))
+        except Exception:
+            traceback.print_exc()
+            return 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        if result is None or result is True:
+            return 0
+        if result is False:
+            return 1
+        if isinstance(result, int):
+            return result
+        logger.warning("Callable {} returned {!r}, expected None, bool or int".format(command, result))
+        return 0
+
+    def _run_single_task(self, task_name, task, prefix, env, render, changes=()):
+        """
+        Runs the commands of a task. Returns (status, exec_infos, wall_clock).
+        """
+        t_start = time.time()
+        cache_key = None
+        if task.cache_results:
+            cache_key, exec_infos = self._lookup_cached_result(task_name, task, prefix)
+            if exec_infos is not None:
+                return scheduler.SUCCESS, exec_infos, time.time() - t_start
+
         exec_infos = []
+        # processes that may get cancelled have to run in their own process group
+        isolated = task.on_busy == "restart" or task.speculative
+        runner = self._runner(task_name, task)
+        for command in task.commands:
+            if isinstance(command, CommandGroup):
+                group_exec_infos = self._run_command_group(command, prefix, isolated, env, render)
+                if self.cancelled.is_set():
+                    return scheduler.CANCELLED, exec_infos, time.time() - t_start
+                exec_infos.extend(group_exec_infos)
+                continue
+
+            # additional newline to separate from task output
+            print(" * {}Running: {}{}{}\n".format(
+                prefix,
+                color(FG.blue, style=Style.bold),
+                command,
+                color()
+            ))
+            sys.stdout.flush()
+
+            t1 = time.time()
+            if isinstance(command, CallableCommand):
+                retcode = self._run_callable(command, changes)
+            else:
+                retcode, _ = self._run_command(render(command), isolated, env, runner=runner)
+            t2 = time.time()
+            if self.cancelled.is_set():
+                return scheduler.CANCELLED, exec_infos, time.time() - t_start
+            exec_infos.append(ExecInfo(command, t2 - t1, retcode))
+        success = all(exec_info.retcode == 0 for exec_info in exec_infos)
+        if success and cache_key is not None:
+            self.result_cache.store(task_name, cache_key, [
+                (str(e.command), e.runtime, e.retcode, e.parallel) for e in exec_infos
+            ])
+        status = scheduler.SUCCESS if success else scheduler.FAILURE
+        return status, exec_infos, time.time() - t_start
+
+    def _run_task(self, launch_info):
         old_config = launch_info.old_config
 
-        if old_config.task.clear_screen:
+        # With several tasks running side by side, clearing the screen
+        # would wipe the output of the others.
+        if not old_config.all_tasks and old_config.task.clear_screen:
             self._clear_screen()
 
         print(" * Trigger: {}".format(launch_info.trigger))
+        # If a trigger got queued right after the debouncer started this run,
+        # a cancellation (restart or speculative) targets this run and must
+        # not get lost.
+        if self.debouncer.queued is None:
+            self.cancelled.clear()
+
+        changes, task_names = self._take_changes()
+        if len(changes) > 0:
+            print(" * Changed files: {}".format(changes))
 
         try:
             config = launch_info.config_factory.load_config()
@@ -172,45 +870,92 @@ class IOHandler(object):
                 color(),
                 e,
             ))
+            self._return_changes(changes, task_names)
             # Note: No config available, fallback to old config...
-            if old_config.sound:
-                self._notify_sound(success=False)
-            if old_config.notifications:
-                messages = ["Error reloading config:\n{}".format(e)]
-                self._notify_display(success=False, messages=messages)
+            self._notify(old_config, False, ["Error reloading config:\n{}".format(e)])
             return
 
-        for command in config.task.commands:
-            # additional newline to separate from task output
-            print(" * Running: {}{}{}\n".format(
-                color(FG.blue, style=Style.bold),
-                command,
-                color()
-            ))
+        self._prune_runners(config)
+        to_run = self._tasks_to_run(config, task_names)
+        if len(to_run) == 0:
+            print(" * Task is no longer active")
+            launch_info.on_task_finished(config)
+            return
+
+        # output of several tasks has to be distinguishable
+        show_names = len(config.active_tasks) > 1
+        exec_infos = {}
+        wall_clocks = {}
+        # task name => exception raised while running it
+        errors = {}
+
+        t_start = time.time()
+        with CommandEnvironment(changes, self.working_dir) as command_env:
+
+            def run_task(name):
+                prefix = "[{}] ".format(name) if show_names else ""
+                try:
+                    status, exec_infos[name], wall_clocks[name] = self._run_single_task(
+                        name, config.tasks[name], prefix, command_env.env, command_env.render,
+                        changes.paths,
+                    )
+                except Exception as e:
+                    logger.exception("Error running task '{}'".format(name))
+                    errors[name] = e
+                    return scheduler.FAILURE
+                return status
+
+            statuses = scheduler.run_graph(config.graph, to_run, run_task, config.max_workers)
+        wall_clock = time.time() - t_start
+
+        if self.cancelled.is_set():
+            self._return_changes(changes, task_names)
+            print("\n * {}Task cancelled{} => restarting".format(color(FG.yellow), color()))
             sys.stdout.flush()
+            launch_info.on_task_finished(config)
+            return
 
-            t1 = time.time()
-            proc = subprocess.Popen(command, shell=True, cwd=self.working_dir)
-            retcode = proc.wait()
-            t2 = time.time()
-            exec_infos.append(ExecInfo(command, t2 - t1, retcode))
+        with self.lock:
+            for name, status in statuses.items():
+                self.results[name] = status == scheduler.SUCCESS
 
-        success = self._report_task_result(exec_infos)
-        if config.sound:
-            self._notify_sound(success)
-        if config.notifications:
-            messages = [
-                "'{}' took {:.1f} sec and returned {}.".format(e.command, e.runtime, e.retcode)
-                for e in exec_infos
-            ]
-            self._notify_display(success, messages)
+        success = True
+        for name in config.graph.topological_order(to_run):
+            prefix = "[{}] ".format(name) if show_names else ""
+            if statuses[name] == scheduler.SKIPPED:
+                print("\n * {}{}Task skipped{} because a dependency failed.".format(
+                    prefix, color(FG.yellow), color(),
+                ))
+                success = False
+            elif name not in exec_infos:
+                print("\n * {}{}Task failed{} with an error: {}".format(
+                    prefix, color(FG.red), color(), errors.get(name, "unknown error"),
+                ))
+                success = False
+            elif not self._report_task_result(exec_infos[name], prefix, wall_clocks.get(name, 0.0)):
+                success = False
+        if len(to_run) > 1:
+            print(" * Total wall clock time: {}{:.1f}{} sec.".format(
+                color(FG.yellow, style=Style.bold), wall_clock, color(),
+            ))
+        print(" * Monitoring '{}' for changes... [Press <CTRL>+C to exit]".format(self.working_dir))
+        sys.stdout.flush()
+
+        messages = [
+            "'{}' took {:.1f} sec and returned {}.".format(e.command, e.runtime, e.retcode)
+            for name in config.graph.topological_order(to_run)
+            for e in exec_infos.get(name, [])
+        ] + [
+            "'{}' failed with an error: {}".format(name, error) for name, error in errors.items()
+        ]
+        self._notify(config, success, messages)
 
         # Return re-loaded config to monitoring thread
         launch_info.on_task_finished(config)
 
-    def _report_task_result(self, exec_infos):
+    def _report_task_result(self, exec_infos, prefix="", wall_clock=None):
         # additional newline to separate from task output
-        print("\n * Task summary:")
+        print("\n * {}Task summary:".format(prefix))
         success = True
         for exec_info in exec_infos:
             if exec_info.retcode == 0:
@@ -218,7 +963,9 @@ class IOHandler(object):
             else:
                 return_color = FG.red
                 success = False
-            print("   {}{}{} took {}{:.1f}{} sec and returned {}{}{}.".format(
+            print("   {}{}{}{}{} took {}{:.1f}{} sec and returned {}{}{}.".format(
+                "(cached) " if exec_info.cached else "",
+                "(parallel) " if exec_info.parallel else "",
                 color(FG.blue, style=Style.bold),
                 exec_info.command,
                 color(),
@@ -229,44 +976,19 @@ class IOHandler(object):
                 exec_info.retcode,
                 color(),
             ))
-        print(" * Monitoring '{}' for changes... [Press <CTRL>+C to exit]".format(self.working_dir))
+        if wall_clock is not None and len(exec_infos) > 1:
+            print("   Wall clock time: {}{:.1f}{} sec (sum of runtimes: {:.1f} sec).".format(
+                color(FG.yellow, style=Style.bold),
+                wall_clock,
+                color(),
+                sum(exec_info.runtime for exec_info in exec_infos),
+            ))
         sys.stdout.flush()
         return success
 
-    @staticmethod
-    def _notify_sound(success):
-        # TODO: make configurable
-        file_positive = "456581__bumpelsnake__nameit5.wav"
-        file_negative = "377017__elmasmalo1__notification-pop.wav"
-        if success:
-            snd_file = os.path.join(os.path.dirname(__file__), "sounds", file_positive)
-        else:
-            snd_file = os.path.join(os.path.dirname(__file__), "sounds", file_negative)
-        try:
-            p = subprocess.Popen(
-                ["ffplay", "-nodisp", "-autoexit", "-hide_banner", snd_file],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            p.wait()
-        except Exception as e:
-            print(" * Failed to play sound notification:\n{}".format(e))
-
-    @staticmethod
-    def _notify_display(success, messages):
-        if success:
-            title = "SUCCESS"
-        else:
-            title = "FAILURE"
-        try:
-            p = subprocess.Popen(
-                ["notify-send", title, "\n".join(messages)],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            p.wait()
-        except Exception as e:
-            print(" * Failed to send notification:\n{}".format(e))
+    def _notify(self, config, success, messages):
+        # runs of this group of tasks supersede each other, other groups' don't
+        self.dispatcher.notify(Notification(success, messages, create_backends(config), source=self))
 
     @staticmethod
     def _clear_screen():
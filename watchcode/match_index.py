@@ -0,0 +1,193 @@
+import collections
+import logging
+import os
+import threading
+
+from . import git_files, gitignore
+from .matching import accepts_event, does_match, is_excluded_subtree
+from .trigger import FileEvent
+from .walk import walk_tree
+
+logger = logging.getLogger(__name__)
+
+
+class MatchIndex(object):
+    """
+    Cache of the match decisions of a fileset, keyed by normalized path.
+
+    A match decision only depends on the path, the fileset, and the
+    gitignore rules (or git's file list). The index is therefore populated
+    eagerly by walking the tree, and afterwards kept up-to-date
+    incrementally: Paths are added on first sight (e.g. created/moved_to
+    events) and dropped on deleted/moved_from events. Changing the fileset
+    or any ignore file invalidates the index. Changes of the listed files
+    only drop the decisions of the affected paths if these are known. Event types
+    are filtered before the lookup. The number of entries is bounded by
+    evicting the least recently used decisions.
+    """
+
+    DEFAULT_MAX_ENTRIES = 250000
+
+    def __init__(self, fileset, max_entries=DEFAULT_MAX_ENTRIES):
+        self.lock = threading.Lock()
+        self.fileset = fileset
+        self.max_entries = max_entries
+        self._decisions = collections.OrderedDict()
+        self._generation = self._current_generation()
+        # incremented on every invalidation, used to discard stale walks
+        self._epoch = 0
+
+    @staticmethod
+    def key(path, is_dir):
+        key = os.path.normpath(path)
+        if is_dir:
+            key += os.sep
+        return key
+
+    def __len__(self):
+        return len(self._decisions)
+
+    def _invalidate(self):
+        self._decisions.clear()
+        self._epoch += 1
+
+    def _current_generation(self):
+        # (generation of everything but git's file list, generation of the file list)
+        matcher = self.fileset.matcher
+        if matcher.uses_git_file_list:
+            file_list_generation = git_files.get_generation()
+            other = matcher.generation() - file_list_generation
+        else:
+            file_list_generation = None
+            other = matcher.generation()
+        return (
+            (gitignore.get_generation() if self.fileset.exclude_gitignore else None, other),
+            file_list_generation,
+        )
+
+    def _check_generation(self):
+        generation = self._current_generation()
+        if generation == self._generation:
+            return
+        old_generation = self._generation
+        self._generation = generation
+        if generation[0] == old_generation[0]:
+            changed_paths = git_files.changes_since(old_generation[1])
+            if changed_paths is not None:
+                logger.info("Match index: {} listed files changed => dropping them".format(
+                    len(changed_paths)
+                ))
+                self._drop(changed_paths)
+                return
+        logger.info("Match index: ignore rules or git file list changed => invalidating")
+        self._invalidate()
+
+    def _drop(self, paths):
+        """
+        Drops the decisions of the given absolute paths and their parent
+        directories, under both their absolute and relative keys.
+        """
+        keys = set()
+        for path in paths:
+            for is_dir in (False, True):
+                keys.add(self.key(path, is_dir))
+                keys.add(self.key(os.path.relpath(path), is_dir))
+            parent = os.path.dirname(path)
+            while parent != os.path.dirname(parent):
+                keys.add(self.key(parent, True))
+                keys.add(self.key(os.path.relpath(parent), True))
+                parent = os.path.dirname(parent)
+        for key in keys:
+            self._decisions.pop(key, None)
+        # a running walk may still hold the previous decisions
+        self._epoch += 1
+
+    def _insert(self, key, decision):
+        self._decisions[key] = decision
+        if len(self._decisions) > self.max_entries:
+            self._decisions.popitem(last=False)
+
+    def set_fileset(self, fileset):
+        """
+        Updates the fileset. Returns True if this invalidated the index.
+        """
+        with self.lock:
+            changed = fileset.signature != self.fileset.signature
+            self.fileset = fileset
+            if changed:
+                logger.info("Match index: fileset changed => invalidating")
+                self._invalidate()
+            return changed
+
+    def does_match(self, event):
+        key = self.key(event.path, event.is_dir)
+        with self.lock:
+            if not accepts_event(self.fileset, event):
+                if event.type in ("deleted", "moved_from"):
+                    self._decisions.pop(key, None)
+                return False
+            self._check_generation()
+            decision = self._decisions.get(key)
+            if decision is not None:
+                self._decisions.move_to_end(key)
+            fileset = self.fileset
+            epoch = self._epoch
+
+        if decision is None:
+            decision = does_match(fileset, event)
+
+        with self.lock:
+            if event.type in ("deleted", "moved_from"):
+                self._decisions.pop(key, None)
+            elif epoch == self._epoch:
+                self._insert(key, decision)
+        return decision
+
+    def matched_files(self):
+        """
+        Returns the paths of all files known to match.
+        """
+        with self.lock:
+            return [
+                key for key, decision in self._decisions.items()
+                if decision and not key.endswith(os.sep)
+            ]
+
+    def populate(self, working_dir, max_workers=None):
+        """
+        Fills the index by walking the tree. Excluded subtrees and `.git`
+        directories are not descended into, their content is looked up
+        lazily if needed.
+        """
+        with self.lock:
+            fileset = self.fileset
+            epoch = self._epoch
+
+        def prune(entry):
+            if entry.name == ".git":
+                return True
+            return is_excluded_subtree(fileset, FileEvent(entry.path, "scan", True))
+
+        decisions = {}
+        for entry in walk_tree(working_dir, prune=prune, max_workers=max_workers):
+            if entry.name == ".git":
+                continue
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            event = FileEvent(entry.path, "scan", is_dir)
+            decisions[self.key(entry.path, is_dir)] = does_match(fileset, event)
+            if len(decisions) >= self.max_entries:
+                logger.info("Match index: reached max entries")
+                break
+
+        with self.lock:
+            if epoch != self._epoch:
+                logger.info("Match index: discarding outdated walk")
+                return False
+            for key, decision in decisions.items():
+                if key not in self._decisions:
+                    self._insert(key, decision)
+            logger.info("Match index: populated with {} entries".format(len(self._decisions)))
+            return True
@@ -1,163 +1,447 @@
-from __future__ import division, print_function
-
 import fnmatch
+import functools
 import logging
 import os
 import re
 
-import subprocess
+from . import git_files
+from . import gitignore
 
 logger = logging.getLogger(__name__)
 
 
-def matcher_fnmatch(pattern, event):
-    if event.is_dir:
+class PatternError(ValueError):
+    pass
+
+
+# On case insensitive file systems (Windows) fnmatch.fnmatch normalizes
+# the case of both the pattern and the path.
+_CASE_FLAGS = re.IGNORECASE if os.path.normcase("A") == "a" else 0
+
+
+def _combine(regexes):
+    return "|".join("(?:{})".format(regex) for regex in regexes)
+
+
+class PatternSet(object):
+    """
+    Base class of a precompiled set of patterns. Calling it with an
+    event tells whether any of the patterns matches the event.
+    """
+
+    # whether matching is restricted to the files listed by git, which
+    # makes an additional gitignore check obsolete
+    uses_git_file_list = False
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __call__(self, event):
+        raise NotImplementedError()
+
+    def covers_subtree(self, event):
+        """
+        Returns True if the pattern set is known to match every path
+        below the directory given by `event`.
+        """
         return False
-    basename = os.path.basename(event.path)
-    return fnmatch.fnmatchcase(basename, pattern)
 
+    def rejects_subtree(self, event):
+        """
+        Returns True if the pattern set is known to match no path
+        below the directory given by `event`.
+        """
+        return False
 
-def matcher_re(pattern, event):
-    m = re.search(pattern, event.path)
-    return m is not None
+    def generation(self):
+        """
+        Returns a counter that changes whenever matching results may have
+        changed for reasons other than the patterns themselves.
+        """
+        return 0
+
+
+class PatternSetFnmatch(PatternSet):
+    """
+    Matches the basename of files (never directories) via fnmatch.
+    """
+
+    def __init__(self, patterns):
+        super(PatternSetFnmatch, self).__init__(patterns)
+        if len(self.patterns) > 0:
+            self.regex = re.compile(_combine(
+                fnmatch.translate(pattern) for pattern in self.patterns
+            ))
+        else:
+            self.regex = None
 
+    def __call__(self, event):
+        if self.regex is None or event.is_dir:
+            return False
+        basename = os.path.basename(event.path)
+        return self.regex.match(basename) is not None
+
+
+class PatternSetRe(PatternSet):
+    """
+    Searches regular expressions in the path of the event.
+    """
+
+    def __init__(self, patterns):
+        super(PatternSetRe, self).__init__(patterns)
+        regexes = []
+        for pattern in self.patterns:
+            try:
+                regexes.append(re.compile(pattern))
+            except re.error as e:
+                raise PatternError("Invalid regular expression '{}': {}".format(pattern, e))
+
+        # Combining into a single regex is only safe if the patterns don't
+        # rely on group numbering (back references) or global flags.
+        self.regex = None
+        if len(regexes) > 0 and all(regex.groups == 0 for regex in regexes):
+            try:
+                self.regex = re.compile(_combine(self.patterns))
+            except re.error:
+                pass
+        self.regexes = regexes if self.regex is None else []
+
+    def __call__(self, event):
+        if self.regex is not None:
+            return self.regex.search(event.path) is not None
+        for regex in self.regexes:
+            if regex.search(event.path) is not None:
+                return True
+        return False
+
+
+def translate_component_glob(pattern):
+    """
+    Translates an fnmatch pattern into a regex which matches within a
+    single path component, i.e., wildcards never match a '/'.
+    """
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            while i < n and pattern[i] == "*":
+                i += 1
+            res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+        elif c == "[":
+            j = i
+            if j < n and pattern[j] == "!":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j >= n:
+                res.append("\\[")
+            else:
+                stuff = pattern[i:j]
+                i = j + 1
+                negate = stuff.startswith("!")
+                if negate:
+                    stuff = stuff[1:]
+                stuff = stuff.replace("\\", "\\\\").replace("[", "\\[").replace("^", "\\^")
+                if negate:
+                    res.append("[^/" + stuff + "]")
+                else:
+                    res.append("(?!/)[" + stuff + "]")
+        else:
+            res.append(re.escape(c))
+    return "".join(res)
+
+
+def _is_literal(pattern):
+    return not any(c in pattern for c in "*?[")
+
+
+class PatternSetGitlike(PatternSet):
+    """
+    Simplified gitignore-like matching of path components.
+
+    Each pattern is parsed once. The most common kinds of patterns, i.e.,
+    plain names (`node_modules`) and extensions (`*.py`) that may match
+    at any level, are stored in hash sets and checked per component. All
+    remaining patterns are translated into regexes operating on the path
+    components joined by '/' (with a trailing '/' for directories), and
+    combined into a single regex.
+    """
 
-def matcher_gitlike(pattern, event):
     GITIGNORE_SEP = "/"
 
-    if pattern.startswith(GITIGNORE_SEP):
-        pattern_is_absolute = True
-        pattern = pattern[1:]
-    else:
-        pattern_is_absolute = False
-
-    if pattern.startswith("**"):
-        match_anywhere = True
-        pattern = pattern[2:]
-    else:
-        match_anywhere = False
-
-    if pattern.endswith(GITIGNORE_SEP):
-        match_dir_only = True
-        pattern = pattern[:-1]
-    else:
-        match_dir_only = False
-
-    pattern_comps = pattern.split(GITIGNORE_SEP)
-    evt_comps = event.components
-    evt_comps_is_dir = event.components_is_dir
-
-    if ".git" in evt_comps:
-        return True
+    def __init__(self, patterns):
+        super(PatternSetGitlike, self).__init__(patterns)
+
+        # Indexed by `match_dir_only`
+        self.names = (set(), set())
+        self.extensions = (set(), set())
+
+        regexes = []
+        for pattern in self.patterns:
+            pattern_is_absolute, match_dir_only, pattern_comps = self.parse(pattern)
+            if pattern_comps == [""]:
+                continue
+            if len(pattern_comps) == 1 and not pattern_is_absolute:
+                comp = self._normcase(pattern_comps[0])
+                if _is_literal(comp):
+                    self.names[match_dir_only].add(comp)
+                    continue
+                elif comp.startswith("*.") and _is_literal(comp[1:]):
+                    self.extensions[match_dir_only].add(comp[1:])
+                    continue
+            regexes.append(self.translate(pattern_is_absolute, match_dir_only, pattern_comps))
+
+        if len(regexes) > 0:
+            try:
+                self.regex = re.compile(_combine(regexes), re.DOTALL | _CASE_FLAGS)
+            except re.error as e:
+                raise PatternError("Invalid pattern in {}: {}".format(self.patterns, e))
+        else:
+            self.regex = None
 
-    def match(evt_comp, evt_comp_is_dir, pattern):
-        if fnmatch.fnmatch(evt_comp, pattern):
-            if match_dir_only:
-                return evt_comp_is_dir
-            else:
-                return True
+        self.has_sets = any(len(x) > 0 for x in self.names + self.extensions)
+
+    @staticmethod
+    def _normcase(s):
+        return s.lower() if _CASE_FLAGS else s
+
+    @classmethod
+    def parse(cls, pattern):
+        """
+        Returns (pattern_is_absolute, match_dir_only, pattern_comps).
+        """
+        sep = cls.GITIGNORE_SEP
+
+        if pattern.startswith(sep):
+            pattern_is_absolute = True
+            pattern = pattern[1:]
         else:
-            return False
+            pattern_is_absolute = False
 
-    if len(pattern_comps) == 1:
-        # matching a single pattern
+        # TODO: add `match_anywhere` implementation for leading '**'
+        if pattern.startswith("**"):
+            pattern = pattern[2:]
 
-        if pattern_is_absolute:
-            return match(evt_comps[0], evt_comps_is_dir[0], pattern)
+        if pattern.endswith(sep):
+            match_dir_only = True
+            pattern = pattern[:-1]
+        else:
+            match_dir_only = False
+
+        return pattern_is_absolute, match_dir_only, pattern.split(sep)
+
+    @staticmethod
+    def translate(pattern_is_absolute, match_dir_only, pattern_comps):
+        """
+        Returns the regex corresponding to a single parsed pattern.
+        """
+        # A component followed by a separator is a directory
+        suffix = "/" if match_dir_only else "(?:/|$)"
+
+        # Components are never empty, otherwise e.g. `b/*` would match the
+        # directory `b` itself via its trailing '/'.
+        comps = ["(?=[^/])" + translate_component_glob(comp) for comp in pattern_comps]
+
+        if len(comps) == 1:
+            if pattern_is_absolute:
+                return "^" + comps[0] + suffix
+            else:
+                return "(?:^|/)" + comps[0] + suffix
         else:
-            for i, c in enumerate(event.components):
-                if match(c, evt_comps_is_dir[i], pattern):
+            # Multi component patterns are always matched from the root,
+            # and match everything below as well.
+            return "^" + "/".join(comps) + suffix
+
+    def _match_sets(self, comps, is_dir):
+        last = len(comps) - 1
+        for i, comp in enumerate(comps):
+            comp = self._normcase(comp)
+            comp_is_dir = i < last or is_dir
+            if comp in self.names[False] or (comp_is_dir and comp in self.names[True]):
+                return True
+            dot = comp.find(".")
+            while dot != -1:
+                ext = comp[dot:]
+                if ext in self.extensions[False] or (comp_is_dir and ext in self.extensions[True]):
                     return True
+                dot = comp.find(".", dot + 1)
+        return False
+
+    def __call__(self, event):
+        if len(self.patterns) == 0:
             return False
+        comps = event.components
+        if ".git" in comps:
+            return True
+        if self.has_sets and self._match_sets(comps, event.is_dir):
+            return True
+        if self.regex is None:
+            return False
+        path = "/".join(comps)
+        if event.is_dir:
+            path += "/"
+        return self.regex.search(path) is not None
 
-    else:
-        # print(evt_comps, pattern_comps)
-        i = 0
-        while True:
-            # print(i, evt_comps[i], pattern_comps[i])
-            if not fnmatch.fnmatch(evt_comps[i], pattern_comps[i]):
-                return False
-            i += 1
-            if i >= len(evt_comps) and i >= len(pattern_comps):
-                if match_dir_only:
-                    return evt_comps_is_dir[i-1]
-                else:
-                    return True
-            elif i >= len(evt_comps):
-                # Pattern is longer than event path => no match.
-                return False
-            elif i >= len(pattern_comps):
-                # Event path is longer than pattern => match.
-                # Note that match_dir_only is automatically satisfied, because
-                return True
+    def covers_subtree(self, event):
+        # Patterns either match a component, or a prefix of the path.
+        # If that is the case for a directory, it also holds for all
+        # paths below it.
+        return self(event)
+
+
+class PatternSetGitTracked(PatternSetGitlike):
+    """
+    Gitlike patterns restricted to the files git knows about, i.e., tracked
+    files and untracked files that are not ignored. Checking whether a path
+    is listed is a set lookup, the list is maintained by `git_files`.
+    Outside of git repositories this is equivalent to plain gitlike matching.
+    """
+
+    uses_git_file_list = True
+
+    @staticmethod
+    def _is_listed(event):
+        file_list = git_files.get_git_file_list(event.path)
+        return file_list is None or file_list.contains(event.path, event.is_dir)
+
+    def __call__(self, event):
+        return super(PatternSetGitTracked, self).__call__(event) and self._is_listed(event)
+
+    def covers_subtree(self, event):
+        # Only the patterns are relevant for excluding
+        return super(PatternSetGitTracked, self).__call__(event)
+
+    def rejects_subtree(self, event):
+        return not self._is_listed(event)
+
+    def generation(self):
+        # Unlisted paths are checked against the ignore rules
+        return git_files.get_generation() + gitignore.get_generation()
+
+
+class FileSetMatcher(object):
+    """
+    Precompiled include/exclude matcher of a fileset.
+    """
+
+    def __init__(self, patterns_incl, patterns_excl, pattern_set_cls):
+        self.matcher_incl = pattern_set_cls(patterns_incl)
+        self.matcher_excl = pattern_set_cls(patterns_excl)
+
+    def __call__(self, event):
+        return self.matcher_incl(event) and not self.matcher_excl(event)
+
+    def excludes_subtree(self, event):
+        return self.matcher_excl.covers_subtree(event) or self.matcher_incl.rejects_subtree(event)
+
+    @property
+    def uses_git_file_list(self):
+        return self.matcher_incl.uses_git_file_list
+
+    def generation(self):
+        return self.matcher_incl.generation()
 
-    # TODO: add `match_anywhere` implementation
 
+@functools.lru_cache(maxsize=256)
+def _compile_single(pattern_set_cls, pattern):
+    return pattern_set_cls([pattern])
 
-def is_gitignore(path):
-    # TODO: needs working directory?
 
-    # `git check-ignore` does not return an ignore status for
-    # files under `.git` itself. We need special handling for
-    # that. Note that git even ignores other `.git` folders
-    # in subpaths.
+def matcher_fnmatch(pattern, event):
+    return _compile_single(PatternSetFnmatch, pattern)(event)
+
+
+def matcher_re(pattern, event):
+    return _compile_single(PatternSetRe, pattern)(event)
+
+
+def matcher_gitlike(pattern, event):
+    return _compile_single(PatternSetGitlike, pattern)(event)
+
+
+def is_gitignore(path, is_dir=None):
+    # Git never reports an ignore status for files under `.git`
+    # itself. We need special handling for that. Note that git
+    # even ignores other `.git` folders in subpaths.
     comps = path.split(os.sep)
     if ".git" in comps:
         return True
 
-    try:
-        p = subprocess.Popen(
-            ["git", "check-ignore", path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-    except OSError:
-        warning = "Cannot execute 'git check-ignore'."
-        # TODO communicate warning
+    git_ignore = gitignore.get_gitignore(path)
+    if git_ignore is None:
+        # Not in a git repository => nothing can be ignored.
+        return False
+    return git_ignore.is_ignored(path, is_dir)
+
+
+# Event types that can be selected by the `events` setting of a fileset.
+EVENT_TYPES = {
+    "created": ["created"],
+    "modified": ["modified"],
+    "deleted": ["deleted"],
+    "moved": ["moved_from", "moved_to"],
+    "closed": ["closed"],
+    "opened": ["opened"],
+    "closed_no_write": ["closed_no_write"],
+}
 
-    outs, errs = p.communicate()
-    ret = p.returncode
+# Opening or reading a file doesn't change it.
+DEFAULT_EVENT_TYPES = ["created", "modified", "deleted", "moved", "closed"]
 
-    if ret == 0:
-        return True
-    elif ret == 1 and errs == "":
+
+def accepts_event(fileset, event):
+    """
+    Cheap first stage of matching, which filters by event type and
+    directories. Events of type 'scan' (used when walking the tree)
+    are always accepted.
+    """
+    if event.is_dir and not fileset.directories:
         return False
-    else:
-        # return code 128 is "fatal error"
-        warning = "'git check-ignore' returned unexpected return code ({})".format(ret)
-        if errs != "":
-            warning += " with error: {}".format(errs)
-        else:
-            warning += "."
-        # TODO communicate warning
+    if fileset.event_types is None or event.type == "scan":
+        return True
+    return event.type in fileset.event_types
 
 
 def does_match(fileset, event):
     # TODO return an object that stores which of the
     # three cases was applied, with additional infos
 
-    matches = False
-    for pattern in fileset.patterns_incl:
-        if fileset.matcher(pattern, event):
-            matches = True
-            break
+    if not accepts_event(fileset, event):
+        return False
 
-    if matches:
-        for pattern in fileset.patterns_excl:
-            if fileset.matcher(pattern, event):
-                matches = False
-                break
+    matches = fileset.matcher(event)
 
     if matches:
         if fileset.exclude_gitignore:
-            if is_gitignore(event.path):
+            if is_gitignore(event.path, event.is_dir):
                 matches = False
 
     return matches
 
 
+def is_excluded_subtree(fileset, event):
+    """
+    Returns True if no path within the directory given by `event` can
+    ever match the fileset, i.e., the directory doesn't need watching.
+    """
+    if fileset.matcher.excludes_subtree(event):
+        return True
+    # Git does not re-include paths below ignored directories.
+    return fileset.exclude_gitignore and is_gitignore(event.path, True)
+
+
 AVAILABLE_MATCH_MODES = {
-    "fnmatch": matcher_fnmatch,
-    "re": matcher_re,
-    "gitlike": matcher_gitlike,
+    "fnmatch": PatternSetFnmatch,
+    "re": PatternSetRe,
+    "gitlike": PatternSetGitlike,
+    "git_tracked": PatternSetGitTracked,
 }
@@ -0,0 +1,201 @@
+import collections
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.request import Request, urlopen
+
+logger = logging.getLogger(__name__)
+
+
+class Notification(object):
+    """
+    The outcome of a run, and the backends that should report it.
+    """
+
+    def __init__(self, success, messages, backends, source=None):
+        self.success = success
+        self.messages = messages
+        self.backends = backends
+        # only notifications of the same source (e.g. a group of tasks)
+        # supersede each other
+        self.source = source
+        self.time = time.time()
+
+    @property
+    def title(self):
+        return "SUCCESS" if self.success else "FAILURE"
+
+
+class SoundBackend(object):
+    FILE_POSITIVE = "456581__bumpelsnake__nameit5.wav"
+    FILE_NEGATIVE = "377017__elmasmalo1__notification-pop.wav"
+
+    def send(self, notification):
+        snd_file = os.path.join(
+            os.path.dirname(__file__), "sounds",
+            self.FILE_POSITIVE if notification.success else self.FILE_NEGATIVE,
+        )
+        try:
+            p = subprocess.Popen(
+                ["ffplay", "-nodisp", "-autoexit", "-hide_banner", snd_file],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            p.wait()
+        except Exception as e:
+            print(" * Failed to play sound notification:\n{}".format(e))
+
+
+class DesktopBackend(object):
+    def send(self, notification):
+        try:
+            p = subprocess.Popen(
+                ["notify-send", notification.title, "\n".join(notification.messages)],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            p.wait()
+        except Exception as e:
+            print(" * Failed to send notification:\n{}".format(e))
+
+
+class BellBackend(object):
+    def send(self, notification):
+        sys.stdout.write("\a")
+        sys.stdout.flush()
+
+
+class WebhookBackend(object):
+    """
+    Posts the notification as JSON to an HTTP URL, or writes it as a
+    single line to a Unix domain socket (address 'unix:<path>').
+    """
+
+    TIMEOUT = 2.0
+
+    def __init__(self, address):
+        self.address = address
+
+    def _payload(self, notification):
+        return json.dumps({
+            "success": notification.success,
+            "title": notification.title,
+            "messages": notification.messages,
+            "time": notification.time,
+        }).encode("utf-8")
+
+    def send(self, notification):
+        payload = self._payload(notification)
+        try:
+            if self.address.startswith("unix:"):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.settimeout(self.TIMEOUT)
+                    sock.connect(self.address[len("unix:"):])
+                    sock.sendall(payload + b"\n")
+                finally:
+                    sock.close()
+            else:
+                request = Request(
+                    self.address, data=payload, headers={"Content-Type": "application/json"},
+                )
+                urlopen(request, timeout=self.TIMEOUT).close()
+        except Exception as e:
+            print(" * Failed to send webhook notification:\n{}".format(e))
+
+
+def create_backends(config):
+    """
+    Returns the notification backends enabled in the config.
+    """
+    backends = []
+    if config.sound:
+        backends.append(SoundBackend())
+    if config.notifications:
+        backends.append(DesktopBackend())
+    if config.bell:
+        backends.append(BellBackend())
+    if config.webhook != "":
+        backends.append(WebhookBackend(config.webhook))
+    return backends
+
+
+class NotificationDispatcher(object):
+    """
+    Delivers notifications in a background thread, so that playing a sound
+    or spawning `notify-send` never delays the next run.
+
+    Notifications piling up while the previous one is delivered are
+    coalesced per source: Only the most recent one of each source is
+    delivered, because it reflects the current state of the source. The
+    queue is bounded, the oldest notifications are dropped if it is full.
+    """
+
+    STOP_TIMEOUT = 3.0
+
+    def __init__(self, max_size=16):
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        # source => most recent notification, in order of arrival
+        self.queue = collections.OrderedDict()
+        self.max_size = max_size
+        self.num_coalesced = 0
+        self.thread = None
+        self.stopped = False
+
+    def notify(self, notification):
+        """
+        Enqueues a notification, never blocks.
+        """
+        if len(notification.backends) == 0:
+            return
+        with self.lock:
+            if self.stopped:
+                return
+            if notification.source in self.queue:
+                del self.queue[notification.source]
+                self.num_coalesced += 1
+            elif len(self.queue) >= self.max_size:
+                self.queue.popitem(last=False)
+                logger.info("Notifications: queue full => dropped the oldest notification")
+            self.queue[notification.source] = notification
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._deliver_loop)
+                self.thread.daemon = True
+                self.thread.start()
+            self.available.notify()
+
+    def _deliver_loop(self):
+        while True:
+            with self.lock:
+                while len(self.queue) == 0 and not self.stopped:
+                    self.available.wait()
+                if len(self.queue) == 0:
+                    return
+                _, notification = self.queue.popitem(last=False)
+                num_coalesced = self.num_coalesced
+                self.num_coalesced = 0
+            if num_coalesced > 0:
+                logger.info("Notifications: skipped {} outdated notifications".format(num_coalesced))
+            for backend in notification.backends:
+                try:
+                    backend.send(notification)
+                except Exception:
+                    logger.exception("Notification backend failed")
+
+    def stop(self):
+        """
+        Stops the delivery thread once the pending notifications have
+        been delivered (waiting at most `STOP_TIMEOUT`).
+        """
+        with self.lock:
+            self.stopped = True
+            thread = self.thread
+            self.available.notify()
+        if thread is not None:
+            thread.join(self.STOP_TIMEOUT)
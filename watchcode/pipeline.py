@@ -0,0 +1,238 @@
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+from .trigger import FileEvent
+
+logger = logging.getLogger(__name__)
+
+
+def split_event(event):
+    """
+    Converts a raw watchdog event into our own simplified representation,
+    which converts 'moved' events into two separate events in order to
+    avoid special handling for event.dest_path.
+    """
+    if event.event_type == "moved":
+        return [
+            FileEvent(event.src_path, event.event_type + "_from", event.is_directory),
+            FileEvent(event.dest_path, event.event_type + "_to", event.is_directory),
+        ]
+    else:
+        return [
+            FileEvent(event.src_path, event.event_type, event.is_directory),
+        ]
+
+
+# Temporary files of editors, which are written next to the actual file
+# and then renamed onto it (or which only contain editor state).
+EDITOR_TEMP_FILE_PATTERNS = [
+    re.compile(pattern) for pattern in [
+        r"^\..+\.sw[a-px]$",                # vim: swap files
+        r"^\..+\.swpx$",                    # vim: swap file probe
+        r"^.+~$",                           # vim/emacs/gedit: backups
+        r"^.+___jb_(tmp|old)___$",          # JetBrains: safe write
+        r"^\.goutputstream-\w+$",           # gedit/GIO: atomic replace
+        r"^#.+#$",                          # emacs: auto-save
+        r"^\.#.+$",                         # emacs: lock files
+        r"^.+\.kate-swp$",                  # kate: swap files
+    ]
+]
+
+
+def is_vim_probe_file(basename):
+    # vim probes write permissions with '4913', adding 123 while it exists
+    return basename.isdigit() and int(basename) >= 4913 and (int(basename) - 4913) % 123 == 0
+
+
+def is_editor_temp_file(path):
+    basename = os.path.basename(path)
+    return is_vim_probe_file(basename) or \
+        any(pattern.match(basename) for pattern in EDITOR_TEMP_FILE_PATTERNS)
+
+
+def normalize_editor_saves(events):
+    """
+    Collapses the write-temp-then-rename sequences of editors into a
+    single logical `modified` event of the actual file, and drops all
+    events of editor temp files:
+
+    - Renaming a temp file onto a file becomes `modified` of the file.
+    - Renaming a file to a temp file (a backup, which is followed by
+      re-creating the file) becomes `modified` of the file, and so does
+      a subsequent `created` of it.
+
+    Expects the moved_from/moved_to pairs produced by `split_event`.
+    """
+    result = []
+    replaced = set()
+    i = 0
+    while i < len(events):
+        event = events[i]
+        if event.is_dir:
+            result.append(event)
+            i += 1
+            continue
+
+        if event.type == "moved_from" and i + 1 < len(events) and \
+                events[i + 1].type == "moved_to":
+            dest = events[i + 1]
+            src_is_temp = is_editor_temp_file(event.path)
+            dest_is_temp = is_editor_temp_file(dest.path)
+            if src_is_temp and not dest_is_temp:
+                result.append(FileEvent(dest.path, "modified", False))
+            elif dest_is_temp and not src_is_temp:
+                replaced.add(event.path)
+                result.append(FileEvent(event.path, "modified", False))
+            elif not src_is_temp and not dest_is_temp:
+                result.extend([event, dest])
+            i += 2
+            continue
+
+        if is_editor_temp_file(event.path):
+            pass
+        elif event.type == "created" and event.path in replaced:
+            result.append(FileEvent(event.path, "modified", False))
+        else:
+            result.append(event)
+        i += 1
+    return result
+
+
+# Event types that carry no additional information if one of the
+# superseding event types occurred for the same path in the same batch.
+SUPERSEDED_BY = {
+    "modified": {"created"},
+    "closed": {"created", "modified"},
+    "closed_no_write": {"created", "modified", "closed"},
+    "opened": {"created", "modified"},
+}
+
+
+def coalesce_events(events):
+    """
+    Removes duplicate (path, type) pairs and collapses sequences like
+    created + modified + closed of the same path into their first
+    significant event. The order of first occurrence is preserved.
+    """
+    types_per_path = {}
+    for event in events:
+        types_per_path.setdefault((event.path, event.is_dir), set()).add(event.type)
+
+    seen = set()
+    result = []
+    for event in events:
+        key = (event.path, event.is_dir, event.type)
+        if key in seen:
+            continue
+        seen.add(key)
+        superseded_by = SUPERSEDED_BY.get(event.type)
+        if superseded_by is not None and \
+                not superseded_by.isdisjoint(types_per_path[(event.path, event.is_dir)]):
+            continue
+        result.append(event)
+    return result
+
+
+class EventPipeline(object):
+    """
+    Bounded hand-off between the observer thread and event processing.
+
+    The observer thread only enqueues raw events. A dedicated consumer
+    thread collects events for a short window, normalizes the save
+    sequences of editors, coalesces the events, and passes the resulting
+    batch to `on_events`. If the queue overflows,
+    events are dropped and the consumer calls `on_overflow` once
+    instead, which should fall back to a full rescan.
+    """
+
+    def __init__(self, on_events, on_overflow, max_size=10000, coalesce_window=0.05,
+                 normalize_editor_saves=True):
+        self.on_events = on_events
+        self.on_overflow = on_overflow
+        self.coalesce_window = coalesce_window
+        self.normalize_editor_saves = normalize_editor_saves
+
+        self.queue = queue.Queue(maxsize=max_size)
+        self.overflowed = threading.Event()
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self._consume)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def put(self, event):
+        """
+        Called from the observer thread, must never block.
+        """
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            if not self.overflowed.is_set():
+                logger.warning("Event queue overflow => falling back to rescan")
+                self.overflowed.set()
+
+    def _collect(self):
+        """
+        Blocks until an event is available, and then collects all events
+        arriving within the coalesce window.
+        """
+        raw_events = [self.queue.get()]
+        deadline = time.monotonic() + self.coalesce_window
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                raw_events.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return [event for event in raw_events if event is not None]
+
+    def _drain(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def _consume(self):
+        while not self.stopped.is_set():
+            raw_events = self._collect()
+            if self.stopped.is_set():
+                break
+
+            if self.overflowed.is_set():
+                self._drain()
+                self.overflowed.clear()
+                self._dispatch(self.on_overflow)
+                continue
+
+            events = []
+            for raw_event in raw_events:
+                events.extend(split_event(raw_event))
+            if self.normalize_editor_saves:
+                events = normalize_editor_saves(events)
+            events = coalesce_events(events)
+            if len(events) > 0:
+                self._dispatch(self.on_events, events)
+
+    @staticmethod
+    def _dispatch(func, *args):
+        # The consumer thread must survive errors in event processing.
+        try:
+            func(*args)
+        except Exception:
+            logger.exception("Error in event processing")
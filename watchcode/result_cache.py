@@ -0,0 +1,126 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+from .config import INTERNAL_DIRNAME
+from .content_cache import ContentCache
+from .matching import does_match, is_excluded_subtree
+from .trigger import FileEvent
+from .walk import walk_tree
+
+logger = logging.getLogger(__name__)
+
+
+def list_fileset_files(working_dir, fileset):
+    """
+    Returns the sorted paths of all files below the working directory
+    matching the fileset.
+    """
+    root = os.path.normpath(working_dir)
+
+    def prune(entry):
+        if entry.name == ".git" or entry.path == os.path.join(root, INTERNAL_DIRNAME):
+            return True
+        return is_excluded_subtree(fileset, FileEvent(entry.path, "scan", True))
+
+    paths = []
+    for entry in walk_tree(root, prune=prune):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                continue
+        except OSError:
+            continue
+        if does_match(fileset, FileEvent(entry.path, "scan", False)):
+            paths.append(entry.path)
+    return sorted(paths)
+
+
+class ResultCache(object):
+    """
+    Persistent cache of successful task results, keyed by a digest of the
+    task inputs: the content of all files of the fileset, and the command
+    templates. This allows to skip re-running a task after reverting a change
+    or switching back to a branch.
+    """
+
+    MAX_ENTRIES_PER_TASK = 20
+
+    def __init__(self, working_dir):
+        self.working_dir = working_dir
+        self.directory = os.path.join(working_dir, INTERNAL_DIRNAME, "cache")
+        # separate from the content cache used for event filtering, because
+        # hashing files here must not hide pending modifications there
+        self.content_cache = ContentCache()
+
+    def input_key(self, task_name, fileset, commands):
+        """
+        Computes the input digest of a task. `commands` are the unrendered
+        commands. All files of the fileset get listed and stat'ed (hashing
+        only the changed ones), i.e., the cost grows with the fileset.
+        """
+        paths = list_fileset_files(self.working_dir, fileset)
+        digests = self.content_cache.digests(paths)
+
+        h = hashlib.blake2b(digest_size=20)
+        h.update(task_name.encode("utf-8") + b"\0")
+        for path in paths:
+            digest = digests[path]
+            h.update(os.path.relpath(path, self.working_dir).encode("utf-8", "surrogateescape"))
+            h.update(b"\0" + (digest if digest is not None else b"?") + b"\0")
+        h.update(json.dumps(commands).encode("utf-8"))
+        return h.hexdigest()
+
+    def _path(self, task_name):
+        return os.path.join(self.directory, re.sub(r"[^\w.-]", "_", task_name) + ".json")
+
+    def _load(self, task_name):
+        try:
+            with open(self._path(task_name)) as f:
+                data = json.load(f)
+            return [entry for entry in data["entries"] if entry["task"] == task_name]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return []
+
+    def _save(self, task_name, entries):
+        tmp_path = None
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"entries": entries}, f)
+            os.replace(tmp_path, self._path(task_name))
+        except (IOError, OSError, TypeError, ValueError) as e:
+            logger.warning("Failed to write result cache: {}".format(e))
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def lookup(self, task_name, key):
+        """
+        Returns the stored list of (command, runtime, retcode, parallel) of a
+        successful run with the given key, or None.
+        """
+        for entry in self._load(task_name):
+            if entry["key"] == key:
+                return [tuple(result) for result in entry["results"]]
+        return None
+
+    def store(self, task_name, key, results):
+        entries = [entry for entry in self._load(task_name) if entry["key"] != key]
+        entries.insert(0, {
+            "task": task_name,
+            "key": key,
+            "time": time.time(),
+            "results": [list(result) for result in results],
+        })
+        self._save(task_name, entries[:self.MAX_ENTRIES_PER_TASK])
+
+    def close(self):
+        self.content_cache.close()
@@ -0,0 +1,176 @@
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logger = logging.getLogger(__name__)
+
+SUCCESS = "success"
+FAILURE = "failure"
+SKIPPED = "skipped"
+CANCELLED = "cancelled"
+
+
+class TaskGraph(object):
+    """
+    Dependency graph of the tasks, built from their `depends_on` lists.
+    """
+
+    def __init__(self, dependencies):
+        self.dependencies = {
+            name: sorted(set(deps)) for name, deps in dependencies.items()
+        }
+        self.dependents = {name: [] for name in self.dependencies}
+        for name, deps in sorted(self.dependencies.items()):
+            for dep in deps:
+                if dep in self.dependents:
+                    self.dependents[dep].append(name)
+
+    @staticmethod
+    def from_tasks(tasks):
+        return TaskGraph({name: task.depends_on for name, task in tasks.items()})
+
+    def undefined_dependencies(self):
+        """
+        Returns (task, dependency) pairs referring to non-existing tasks.
+        """
+        return [
+            (name, dep)
+            for name, deps in sorted(self.dependencies.items())
+            for dep in deps
+            if dep not in self.dependencies
+        ]
+
+    def find_cycle(self):
+        """
+        Returns a list of task names forming a cycle, or None if the
+        graph is acyclic.
+        """
+        visiting = set()
+        visited = set()
+
+        def visit(name, path):
+            if name in visiting:
+                return path[path.index(name):] + [name]
+            if name in visited or name not in self.dependencies:
+                return None
+            visiting.add(name)
+            for dep in self.dependencies[name]:
+                cycle = visit(dep, path + [name])
+                if cycle is not None:
+                    return cycle
+            visiting.remove(name)
+            visited.add(name)
+            return None
+
+        for name in sorted(self.dependencies):
+            cycle = visit(name, [])
+            if cycle is not None:
+                return cycle
+        return None
+
+    @staticmethod
+    def _closure(names, edges):
+        result = set()
+        stack = list(names)
+        while len(stack) > 0:
+            name = stack.pop()
+            if name in result:
+                continue
+            result.add(name)
+            stack.extend(edges.get(name, []))
+        return result
+
+    def upstream(self, names):
+        """
+        The given tasks and all tasks they (transitively) depend on.
+        """
+        return self._closure(names, self.dependencies)
+
+    def downstream(self, names):
+        """
+        The given tasks and all tasks (transitively) depending on them.
+        """
+        return self._closure(names, self.dependents)
+
+    def component(self, name):
+        """
+        All tasks connected to the given task, ignoring edge direction.
+        """
+        result = set()
+        stack = [name]
+        while len(stack) > 0:
+            name = stack.pop()
+            if name in result:
+                continue
+            result.add(name)
+            stack.extend(self.dependencies.get(name, []))
+            stack.extend(self.dependents.get(name, []))
+        return frozenset(result)
+
+    def topological_order(self, names):
+        """
+        Sorts the given tasks such that dependencies come first.
+        """
+        names = set(names)
+        result = []
+        visited = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            visited.add(name)
+            for dep in self.dependencies[name]:
+                if dep in names:
+                    visit(dep)
+            result.append(name)
+
+        for name in sorted(names):
+            visit(name)
+        return result
+
+
+def run_graph(graph, task_names, run_task, max_workers):
+    """
+    Runs the given tasks on a thread pool. A task is started once all of
+    its dependencies within `task_names` have succeeded, and skipped if
+    one of them did not. Dependencies outside of `task_names` are assumed
+    to be up-to-date.
+
+    `run_task(name)` has to return SUCCESS, FAILURE, or CANCELLED.
+    Returns a dict mapping task names to their status.
+    """
+    task_names = set(task_names)
+    remaining = graph.topological_order(task_names)
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        running = {}
+        while len(remaining) > 0 or len(running) > 0:
+            still_remaining = []
+            for name in remaining:
+                deps = [dep for dep in graph.dependencies[name] if dep in task_names]
+                dep_results = [results.get(dep) for dep in deps]
+                if any(result not in (None, SUCCESS) for result in dep_results):
+                    results[name] = SKIPPED
+                elif all(result == SUCCESS for result in dep_results):
+                    running[pool.submit(run_task, name)] = name
+                else:
+                    still_remaining.append(name)
+            remaining = still_remaining
+
+            if len(running) == 0:
+                # can only happen for inconsistent graphs
+                for name in remaining:
+                    results[name] = SKIPPED
+                break
+
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    logger.exception("Error running task '{}'".format(name))
+                    results[name] = FAILURE
+
+    return results
@@ -0,0 +1,210 @@
+import logging
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import uuid
+
+from .forkserver import ForkedProcess
+
+logger = logging.getLogger(__name__)
+
+
+class ShellSessionError(Exception):
+    pass
+
+
+ENV_NAME_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class ShellSession(object):
+    """
+    Keeps a long-lived bash coprocess per task. Its `setup` commands run
+    once when the shell starts, so that e.g. activating a virtualenv
+    persists across runs instead of being paid on every save.
+
+    The commands are written to the stdin of the shell. Each of them runs
+    as a background job with its own process group (job control), so that
+    it can be cancelled without losing the session. The pid and the exit
+    code of a job are reported via a separate pipe, tagged by a random
+    sentinel. If the shell dies, it is restarted on the next run.
+    """
+
+    STOP_TIMEOUT = 3.0
+
+    def __init__(self, working_dir, setup):
+        self.working_dir = working_dir
+        self.setup = list(setup)
+        self.lock = threading.Lock()
+        self.proc = None
+        self.status = None
+        self.status_fd = None
+        self.sentinel = None
+        # environment of the shell at startup, and variables exported since
+        self.base_env = {}
+        self.exported = set()
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _start(self):
+        bash = shutil.which("bash")
+        if bash is None:
+            raise ShellSessionError("bash not found")
+        read_fd, write_fd = os.pipe()
+        try:
+            self.proc = subprocess.Popen(
+                [bash, "-s"],
+                stdin=subprocess.PIPE,
+                cwd=self.working_dir,
+                pass_fds=(write_fd,),
+                start_new_session=True,
+            )
+        except OSError as e:
+            os.close(read_fd)
+            self.proc = None
+            raise ShellSessionError(str(e))
+        finally:
+            os.close(write_fd)
+        if self.status is not None:
+            self.status.close()
+        self.status = os.fdopen(read_fd, "r")
+        self.status_fd = write_fd
+        self.sentinel = uuid.uuid4().hex
+        self.base_env = dict(os.environ)
+        self.exported = set()
+
+        # job control => every job is a process group leader
+        self._send("set -m")
+        for command in self.setup:
+            self._send("\n".join([
+                "cd {}".format(shlex.quote(os.path.abspath(self.working_dir))),
+                "eval {} </dev/null".format(shlex.quote(command)),
+                self._report("setup", "$?"),
+            ]))
+            retcode = self._receive("setup")
+            if retcode != 0:
+                print(" * Setup command '{}' returned {}".format(command, retcode))
+                sys.stdout.flush()
+        logger.info("Shell session ready (pid {})".format(self.proc.pid))
+
+    def _send(self, script):
+        try:
+            self.proc.stdin.write((script + "\n").encode("utf-8", "surrogateescape"))
+            self.proc.stdin.flush()
+        except (IOError, OSError) as e:
+            raise ShellSessionError("shell exited ({})".format(e))
+
+    def _report(self, kind, value):
+        return "printf '{} {} %d\\n' \"{}\" >&{}".format(self.sentinel, kind, value, self.status_fd)
+
+    def _receive(self, kind):
+        while True:
+            line = self.status.readline()
+            if line == "":
+                raise ShellSessionError("shell exited with {}".format(self.proc.wait()))
+            parts = line.split()
+            if len(parts) == 3 and parts[0] == self.sentinel and parts[1] == kind:
+                return int(parts[2])
+
+    def _env_updates(self, env):
+        """
+        Returns the commands to bring the exported variables of the shell
+        in line with `env`. Variables set by the setup commands are kept
+        unless `env` overrides them.
+        """
+        updates = {
+            key: value for key, value in env.items()
+            if self.base_env.get(key) != value and ENV_NAME_PATTERN.match(key)
+        }
+        removed = (set(self.base_env) | self.exported) - set(env)
+        self.exported = set(updates)
+        lines = ["export {}={}".format(key, shlex.quote(value)) for key, value in sorted(updates.items())]
+        lines += ["unset {}".format(key) for key in sorted(removed) if ENV_NAME_PATTERN.match(key)]
+        return lines
+
+    def warm(self):
+        """
+        Starts the shell and runs the setup commands in the background.
+        """
+        thread = threading.Thread(target=self._warm)
+        thread.daemon = True
+        thread.start()
+
+    def _warm(self):
+        with self.lock:
+            if self.alive:
+                return
+            try:
+                self._start()
+            except ShellSessionError as e:
+                # retried on the next run
+                logger.warning("Failed to start shell session: {}".format(e))
+
+    @staticmethod
+    def accepts(command):
+        return True
+
+    def run(self, command, env, on_started):
+        """
+        Runs a command as a job of the shell and returns its exit code.
+        `on_started` is called with a ForkedProcess handle of the job, which
+        allows to cancel it. Raises ShellSessionError if the shell could not
+        be (re)started.
+        """
+        with self.lock:
+            if not self.alive:
+                if self.proc is not None:
+                    print(" * Shell session exited => restarting")
+                    sys.stdout.flush()
+                self._start()
+            # the job must neither read the script nor write to the status pipe
+            self._send("\n".join(self._env_updates(env) + [
+                "cd {}".format(shlex.quote(os.path.abspath(self.working_dir))),
+                "( eval {} ) </dev/null {}>&- &".format(shlex.quote(command), self.status_fd),
+                self._report("pid", "$!"),
+                "wait $!",
+                self._report("exit", "$?"),
+            ]))
+            job = ForkedProcess(self._receive("pid"))
+            on_started(job)
+            try:
+                job._set_returncode(self._receive("exit"))
+            except ShellSessionError as e:
+                # not re-run in another shell, the command has started already
+                print(" * Shell session died during the command: {}".format(e))
+                sys.stdout.flush()
+                job._set_returncode(-1)
+            return job.returncode
+
+    def stop(self):
+        """
+        Stops the shell in the background after a running command has finished.
+        """
+        thread = threading.Thread(target=self._stop)
+        thread.daemon = True
+        thread.start()
+
+    def _stop(self):
+        # closing stdin makes the shell exit
+        with self.lock:
+            proc = self.proc
+            self.proc = None
+            if self.status is not None:
+                self.status.close()
+                self.status = None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            proc.wait(timeout=self.STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
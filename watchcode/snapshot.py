@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+import tempfile
+
+from .config import INTERNAL_DIRNAME, LOG_FILENAME
+from .matching import does_match
+from .trigger import FileEvent
+from .walk import walk_tree
+from .watch_manager import is_prunable_dir
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILENAME = os.path.join(INTERNAL_DIRNAME, "snapshot.json")
+SNAPSHOT_VERSION = 1
+
+
+class Snapshot(object):
+    """
+    Stat data of the matched files and the results of the last runs,
+    saved on exit to decide whether the initial run can be skipped.
+    """
+
+    def __init__(self, files, results):
+        # relative path => (size, mtime_ns)
+        self.files = files
+        # task name => whether its last run succeeded
+        self.results = results
+
+    @staticmethod
+    def take(working_dir, filesets, results):
+        """
+        Collects the stat data of all files matching any of the filesets
+        using a parallel walk. The config file is always included.
+        """
+        root = os.path.normpath(working_dir)
+        internal_dir = os.path.join(root, INTERNAL_DIRNAME)
+        log_file = os.path.join(root, LOG_FILENAME)
+
+        def prune(entry):
+            if entry.name == ".git" or entry.path == internal_dir:
+                return True
+            return is_prunable_dir(filesets, entry.path)
+
+        files = {}
+        for entry in walk_tree(root, prune=prune):
+            try:
+                if entry.is_dir(follow_symlinks=False) or entry.path == log_file:
+                    continue
+                rel_event = FileEvent(os.path.relpath(entry.path, root), "scan", False)
+                is_config_file = rel_event.is_config_file
+                event = FileEvent(entry.path, "scan", False)
+                if is_config_file or any(does_match(fileset, event) for fileset in filesets):
+                    stat = entry.stat(follow_symlinks=False)
+                    files[os.path.relpath(entry.path, root)] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+        return Snapshot(files, dict(results))
+
+    def diff(self, other):
+        """
+        Returns the sorted relative paths of files that were added, removed,
+        or modified in `other`.
+        """
+        return sorted(
+            path for path in set(self.files) | set(other.files)
+            if self.files.get(path) != other.files.get(path)
+        )
+
+    def save(self, working_dir):
+        path = os.path.join(working_dir, SNAPSHOT_FILENAME)
+        data = {
+            "version": SNAPSHOT_VERSION,
+            "files": self.files,
+            "results": self.results,
+        }
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        except (IOError, OSError) as e:
+            logger.warning("Failed to write snapshot: {}".format(e))
+
+    @staticmethod
+    def load(working_dir):
+        """
+        Returns the snapshot of the last session, or None.
+        """
+        path = os.path.join(working_dir, SNAPSHOT_FILENAME)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data["version"] != SNAPSHOT_VERSION:
+                return None
+            files = {p: tuple(stat) for p, stat in data["files"].items()}
+            return Snapshot(files, data["results"])
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
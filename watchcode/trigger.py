@@ -1,15 +1,11 @@
-from __future__ import division, print_function
-
 import abc
 import os
-import six
 
 from .colors import color, Style, FG
 from .config import DEFAULT_CONFIG_FILENAME
 
 
-@six.add_metaclass(abc.ABCMeta)
-class Trigger:
+class Trigger(metaclass=abc.ABCMeta):
     def instance_of(self, cls):
         return isinstance(self, cls)
 
@@ -24,6 +20,11 @@ class ManualTrigger(Trigger):
         return "Manual trigger"
 
 
+class RescanTrigger(Trigger):
+    def __str__(self):
+        return "Rescan trigger (event queue overflow)"
+
+
 class FileEvent(Trigger):
     def __init__(self, path, type, is_dir):
         self.path = path
@@ -0,0 +1,39 @@
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logger = logging.getLogger(__name__)
+
+
+def _scan_dir(path):
+    try:
+        return list(os.scandir(path))
+    except OSError as e:
+        logger.info("Failed to scan directory '{}': {}".format(path, e))
+        return []
+
+
+def walk_tree(root, prune=None, max_workers=None):
+    """
+    Walks the directory tree below `root`, scanning directories in
+    parallel on a thread pool.
+
+    Yields `os.DirEntry` objects for all files and directories (in no
+    particular order). Directories are yielded before their content.
+    If `prune(entry)` returns True for a directory, it is yielded but
+    not descended into. Symlinks to directories are not followed.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {pool.submit(_scan_dir, root)}
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for entry in future.result():
+                    yield entry
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        is_dir = False
+                    if is_dir and (prune is None or not prune(entry)):
+                        pending.add(pool.submit(_scan_dir, entry.path))
@@ -0,0 +1,199 @@
+import logging
+import os
+import threading
+
+from . import git_files
+from . import gitignore
+from .matching import is_excluded_subtree
+from .trigger import FileEvent
+from .walk import walk_tree
+
+logger = logging.getLogger(__name__)
+
+
+def is_prunable_dir(filesets, path):
+    """
+    A directory can only be pruned if none of the filesets can match below it.
+    """
+    event = FileEvent(path, "scan", True)
+    return all(is_excluded_subtree(fileset, event) for fileset in filesets)
+
+
+def compute_watch_plan(working_dir, filesets):
+    """
+    Determines the set of (path, recursive) watches required to observe
+    all directories that can produce a match of any of the filesets.
+
+    Directories that contain (somewhere below) a prunable directory get
+    a non-recursive watch. All other directories are covered by a single
+    recursive watch at the topmost such directory. The working directory
+    itself is always watched, because it contains the config file.
+    """
+    root = os.path.normpath(working_dir)
+
+    pruned = []
+
+    def prune(entry):
+        if is_prunable_dir(filesets, entry.path):
+            pruned.append(entry.path)
+            return True
+        return False
+
+    dirs = [root]
+    for entry in walk_tree(root, prune=prune):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+        except OSError:
+            pass
+
+    # Mark all ancestors of pruned directories as partially watched.
+    partial = set()
+    for path in pruned:
+        parent = os.path.dirname(path)
+        while parent not in partial:
+            partial.add(parent)
+            if parent == root or parent == "":
+                break
+            parent = os.path.dirname(parent)
+
+    pruned = set(pruned)
+    plan = set()
+    for path in dirs:
+        if path in pruned:
+            continue
+        if path in partial:
+            plan.add((path, False))
+        elif path == root or os.path.dirname(path) in partial:
+            plan.add((path, True))
+
+    # `.git` itself is pruned, but some of its content is relevant:
+    # Changes to `.git/info/exclude` affect the gitignore rules, and
+    # the git directory contains the index and the markers of running
+    # git operations.
+    git_ignore = gitignore.get_gitignore(os.path.join(root, ".gitignore"))
+    if git_ignore is not None:
+        info_dir = os.path.dirname(git_ignore.info_exclude_file)
+        if any(fileset.exclude_gitignore for fileset in filesets) and os.path.isdir(info_dir):
+            plan.add((info_dir, False))
+        git_dir = os.path.dirname(git_files.find_index_file(git_ignore.repo_root))
+        if os.path.isdir(git_dir):
+            plan.add((git_dir, False))
+
+    logger.info("Watch plan: {} watches ({} non-recursive), {} pruned directories".format(
+        len(plan), sum(1 for _, recursive in plan if not recursive), len(pruned),
+    ))
+    return plan
+
+
+class WatchManager(object):
+    """
+    Maintains the watches of the observer. Instead of watching the working
+    directory recursively, subtrees that can never produce a match (e.g.
+    gitignored or excluded directories like `node_modules`) are left out,
+    which saves kernel resources (inotify watches).
+    """
+
+    def __init__(self, observer, event_handler, working_dir):
+        self.observer = observer
+        self.event_handler = event_handler
+        self.working_dir = working_dir
+
+        self.lock = threading.RLock()
+        self.filesets = []
+        # (path, recursive) => ObservedWatch
+        self.watches = {}
+
+        self._update_running = False
+        self._update_pending = False
+
+    def _schedule(self, path, recursive):
+        key = (path, recursive)
+        if key in self.watches:
+            return
+        try:
+            self.watches[key] = self.observer.schedule(
+                self.event_handler, path, recursive=recursive
+            )
+        except OSError as e:
+            logger.info("Failed to watch '{}': {}".format(path, e))
+
+    def _unschedule(self, key):
+        watch = self.watches.pop(key)
+        try:
+            self.observer.unschedule(watch)
+        except (KeyError, OSError) as e:
+            logger.info("Failed to unwatch '{}': {}".format(key[0], e))
+
+    def update(self, filesets=None):
+        """
+        Recomputes the watch plan and (un)schedules the difference.
+        """
+        with self.lock:
+            if filesets is not None:
+                self.filesets = list(filesets)
+            filesets = self.filesets
+
+        plan = compute_watch_plan(self.working_dir, filesets)
+
+        with self.lock:
+            # schedule first to not miss events in between
+            for path, recursive in sorted(plan - set(self.watches.keys())):
+                self._schedule(path, recursive)
+            for key in set(self.watches.keys()) - plan:
+                self._unschedule(key)
+
+    def request_update(self, filesets=None):
+        """
+        Triggers an update in the background. Concurrent requests are
+        coalesced into a single follow-up update.
+        """
+        with self.lock:
+            if filesets is not None:
+                self.filesets = list(filesets)
+            if self._update_running:
+                self._update_pending = True
+                return
+            self._update_running = True
+
+        thread = threading.Thread(target=self._update_loop)
+        thread.daemon = True
+        thread.start()
+
+    def _update_loop(self):
+        while True:
+            self.update()
+            with self.lock:
+                if not self._update_pending:
+                    self._update_running = False
+                    return
+                self._update_pending = False
+
+    def on_event(self, event):
+        """
+        Keeps the watches consistent with directory creations/deletions.
+        """
+        if not event.is_dir:
+            return
+
+        if event.type in ("created", "moved_to"):
+            with self.lock:
+                parent = os.path.dirname(event.path)
+                parent_is_partial = (parent, False) in self.watches
+                filesets = self.filesets
+            prunable = is_prunable_dir(filesets, event.path)
+            if parent_is_partial:
+                if not prunable:
+                    with self.lock:
+                        self._schedule(event.path, True)
+            elif prunable:
+                # The new directory is covered by a recursive watch, which
+                # has to be split up.
+                self.request_update()
+
+        elif event.type in ("deleted", "moved_from"):
+            prefix = event.path + os.sep
+            with self.lock:
+                for key in list(self.watches.keys()):
+                    if key[0] == event.path or key[0].startswith(prefix):
+                        self._unschedule(key)
@@ -4,26 +4,40 @@
 Generic tool to watch code for changes and continuously re-execute tasks.
 """
 
-from __future__ import division, print_function
-
 import argparse
 import os
 import logging
 import sys
+import threading
 import time
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-from . import matching
+from . import git_files
+from . import gitignore
 from . import templates
-from .io_handler import LaunchInfo, IOHandler
-from .config import Overrides, ConfigError, ConfigFactory, DEFAULT_CONFIG_FILENAME
-from .trigger import InitialTrigger, ManualTrigger, FileEvent
+from .io_handler import ChangeSet, LaunchInfo, IOHandler
+from .config import Overrides, ConfigError, ConfigFactory, StaticConfigFactory
+from .config import DEFAULT_CONFIG_FILENAME, INTERNAL_DIRNAME, LOG_FILENAME
+from .content_cache import ContentCache
+from .git_operations import GitOperationMonitor
+from .match_index import MatchIndex
+from .matching import DEFAULT_EVENT_TYPES, EVENT_TYPES
+from .notifications import NotificationDispatcher
+from .pipeline import EventPipeline
+from .snapshot import Snapshot
+from .watch_manager import WatchManager
+from .trigger import FileEvent, InitialTrigger, ManualTrigger, RescanTrigger
 from .colors import color, FG
 
 logger = logging.getLogger(__name__)
 
+# Mere reads of the config (e.g. by the reload itself) must not trigger a reload
+CONFIG_CHANGE_EVENT_TYPES = frozenset(
+    event_type for event in DEFAULT_EVENT_TYPES for event_type in EVENT_TYPES[event]
+)
+
 
 def parse_args():
 
@@ -60,11 +74,18 @@ def parse_args():
         metavar="<TASK>",
         help="Run a specific task. Overrides 'default_task' setting in config.",
     )
+    parser.add_argument(
+        "--all-tasks",
+        metavar="<BOOL-LIKE>",
+        type=str2bool,
+        help="Enable/disable running all tasks concurrently, each triggered by "
+             "its own fileset. Overrides 'all_tasks' setting in config.",
+    )
     parser.add_argument(
         "--log",
         metavar="<BOOL-LIKE>",
         type=str2bool,
-        help="Enable/disable debug logging to file '.watchcode.log'. "
+        help="Enable/disable debug logging to file '{}'. ".format(LOG_FILENAME) +
              "Overrides 'log' setting in config.",
     )
     parser.add_argument(
@@ -84,7 +105,7 @@ def parse_args():
     args = parser.parse_args()
 
     if args.log:
-        log_file = os.path.join(args.dir, '.watchcode.log')
+        log_file = os.path.join(args.dir, LOG_FILENAME)
         logging.basicConfig(
             level=logging.INFO,
             format='%(asctime)s.%(msecs)03d | %(levelname)-8s | %(message)s',
@@ -101,6 +122,7 @@ def extract_overrides(args):
         log=args.log,
         sound=args.sound,
         notifications=args.notifications,
+        all_tasks=args.all_tasks,
     )
 
 
@@ -111,9 +133,23 @@ class EventHandler(FileSystemEventHandler):
         self.working_dir = working_dir
         self.config_factory = config_factory
 
+        self.lock = threading.Lock()
         self.config = self.initial_config_load()
+        # fileset name => MatchIndex, shared by all tasks using the fileset
+        self.match_indexes = {}
+        self._update_match_indexes(self.config)
+        self.watch_manager = None
+        self.content_cache = ContentCache()
 
-        self.io_handler = IOHandler(working_dir)
+        # group of tasks connected by dependencies => IOHandler
+        self.io_handlers = {}
+        # shared by all IOHandlers, so that notifications don't overlap
+        self.dispatcher = NotificationDispatcher()
+
+        self.git_operations = GitOperationMonitor(working_dir)
+
+        self.pipeline = EventPipeline(self.on_events, self.on_overflow)
+        self.pipeline.start()
 
     def initial_config_load(self):
         try:
@@ -127,58 +163,309 @@ class EventHandler(FileSystemEventHandler):
             ))
             sys.exit(1)
 
-    def on_any_event(self, event):
+    def _update_match_indexes(self, config):
         """
-        Overrides EventHandler.on_any_event for general notifications.
-        The implementation convert the raw event into our own simplified
-        representation, which converts 'moved' event two separate events
-        in order to avoid special handling for event.dest_path.
+        Brings the match indexes in line with the filesets of the active
+        tasks. Returns the indexes that need to be (re-)populated.
+        """
+        with self.lock:
+            filesets = {}
+            for task in config.active_tasks.values():
+                filesets[task.fileset_name] = task.fileset
+
+            outdated = []
+            match_indexes = {}
+            for name, fileset in filesets.items():
+                match_index = self.match_indexes.get(name)
+                if match_index is None:
+                    match_index = MatchIndex(fileset)
+                    outdated.append(match_index)
+                elif match_index.set_fileset(fileset):
+                    outdated.append(match_index)
+                match_indexes[name] = match_index
+
+            changed = len(outdated) > 0 or set(match_indexes) != set(self.match_indexes)
+            self.match_indexes = match_indexes
+        return outdated, changed
+
+    @property
+    def filesets(self):
+        with self.lock:
+            return [match_index.fileset for match_index in self.match_indexes.values()]
+
+    def populate_match_index(self, match_indexes=None):
         """
-        super(EventHandler, self).on_any_event(event)
+        Fills the match indexes in the background.
+        """
+        if match_indexes is None:
+            with self.lock:
+                match_indexes = list(self.match_indexes.values())
+        for match_index in match_indexes:
+            thread = threading.Thread(
+                target=self._populate_match_index,
+                args=(match_index,),
+            )
+            thread.daemon = True
+            thread.start()
 
-        if event.event_type == "moved":
-            events = [
-                FileEvent(event.src_path, event.event_type + "_from", event.is_directory),
-                FileEvent(event.dest_path, event.event_type + "_to", event.is_directory),
-            ]
-        else:
-            events = [
-                FileEvent(event.src_path, event.event_type, event.is_directory),
-            ]
+    def _populate_match_index(self, match_index):
+        if match_index.populate(self.working_dir) and match_index.fileset.compare_content:
+            self.content_cache.prime(match_index.matched_files())
 
-        for event in events:
-            self.on_any_single_event(event)
+    def schedule_watches(self, observer):
+        """
+        Schedules the (pruned) set of watches on the observer.
+        """
+        self.watch_manager = WatchManager(observer, self, self.working_dir)
+        self.watch_manager.update(self.filesets)
 
-    def on_any_single_event(self, event):
+    def on_any_event(self, event):
         """
-        Actual event handler.
+        Overrides EventHandler.on_any_event for general notifications.
+        This runs on the observer thread, and only hands the raw event
+        over to the event pipeline.
         """
-        matches = matching.does_match(self.config.task.fileset, event)
+        self.pipeline.put(event)
 
-        # There is one exception we should make for logging: We should not log
-        # changes to '.watchcode.log' otherwise a log event would trigger yet
-        # another change, creating a log loop.
-        if event.basename != ".watchcode.log":
+    def on_events(self, events):
+        """
+        Handles a coalesced batch of events (called by the pipeline).
+        """
+        # watchcode's own files must neither trigger tasks nor get logged
+        # (logging changes of the log file would create a log loop)
+        events = [event for event in events if not self._is_internal(event)]
+
+        # during git operations events are held back and released at once
+        events, overflowed = self.git_operations.process(events)
+        if overflowed:
+            self.on_overflow()
+            return
+
+        routed = [self._route(event) for event in events]
+        unchanged = self._find_unchanged_content(routed)
+
+        for event, config, task_names in routed:
+            content_unchanged = event.type == "modified" and \
+                os.path.normpath(event.path) in unchanged
+            if content_unchanged:
+                task_names = [
+                    task_name for task_name in task_names
+                    if not config.tasks[task_name].fileset.compare_content
+                ]
+
+            if len(task_names) > 0:
+                decision = u"✓ " + ", ".join(task_names)
+            elif content_unchanged:
+                decision = u"○ (content unchanged)"
+            else:
+                decision = u"○"
             logger.info(u"Event: {:<60s} {:<12} {}".format(
                 event.path_normalized,
                 event.type,
-                u"✓" if matches else u"○",
+                decision,
             ))
 
-        if matches:
-            launch_info = LaunchInfo(
-                old_config=self.config,
-                trigger=event,
-                config_factory=self.config_factory,
-                on_task_finished=self.on_task_finished,
-            )
-            self.io_handler.trigger(launch_info)
+            for task_name in task_names:
+                self._trigger(event, task_name)
+
+    def on_overflow(self):
+        """
+        Called by the pipeline if events had to be dropped. Since we don't
+        know what changed, we have to assume that anything could have.
+        """
+        if self.git_operations.defer_overflow():
+            return
+        git_files.refresh_all(self._on_file_list_changed)
+        self.config_factory.notify_changed()
+        if self.watch_manager is not None:
+            self.watch_manager.request_update()
+        self._trigger(RescanTrigger())
+
+    def on_any_single_event(self, event):
+        self.on_events([event])
+
+    def _on_file_list_changed(self):
+        # called from the background refresh of git's file list
+        if self.watch_manager is not None:
+            self.watch_manager.request_update()
+
+    def _route(self, event):
+        """
+        Updates the internal state for an event and determines the tasks
+        whose fileset matches. Returns (event, config, task_names).
+        """
+        # Edits of ignore files have to invalidate cached ignore rules (and
+        # thereby the match index) before matching. Edits of the git index
+        # refresh the file list in the background, without stalling events.
+        ignore_file_changed = gitignore.notify_changed(event.path)
+        git_files.notify_changed(event.path, self._on_file_list_changed)
+
+        # the config gets reloaded before a task can use it
+        rel_event = FileEvent(os.path.relpath(event.path, self.working_dir), event.type, event.is_dir)
+        if rel_event.is_config_file and event.type in CONFIG_CHANGE_EVENT_TYPES:
+            self.config_factory.notify_changed()
+
+        if self.watch_manager is not None:
+            if ignore_file_changed:
+                self.watch_manager.request_update()
+            else:
+                self.watch_manager.on_event(event)
+
+        with self.lock:
+            config = self.config
+            match_indexes = self.match_indexes
+
+        # evaluate each fileset only once, even if it is used by several tasks
+        fileset_matches = {
+            name: match_index.does_match(event)
+            for name, match_index in match_indexes.items()
+        }
+        task_names = sorted(
+            task_name for task_name, task in config.active_tasks.items()
+            if fileset_matches.get(task.fileset_name, False)
+        )
+        return event, config, task_names
+
+    def _is_internal(self, event):
+        rel_path = os.path.relpath(event.path, self.working_dir)
+        return rel_path == LOG_FILENAME or rel_path.split(os.sep)[0] == INTERNAL_DIRNAME
+
+    def _find_unchanged_content(self, routed):
+        """
+        Checks the content of files matched by filesets using `compare_content`
+        (in parallel) and returns the paths of modified files whose content
+        did not change. Created files are recorded for later comparisons.
+        """
+        paths = set()
+        for event, config, task_names in routed:
+            if event.is_dir or not any(
+                config.tasks[task_name].fileset.compare_content for task_name in task_names
+            ):
+                continue
+            if event.type in ("modified", "created", "moved_to"):
+                paths.add(os.path.normpath(event.path))
+            elif event.type in ("deleted", "moved_from"):
+                self.content_cache.forget(event.path)
+
+        if len(paths) == 0:
+            return set()
+        return paths - self.content_cache.changed(paths)
 
     def on_task_finished(self, config):
         """
         Callback for finished build.
         """
-        self.config = config
+        with self.lock:
+            self.config = config
+        self._prune_io_handlers(config)
+        outdated, changed = self._update_match_indexes(config)
+        if len(outdated) > 0:
+            self.populate_match_index(outdated)
+        if changed and self.watch_manager is not None:
+            self.watch_manager.request_update(self.filesets)
+
+    def _prune_io_handlers(self, config):
+        """
+        Stops and drops the IOHandlers of groups of tasks which no longer
+        exist, e.g. because dependencies have changed. Their pending tasks
+        are triggered again in the new groups.
+        """
+        components = {config.graph.component(name) for name in config.tasks}
+        with self.lock:
+            removed = [
+                (component, io_handler) for component, io_handler in self.io_handlers.items()
+                if component not in components
+            ]
+            for component, _ in removed:
+                del self.io_handlers[component]
+        for component, io_handler in removed:
+            logger.info("Task group {} no longer exists => stopping its IOHandler".format(
+                sorted(component)
+            ))
+            io_handler.stop()
+            with io_handler.lock:
+                pending_tasks = set(io_handler.pending_tasks)
+            for task_name in sorted(pending_tasks):
+                if task_name in config.tasks:
+                    # the changes collected for the task are lost
+                    self._trigger(ManualTrigger(), task_name)
+
+    def task_results(self):
+        with self.lock:
+            io_handlers = list(self.io_handlers.values())
+        results = {}
+        for io_handler in io_handlers:
+            results.update(io_handler.settled_results())
+        return results
+
+    def save_snapshot(self):
+        """
+        Stores the state of the matched files and the task results on exit.
+        Results of tasks that did not run in this session are carried over
+        from the previous snapshot, unless a run of their group is pending.
+        """
+        results = {}
+        old_snapshot = Snapshot.load(self.working_dir)
+        if old_snapshot is not None:
+            with self.lock:
+                io_handlers = list(self.io_handlers.items())
+            unsettled = set()
+            for component, io_handler in io_handlers:
+                if not io_handler.is_settled():
+                    unsettled.update(component)
+            results.update(
+                (name, result) for name, result in old_snapshot.results.items()
+                if name not in unsettled
+            )
+        results.update(self.task_results())
+        Snapshot.take(self.working_dir, self.filesets, results).save(self.working_dir)
+
+    def initial_trigger(self):
+        """
+        Triggers the initial run, unless nothing changed since the last
+        session and the last runs of all active tasks succeeded. If only
+        some files changed, only the affected tasks are triggered.
+        """
+        old_snapshot = Snapshot.load(self.working_dir)
+        if old_snapshot is None:
+            self.on_manual_trigger(is_initial=True)
+            return
+
+        snapshot = Snapshot.take(self.working_dir, self.filesets, {})
+        changed = old_snapshot.diff(snapshot)
+        with self.lock:
+            config = self.config
+        not_succeeded = sorted(
+            task_name for task_name in config.active_tasks
+            if not old_snapshot.results.get(task_name)
+        )
+
+        if len(changed) == 0 and len(not_succeeded) == 0:
+            print(" * Nothing changed since the last session => skipping initial run")
+            print(" * Monitoring '{}' for changes... [Press <CTRL>+C to exit]".format(
+                self.working_dir
+            ))
+            return
+
+        if len(changed) > 0:
+            print(" * Changed since the last session: {}".format(ChangeSet(changed)))
+        if DEFAULT_CONFIG_FILENAME in changed:
+            self.on_manual_trigger(is_initial=True)
+            return
+
+        events = []
+        for path in changed:
+            if path not in snapshot.files:
+                event_type = "deleted"
+            elif path not in old_snapshot.files:
+                event_type = "created"
+            else:
+                event_type = "modified"
+            events.append(FileEvent(os.path.join(self.working_dir, path), event_type, False))
+        self.on_events(events)
+
+        for task_name in not_succeeded:
+            self._trigger(InitialTrigger(), task_name)
 
     def on_manual_trigger(self, is_initial=False):
         """
@@ -188,14 +475,136 @@ class EventHandler(FileSystemEventHandler):
             trigger = InitialTrigger()
         else:
             trigger = ManualTrigger()
+        self._trigger(trigger)
 
-        launch_info = LaunchInfo(
-            old_config=self.config,
-            trigger=trigger,
-            config_factory=self.config_factory,
-            on_task_finished=self.on_task_finished,
-        )
-        self.io_handler.trigger(launch_info)
+    def cancel_running(self):
+        with self.lock:
+            io_handlers = list(self.io_handlers.values())
+        for io_handler in io_handlers:
+            io_handler.cancel_running()
+
+    def _trigger(self, trigger, task_name=None):
+        """
+        Triggers the given task, or all active tasks if no task is given.
+        """
+        with self.lock:
+            config = self.config
+            if task_name is None:
+                task_names = sorted(config.active_tasks.keys())
+            else:
+                task_names = [task_name]
+            io_handlers = []
+            for name in task_names:
+                component = config.graph.component(name)
+                if component not in self.io_handlers:
+                    self.io_handlers[component] = IOHandler(self.working_dir, self.dispatcher)
+                io_handlers.append(self.io_handlers[component])
+
+        for name, io_handler in zip(task_names, io_handlers):
+            launch_info = LaunchInfo(
+                old_config=config,
+                task_name=name,
+                trigger=trigger,
+                config_factory=self.config_factory,
+                on_task_finished=self.on_task_finished,
+            )
+            io_handler.trigger(launch_info)
+
+    def stop(self):
+        """
+        Stops handling events, discards pending triggers, stops the
+        runners of the tasks, and shuts down worker threads.
+        """
+        self.pipeline.stop()
+        with self.lock:
+            io_handlers = list(self.io_handlers.values())
+        for io_handler in io_handlers:
+            io_handler.stop()
+        self.content_cache.close()
+        self.dispatcher.stop()
+
+
+class Watcher(object):
+    """
+    Embeddable watcher, e.g. to run the tasks from within a dev server
+    instead of a separate process.
+
+    Without `config` the config file of `working_dir` is used (and reloaded
+    on changes). Otherwise `config` is a dict with the structure of the
+    config file, where commands can also be Python callables. They are
+    called in-process with the list of changed files (relative paths), and
+    their return value is the exit code (None/True: success, False: failure).
+
+    Raises ConfigError if the config is invalid.
+    """
+
+    def __init__(self, working_dir=".", config=None, overrides=None):
+        if overrides is None:
+            overrides = Overrides()
+        self.working_dir = working_dir
+        if config is None:
+            self.config_factory = ConfigFactory(working_dir, overrides)
+            # raises here instead of exiting in the event handler
+            self.config_factory.load_config()
+        else:
+            self.config_factory = StaticConfigFactory(config, overrides)
+        self.event_handler = EventHandler(working_dir, self.config_factory)
+        self.observer = None
+
+    def start(self, initial_run=True):
+        """
+        Starts watching. The tasks run initially, unless `initial_run` is
+        disabled or nothing changed since the last session.
+        """
+        self.event_handler.populate_match_index()
+        if initial_run:
+            self.event_handler.initial_trigger()
+        self.observer = Observer()
+        self.event_handler.schedule_watches(self.observer)
+        self.observer.start()  # TODO: catch OSError here? Thrown e.g. on wrong file permissions
+        return self
+
+    def trigger(self):
+        """
+        Triggers a run of all active tasks.
+        """
+        self.event_handler.on_manual_trigger()
+
+    def wait_idle(self, timeout=None):
+        """
+        Waits until no run is pending or in progress. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.event_handler.lock:
+            io_handlers = list(self.event_handler.io_handlers.values())
+        for io_handler in io_handlers:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+            if not io_handler.debouncer.wait_idle(remaining):
+                return False
+        return True
+
+    def stop(self):
+        """
+        Stops watching, cancels running commands, and saves the snapshot
+        of the session.
+        """
+        if self.observer is not None:
+            self.observer.stop()
+        # tasks running in their own process group don't receive the SIGINT
+        self.event_handler.cancel_running()
+        if self.observer is not None:
+            self.observer.join()
+            self.observer = None
+        self.event_handler.stop()
+        self.event_handler.save_snapshot()
+
+    def __enter__(self):
+        if self.observer is None:
+            self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
 
 
 def main():
@@ -214,24 +623,26 @@ def main():
             with open(config_path, "w") as f:
                 f.write(args.init_config)
 
-    config_factory = ConfigFactory(working_dir, overrides)
-    event_handler = EventHandler(working_dir, config_factory)
-    event_handler.on_manual_trigger(is_initial=True)
-
-    observer = Observer()
-    observer.schedule(event_handler, working_dir, recursive=True)
-    observer.start()  # TODO: catch OSError here? Thrown e.g. on wrong file permissions
+    try:
+        watcher = Watcher(working_dir, overrides=overrides)
+    except ConfigError as e:
+        print(" * {}Error reloading config{}:\n{}".format(
+            color(FG.red),
+            color(),
+            str(e),
+        ))
+        sys.exit(1)
+    watcher.start()
     try:
         while True:
             time.sleep(1000)
         # TODO: make this optional
         # while True:
-        #     input_value = six.moves.input()
+        #     input_value = input()
         #     if input_value == "":
-        #         event_handler.on_manual_trigger()
+        #         watcher.trigger()
     except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
+        watcher.stop()
 
 
 if __name__ == "__main__":